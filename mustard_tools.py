@@ -16,9 +16,12 @@ import addon_utils
 import sys
 import os
 import re
+import json
 import time
 import math
+import numpy as np
 from bpy.props import *
+from bpy.app.handlers import persistent
 from mathutils import Vector, Color
 import webbrowser
 
@@ -48,6 +51,59 @@ def mustardtools_ms_advanced_update(self, context):
     
     return
         
+# Factors of the Mouth Controller corrections, and flag to suspend their updates while a profile is copied
+mustardtools_mouth_controller_factor_names = ["edge_z", "middle1_x", "middle1_z", "middle2_x", "middle2_z", "center_z", "floor", "transform"]
+mustardtools_mouth_controller_update_suspended = False
+
+# Function for Mouth Controller corrections (update the constraints of the Mouth Controller, if already created)
+def mustardtools_mouth_controller_correction_update(factor):
+    
+    def update(self, context):
+        if mustardtools_mouth_controller_update_suspended:
+            return
+        mustardtools_mouth_controller_update(bpy.context.scene.mustardtools_settings, self, [factor])
+    
+    return update
+
+# Class with the Mouth Controller settings of a character.
+# The profile has also all the mouth_controller_* properties of the settings, which are added before registration
+class MustardTools_MouthControllerProfile(bpy.types.PropertyGroup):
+    
+    enabled: bpy.props.BoolProperty(default=True,
+                                    name="Enabled",
+                                    description="Include this profile in the batch operations")
+
+# Class with the settings of a channel of the Custom layout of the Merge Images tool
+class MustardTools_MergeImagesChannel(bpy.types.PropertyGroup):
+    
+    source: bpy.props.EnumProperty(name="Source",
+                                    items=[("NONE", "None", "The channel is not used (not created for alpha, filled with 0 otherwise)"),
+                                           ("IMAGE", "Image", "Take the channel from an image node"),
+                                           ("CONSTANT", "Constant", "Fill the channel with a value")],
+                                    default="NONE")
+    node: bpy.props.StringProperty(name="Node",
+                                    default="",
+                                    description="Image node of the active material")
+    channel: bpy.props.EnumProperty(name="Channel",
+                                    items=[("0", "R", "Red channel"),
+                                           ("1", "G", "Green channel"),
+                                           ("2", "B", "Blue channel"),
+                                           ("3", "A", "Alpha channel")],
+                                    default="0",
+                                    description="Channel of the image to use (R for grayscale images)")
+    value: bpy.props.FloatProperty(name="Value",
+                                    default=0.,min=0.,max=1.,
+                                    description="Value of the constant channel")
+    invert: bpy.props.BoolProperty(name="Invert",
+                                    default=False,
+                                    description="Invert the values of the channel (for example, to convert glossiness to roughness).\nThe material nodes are linked to restore the original values")
+    remap_min: bpy.props.FloatProperty(name="Min",
+                                    default=0.,min=0.,max=1.,
+                                    description="Value the channel 0 is remapped to")
+    remap_max: bpy.props.FloatProperty(name="Max",
+                                    default=1.,min=0.,max=1.,
+                                    description="Value the channel 1 is remapped to")
+
 # Class with all the settings variables
 class MustardTools_Settings(bpy.types.PropertyGroup):
     
@@ -79,6 +135,9 @@ class MustardTools_Settings(bpy.types.PropertyGroup):
                                                                 name="",
                                                                 description="Object that will be used as custom shape for the IK controller",
                                                                 poll=mustardtools_poll_mesh)
+    ik_chain_mirror: bpy.props.BoolProperty(name="Build Mirrored",
+                                                    description="Create the IK also on the mirrored chain, found by name or by position.\nThe controller of the mirrored chain is placed flipping the X coordinates",
+                                                    default=False)
     ik_chain_pole_angle: bpy.props.IntProperty(name="Pole Angle",
                                                     default=90,min=-180,max=180,
                                                     description="Pole rotation offset.\nChange this value if the rotation of the bones in the result are wrong (usually this is 90 or -90 degrees)")
@@ -86,6 +145,9 @@ class MustardTools_Settings(bpy.types.PropertyGroup):
                                                                 name="",
                                                                 description="Object that will be used as custom shape for the IK pole",
                                                                 poll=mustardtools_poll_mesh)
+    ik_chain_pole_distance: bpy.props.FloatProperty(name="Pole Distance",
+                                                    default=0.5,min=0.05,max=5.,
+                                                    description="Distance of the automatic poles from the bend of the chain, relative to the length of the chain")
     
     # Internal definitions (not for UI)
     ik_chain_pole_status: bpy.props.BoolProperty(default=False,
@@ -100,6 +162,9 @@ class MustardTools_Settings(bpy.types.PropertyGroup):
     ik_spline_number: bpy.props.IntProperty(default=3,min=3,max=20,
                                             name="Controllers",
                                             description="Number of IK spline controllers")
+    ik_spline_arc_length: bpy.props.BoolProperty(name="Even Spacing",
+                                            description="Place the controllers at even distances along the chain, instead of on the heads of evenly spaced bones.\nUseful with many controllers on chains of bones with different lengths",
+                                            default=False)
     ik_spline_resolution: bpy.props.IntProperty(default=32,min=1,max=64,
                                             name="Resolution",
                                             description="Resolution of the spline.\nSubdivision performed on each segment of the curve")
@@ -109,6 +174,9 @@ class MustardTools_Settings(bpy.types.PropertyGroup):
     ik_spline_bendy_segments: bpy.props.IntProperty(name="Segments",
                                                     default=2,min=2,max=32,
                                                     description="Number of segments for every bendy bone")
+    ik_spline_mirror: bpy.props.BoolProperty(name="Build Mirrored",
+                                                    description="Create the IK spline also on the mirrored chain, found by name or by position.\nThe controllers of the mirrored chain are placed flipping the X coordinates",
+                                                    default=False)
     ik_spline_bone_custom_shape: bpy.props.PointerProperty(type=bpy.types.Object,
                                                     name="",
                                                     description="Object that will be used as custom shape for the spline IK bones",
@@ -125,6 +193,12 @@ class MustardTools_Settings(bpy.types.PropertyGroup):
     mouth_controller_number_bones: bpy.props.IntProperty(default=2, min=1, max=2, name="Number of central bones")
     mouth_controller_create_driver: bpy.props.BoolProperty(name="Create Driver",
                                                     description="Create a driver on the Armature object to switch on/off the mouth controller")
+    mouth_controller_driver_type: bpy.props.EnumProperty(name="Switch",
+                                                    items=[("AVERAGE", "Driver", "One Averaged Value driver on each constraint, reading the Mouth Controller Mute custom property of the Armature"),
+                                                           ("SIMPLE_EXPRESSION", "Simple Expression Driver", "One Scripted Expression driver on each constraint, with an expression evaluated without Python"),
+                                                           ("SWITCH", "Switch", "No drivers: the Mouth Controller Mute property of the Armature mutes the constraints directly when changed.\nNothing is evaluated during playback, but the switch can not be animated")],
+                                                    default="AVERAGE",
+                                                    description="Mechanism used to switch on/off the mouth controller")
     mouth_controller_mhx: bpy.props.BoolProperty(name="MHX",
                                                     description="Use this option if the armature type is MHX")
     mouth_controller_body_object: bpy.props.PointerProperty(type=bpy.types.Object,
@@ -137,31 +211,39 @@ class MustardTools_Settings(bpy.types.PropertyGroup):
                                                             description="The default value can not be changed")
     mouth_controller_edge_bone_correction_z: bpy.props.FloatProperty(default=0.1,
                                                             name="Edge bones correction (z axis)",
-                                                            description="This value is the ratio between the movement of the edge bones and the center bones on the z axis (back and forth movement of the controller bone)")
+                                                            description="This value is the ratio between the movement of the edge bones and the center bones on the z axis (back and forth movement of the controller bone)",
+                                                            update=mustardtools_mouth_controller_correction_update("edge_z"))
     mouth_controller_middle1_bone_correction_x: bpy.props.FloatProperty(default=0.2,
                                                             name="Middle bones 1 correction (x axis)",
-                                                            description="This value is the ratio between the movement of the middle bones and the edge bones on the x axis (left and right movement of the controller bone)")
+                                                            description="This value is the ratio between the movement of the middle bones and the edge bones on the x axis (left and right movement of the controller bone)",
+                                                            update=mustardtools_mouth_controller_correction_update("middle1_x"))
     mouth_controller_middle1_bone_correction_z: bpy.props.FloatProperty(default=1.,
                                                             name="Middle bones 1 correction (z axis)",
-                                                            description="This value is the ratio between the movement of the middle bones and the center bones on the x axis (back and forth movement of the controller bone)")
+                                                            description="This value is the ratio between the movement of the middle bones and the center bones on the x axis (back and forth movement of the controller bone)",
+                                                            update=mustardtools_mouth_controller_correction_update("middle1_z"))
     mouth_controller_middle2_bone_correction_x: bpy.props.FloatProperty(default=0.5,
                                                             name="Middle bones 2 correction (x axis)",
-                                                            description="This value is the ratio between the movement of the middle bones and the edge bones on the x axis (left and right movement of the controller bone)")
+                                                            description="This value is the ratio between the movement of the middle bones and the edge bones on the x axis (left and right movement of the controller bone)",
+                                                            update=mustardtools_mouth_controller_correction_update("middle2_x"))
     mouth_controller_middle2_bone_correction_z: bpy.props.FloatProperty(default=1.,
                                                             name="Middle bones 2 correction (z axis)",
-                                                            description="This value is the ratio between the movement of the middle bones and the center bones on the x axis (back and forth movement of the controller bone)")
+                                                            description="This value is the ratio between the movement of the middle bones and the center bones on the x axis (back and forth movement of the controller bone)",
+                                                            update=mustardtools_mouth_controller_correction_update("middle2_z"))
     mouth_controller_center_bone_correction_x: bpy.props.FloatProperty(default=1.,
                                                             name="Center bones correction (x axis)",
                                                             description="The default value can not be changed")
     mouth_controller_center_bone_correction_z: bpy.props.FloatProperty(default=1.,
                                                             name="Middle bones 2 correction (z axis)",
-                                                            description="This value is the ratio between the movement of the middle bones and the center bones on the x axis (back and forth movement of the controller bone)")
+                                                            description="This value is the ratio between the movement of the middle bones and the center bones on the x axis (back and forth movement of the controller bone)",
+                                                            update=mustardtools_mouth_controller_correction_update("center_z"))
     mouth_controller_floor_correction: bpy.props.FloatProperty(default=1.0,
                                                             name="Limit distance factor",
-                                                            description="Value to adjust the maximum distance between the lips")
+                                                            description="Value to adjust the maximum distance between the lips",
+                                                            update=mustardtools_mouth_controller_correction_update("floor"))
     mouth_controller_transform_ratio: bpy.props.FloatProperty(default=0.1,
                                                             name="Bones transformation value",
-                                                            description="The value with which the bones are affected by the movement of the controller")
+                                                            description="The value with which the bones are affected by the movement of the controller",
+                                                            update=mustardtools_mouth_controller_correction_update("transform"))
     
     mouth_controller_armature_controller: bpy.props.PointerProperty(type=bpy.types.Object,
                                                     name="Armature controller",
@@ -190,6 +272,13 @@ class MustardTools_Settings(bpy.types.PropertyGroup):
     mouth_controller_middle2_bone_L_bot: bpy.props.StringProperty(name="Middle 2 Bottom L",description="In the case of more than one middle bone, the Middle 2 should be the one far from the center bone")
     mouth_controller_middle2_bone_R_bot: bpy.props.StringProperty(name="Middle 2 Bottom R",description="In the case of more than one middle bone, the Middle 2 should be the one far from the center bone")
     mouth_controller_jaw_bone: bpy.props.StringProperty(name="Jaw")
+    mouth_controller_conventions_file: bpy.props.StringProperty(name="Conventions",
+                                                    subtype='FILE_PATH',
+                                                    description="JSON file with additional naming conventions for the Smart Search")
+    
+    # Profiles definitions
+    mouth_controller_profiles: bpy.props.CollectionProperty(type=MustardTools_MouthControllerProfile)
+    mouth_controller_profiles_index: bpy.props.IntProperty(default=0)
     
     # Merge Images To Grayscale Tool definitions
     # UI definitions
@@ -199,16 +288,696 @@ class MustardTools_Settings(bpy.types.PropertyGroup):
     merge_images_to_grayscale_separator: bpy.props.StringProperty(name="Separator",
                                                     default = "_",
                                                     description="Separation character for new image name")
+    merge_images_to_grayscale_layout: bpy.props.EnumProperty(name = "Layout",
+                                                    items=[("SELECTED", "Selected", "Merge the selected image nodes: 3 images in the RGB channels, or 4 images in the RGBA channels"),
+                                                           ("CUSTOM", "Custom", "Set the source of every channel")],
+                                                    default = "SELECTED")
+    merge_images_to_grayscale_r: bpy.props.PointerProperty(type=MustardTools_MergeImagesChannel)
+    merge_images_to_grayscale_g: bpy.props.PointerProperty(type=MustardTools_MergeImagesChannel)
+    merge_images_to_grayscale_b: bpy.props.PointerProperty(type=MustardTools_MergeImagesChannel)
+    merge_images_to_grayscale_a: bpy.props.PointerProperty(type=MustardTools_MergeImagesChannel)
+    merge_images_to_grayscale_resolution: bpy.props.EnumProperty(name = "Resolution",
+                                                    items=[("MIN", "Smallest", "Resample the images to the smallest width and height"),
+                                                           ("MAX", "Largest", "Resample the images to the largest width and height"),
+                                                           ("POWER_OF_TWO", "Power of Two", "Resample the images to the largest width and height, rounded to the nearest power of two"),
+                                                           ("EXPLICIT", "Explicit", "Resample the images to the width and height set")],
+                                                    default = "MIN",
+                                                    description = "Resolution of the new image, if the images have different sizes")
+    merge_images_to_grayscale_width: bpy.props.IntProperty(name = "Width",
+                                                    default = 2048,min = 1,max = 65536,
+                                                    description = "Width of the new image")
+    merge_images_to_grayscale_height: bpy.props.IntProperty(name = "Height",
+                                                    default = 2048,min = 1,max = 65536,
+                                                    description = "Height of the new image")
+    merge_images_to_grayscale_filter: bpy.props.EnumProperty(name = "Filter",
+                                                    items=[("AREA", "Area", "Average of the pixels covered by the new pixel (best for downscaling)"),
+                                                           ("BILINEAR", "Bilinear", "Linear interpolation"),
+                                                           ("LANCZOS", "Lanczos", "Lanczos filter with 3 lobes (sharper, slower)")],
+                                                    default = "AREA",
+                                                    description = "Filter used to resample the images")
+    merge_images_to_grayscale_streaming: bpy.props.BoolProperty(name = "Streaming",
+                                                    default = False,
+                                                    description = "Read, pack and write the images in strips of rows, to merge very large images with bounded memory.\nThe new image is always written in the textures folder")
+    merge_images_to_grayscale_strip: bpy.props.IntProperty(name = "Strip Rows",
+                                                    default = 512,min = 16,max = 8192,
+                                                    description = "Number of rows read and written at the same time with the Streaming option")
+    merge_images_to_grayscale_save: bpy.props.BoolProperty(name = "Save to Disk",
+                                                    default = True,
+                                                    description = "Save the new image in the textures folder next to the .blend file.\nIf disabled, the image is packed in the .blend file")
     
 
+MustardTools_MouthControllerProfile.__annotations__.update({k: v for k, v in MustardTools_Settings.__annotations__.items() if k.startswith("mouth_controller_") and not k.startswith("mouth_controller_profiles")})
+
+bpy.utils.register_class(MustardTools_MergeImagesChannel)
+bpy.utils.register_class(MustardTools_MouthControllerProfile)
 bpy.utils.register_class(MustardTools_Settings)
 
 bpy.types.Scene.mustardtools_settings = bpy.props.PointerProperty(type=MustardTools_Settings)
 
+# ------------------------------------------------------------------------
+#    Rig Components Registry
+# ------------------------------------------------------------------------
+
+# Every rig component generated by the tools (an IK chain, an IK spline, ...) is recorded on the armature object,
+# with all the elements that have been created for it. Cleanup and listing use these records,
+# instead of searching the generated data through constraint names and targets.
+# The component ID is built from the component type and the bone with the main constraint,
+# so that the component of a bone can be found directly.
+
+# Element of a rig component
+class MustardTools_RigElement(bpy.types.PropertyGroup):
+    
+    # The name of the element is the name of the bone (BONE, CHAIN and CUSTOM_SHAPE), of the constraint (CONSTRAINT),
+    # the data path of the driver (DRIVER) or the name of the custom property (PROPERTY).
+    # The object is the owner of constraints, drivers, custom properties and custom shapes, if not the armature of the component
+    type: bpy.props.EnumProperty(items=[("BONE", "Bone", "Bone created for the component"),
+                                        ("CHAIN", "Chain Bone", "Bone of the armature used by the component"),
+                                        ("CONSTRAINT", "Constraint", "Constraint created for the component"),
+                                        ("OBJECT", "Object", "Object created for the component"),
+                                        ("DRIVER", "Driver", "Driver created for the component"),
+                                        ("PROPERTY", "Custom Property", "Custom property created for the component"),
+                                        ("CUSTOM_SHAPE", "Custom Shape", "Bone with the custom shape set by the component")])
+    bone: bpy.props.StringProperty(description="Bone with the constraint (CONSTRAINT)")
+    object: bpy.props.PointerProperty(type=bpy.types.Object)
+
+bpy.utils.register_class(MustardTools_RigElement)
+
+# Rig component, with the list of its elements
+class MustardTools_RigComponent(bpy.types.PropertyGroup):
+    
+    type: bpy.props.EnumProperty(items=[("IK_CHAIN", "IK Chain", "IK Chain rig", "CON_KINEMATIC", 0),
+                                        ("IK_SPLINE", "IK Spline", "IK Spline rig", "CON_SPLINEIK", 1),
+                                        ("MOUTH_CONTROLLER", "Mouth Controller", "Mouth Controller rig", "MESH_MONKEY", 2)])
+    elements: bpy.props.CollectionProperty(type=MustardTools_RigElement)
+
+bpy.utils.register_class(MustardTools_RigComponent)
+
+bpy.types.Object.mustardtools_rig_components = bpy.props.CollectionProperty(type=MustardTools_RigComponent)
+bpy.types.Object.mustardtools_rig_components_index = bpy.props.IntProperty(default=0)
+
+def mustardtools_rig_component_id(type, bone_name):
+    
+    return type + ":" + bone_name
+
+# Create a new component on the armature (replacing a previous one with the same ID)
+def mustardtools_rig_component_new(arm, type, bone_name):
+    
+    component_id = mustardtools_rig_component_id(type, bone_name)
+    
+    index = arm.mustardtools_rig_components.find(component_id)
+    if index >= 0:
+        arm.mustardtools_rig_components.remove(index)
+    
+    component = arm.mustardtools_rig_components.add()
+    component.name = component_id
+    component.type = type
+    
+    return component
+
+def mustardtools_rig_component_add(component, type, name="", bone="", object=None):
+    
+    element = component.elements.add()
+    element.type = type
+    element.name = name
+    element.bone = bone
+    element.object = object
+    
+    return element
+
+# Find the components of a type with the main constraint on one of the bones
+def mustardtools_rig_components_find(arm, type, bone_names):
+    
+    components = []
+    for bone_name in bone_names:
+        component = arm.mustardtools_rig_components.get(mustardtools_rig_component_id(type, bone_name))
+        if component != None:
+            components.append(component)
+    
+    return components
+
+# Remove rig elements from an armature in a single pass:
+# constraints are removed first, then objects with a single batch removal, and finally
+# bones are removed and bendy bones are resetted in a single Edit mode session.
+# The armature is left in the mode it was before the removal.
+# Returns the number of removed constraints, objects and bones, and the list of the removed items
+def mustardtools_rig_remove(arm, constraints, objects, bones, bendy_bones, settings):
+    
+    removed = {"constraints": 0, "drivers": 0, "objects": 0, "bones": 0, "items": []}
+    
+    for bone_name, constraint_name in constraints:
+        bone = arm.pose.bones.get(bone_name)
+        if bone == None:
+            continue
+        constraint = bone.constraints.get(constraint_name)
+        if constraint != None:
+            bone.constraints.remove(constraint)
+            removed["constraints"] += 1
+            removed["items"].append("Constraint " + constraint_name + " of " + bone_name)
+            if settings.ms_debug:
+                print("MustardTools - Constraint " + constraint_name + " removed from " + bone_name)
+    
+    objects = [obj for obj in set(objects) if obj != None]
+    if len(objects) > 0:
+        for obj in objects:
+            removed["items"].append("Object " + obj.name)
+            if settings.ms_debug:
+                print("MustardTools - Object " + obj.name + " removed")
+        
+        # Remove also the curve data of the objects, otherwise they are left orphaned in the file
+        datablocks = set(obj.data for obj in objects if obj.type == "CURVE" and obj.data.users == 1)
+        bpy.data.batch_remove(objects + list(datablocks))
+        removed["objects"] = len(objects)
+    
+    if len(bones) > 0 or len(bendy_bones) > 0:
+        
+        mode = arm.mode
+        mustardtools_mode_set(arm, 'EDIT')
+        
+        edit_bones = {b.name: b for b in arm.data.edit_bones}
+        
+        for bone_name in bendy_bones:
+            if bone_name in edit_bones:
+                edit_bones[bone_name].bbone_segments = 1
+        
+        for bone_name in set(bones):
+            if bone_name in edit_bones:
+                arm.data.edit_bones.remove(edit_bones[bone_name])
+                removed["bones"] += 1
+                removed["items"].append("Bone " + bone_name)
+                if settings.ms_debug:
+                    print("MustardTools - Bone " + bone_name + " removed from Armature " + arm.name)
+        
+        mustardtools_mode_set(arm, mode)
+    
+    return removed
+
+# Remove rig components and all their elements from the armature.
+# Drivers, custom properties and custom shapes, and constraints on other armatures, are removed before the other elements.
+# Returns the number of removed constraints, drivers, objects and bones, and the list of the removed items
+def mustardtools_rig_components_remove(arm, components, settings, delete_bones=True, reset_bendy=True):
+    
+    constraints = []
+    objects = []
+    bones = []
+    bendy_bones = []
+    extras = []
+    
+    for component in components:
+        for element in component.elements:
+            if element.type in ["DRIVER", "PROPERTY", "CUSTOM_SHAPE"] or (element.type == "CONSTRAINT" and element.object not in [None, arm]):
+                extras.append((element.type, element.object if element.object != None else arm, element.bone, element.name))
+            elif element.type == "CONSTRAINT":
+                constraints.append((element.bone, element.name))
+            elif element.type == "OBJECT":
+                objects.append(element.object)
+            elif element.type == "BONE" and delete_bones:
+                bones.append(element.name)
+            elif element.type == "CHAIN" and reset_bendy:
+                bendy_bones.append(element.name)
+    
+    # Remove the records before the bones, as removing bones is done in Edit mode
+    component_ids = set(component.name for component in components)
+    for index in reversed(range(len(arm.mustardtools_rig_components))):
+        if arm.mustardtools_rig_components[index].name in component_ids:
+            arm.mustardtools_rig_components.remove(index)
+    
+    drivers = 0
+    constraints_removed = 0
+    items = []
+    for type, owner, bone_name, name in extras:
+        
+        if type == "DRIVER":
+            if owner.animation_data == None:
+                continue
+            fcurve = owner.animation_data.drivers.find(name)
+            if fcurve != None:
+                owner.animation_data.drivers.remove(fcurve)
+                drivers += 1
+                items.append("Driver " + name + " of " + owner.name)
+        
+        elif type == "PROPERTY":
+            if name in owner.keys():
+                del owner[name]
+                items.append("Custom property " + name + " of " + owner.name)
+        
+        elif type == "CUSTOM_SHAPE":
+            bone = owner.pose.bones.get(name)
+            if bone != None:
+                bone.custom_shape = None
+        
+        elif type == "CONSTRAINT":
+            bone = owner.pose.bones.get(bone_name)
+            constraint = bone.constraints.get(name) if bone != None else None
+            if constraint != None:
+                bone.constraints.remove(constraint)
+                constraints_removed += 1
+                items.append("Constraint " + name + " of " + owner.name + ":" + bone_name)
+    
+    if settings.ms_debug:
+        for item in items:
+            print("MustardTools - " + item + " removed")
+    
+    removed = mustardtools_rig_remove(arm, constraints, objects, bones, bendy_bones, settings)
+    removed["drivers"] += drivers
+    removed["constraints"] += constraints_removed
+    removed["items"] = items + removed["items"]
+    
+    return removed
+
+class MUSTARDTOOLS_OT_RigComponents_Remove(bpy.types.Operator):
+    """Remove the rig component and all the elements created for it.\nA confirmation box will appear"""
+    bl_idname = "mustardui.rig_components_remove"
+    bl_label = "Remove Rig Component"
+    bl_options = {'REGISTER','UNDO'}
+    
+    remove_all: BoolProperty(name='All',
+        description="Remove all the rig components of the armature",
+        default=False
+    )
+    delete_bones: BoolProperty(name='Delete bones',
+        description="Delete controller and pole bones",
+        default=True
+    )
+    reset_bendy: BoolProperty(name='Reset Bendy Bones',
+        description="Reset bendy bones to standard bones",
+        default=True
+    )
+    
+    @classmethod
+    def poll(cls, context):
+        
+        arm = context.object
+        return arm != None and arm.type == "ARMATURE" and len(arm.mustardtools_rig_components) > 0
+    
+    def execute(self, context):
+        
+        settings = bpy.context.scene.mustardtools_settings
+        arm = context.object
+        
+        if self.remove_all:
+            components = list(arm.mustardtools_rig_components)
+        elif arm.mustardtools_rig_components_index < len(arm.mustardtools_rig_components):
+            components = [arm.mustardtools_rig_components[arm.mustardtools_rig_components_index]]
+        else:
+            self.report({'ERROR'}, 'MustardTools - No rig component selected.')
+            return {'FINISHED'}
+        
+        components_number = len(components)
+        removed = mustardtools_rig_components_remove(arm, components, settings, self.delete_bones, self.reset_bendy)
+        arm.mustardtools_rig_components_index = min(arm.mustardtools_rig_components_index, max(len(arm.mustardtools_rig_components)-1, 0))
+        
+        if settings.ms_debug:
+            print("MustardTools Rig Components - Removed " + str(removed["constraints"]) + " constraints, " + str(removed["objects"]) + " objects and " + str(removed["bones"]) + " bones")
+        
+        self.report({'INFO'}, 'MustardTools - ' + str(components_number) + ' rig components removed.')
+        
+        return {'FINISHED'}
+    
+    def invoke(self, context, event):
+        
+        return context.window_manager.invoke_props_dialog(self)
+            
+    def draw(self, context):
+        
+        layout = self.layout
+        
+        box = layout.box()
+        box.label(text="Are you sure?", icon="ERROR")
+        
+        box = layout.box()
+        box.prop(self, "delete_bones")
+        box.prop(self, "reset_bendy")
+
 # ------------------------------------------------------------------------
 #    IK Chain Tool
 # ------------------------------------------------------------------------
 
+# Switch the object to the requested mode, making it active if needed
+# Returns the number of mode switches actually performed (0 or 1)
+def mustardtools_mode_set(obj, mode):
+    
+    if bpy.context.view_layer.objects.active != obj:
+        bpy.context.view_layer.objects.active = obj
+    
+    if obj.mode == mode:
+        return 0
+    
+    bpy.ops.object.mode_set(mode=mode, toggle=False)
+    
+    return 1
+
+# Cache with the IK and Spline IK constraints of the armatures, used by the poll functions.
+# For every armature, the cache stores the bones with an IK constraint (with True if its last IK
+# constraint has a pole), and the set of the bones with a Spline IK constraint.
+# The cache of an armature is cleared every time the armature is updated in the depsgraph,
+# and the whole cache is cleared on file load, undo and redo.
+mustardtools_constraints_cache = {}
+
+def mustardtools_constraints_summary(arm):
+    
+    key = arm.as_pointer()
+    
+    summary = mustardtools_constraints_cache.get(key)
+    if summary == None:
+        
+        summary = {"IK": {}, "SPLINE_IK": set()}
+        for bone in arm.pose.bones:
+            for constraint in bone.constraints:
+                if constraint.type == 'IK':
+                    summary["IK"][bone.name] = constraint.pole_target != None and constraint.pole_subtarget != None and constraint.pole_subtarget != ""
+                elif constraint.type == 'SPLINE_IK':
+                    summary["SPLINE_IK"].add(bone.name)
+        
+        mustardtools_constraints_cache[key] = summary
+    
+    return summary
+
+@persistent
+def mustardtools_constraints_cache_update(scene, depsgraph):
+    
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Object) and update.id.type == 'ARMATURE':
+            mustardtools_constraints_cache.pop(update.id.original.as_pointer(), None)
+
+@persistent
+def mustardtools_constraints_cache_clear(dummy):
+    
+    mustardtools_constraints_cache.clear()
+
+# Find the bones of the chain of an IK constraint, walking the hierarchy from the bone with the constraint.
+# A chain count of 0 means that the chain continues up to the root bone.
+# Returns the bone names ordered from the root to the tip
+def mustardtools_ik_chain_bones(arm, bone_name, chain_count):
+    
+    chain_bones = []
+    bone = arm.data.bones.get(bone_name)
+    while bone != None and (chain_count == 0 or len(chain_bones) < chain_count):
+        chain_bones.append(bone.name)
+        bone = bone.parent
+    chain_bones.reverse()
+    
+    return chain_bones
+
+# Compute the pole of an IK chain from its bend plane, using the rest position of the bones.
+# The pole is placed in front of the joint farthest from the line between the ends of the chain, at a distance relative
+# to the chain length. Straight chains bend along the Z axis of the root bone.
+# The pole angle is the angle between the X axis of the root bone and the pole direction projected on the plane
+# perpendicular to the root bone, so that the IK keeps the rest position of the chain.
+# Returns the head and tail of the pole bone, and the pole angle in radians
+def mustardtools_ik_chain_pole(bones, chain_bones, distance):
+    
+    root = bones[chain_bones[0]]
+    root_matrix = root.matrix_local.to_3x3()
+    root_x = Vector(root_matrix.col[0])
+    root_y = root.tail_local - root.head_local
+    
+    start = root.head_local
+    axis = bones[chain_bones[-1]].tail_local - start
+    if axis.length_squared == 0.:
+        axis = root_y
+    chain_length = sum(bones[bone].length for bone in chain_bones)
+    
+    # Joint farthest from the line between the ends of the chain
+    joint, offset = start, Vector((0., 0., 0.))
+    for bone in chain_bones[1:]:
+        head = bones[bone].head_local
+        head_offset = (head - start) - axis * ((head - start).dot(axis) / axis.length_squared)
+        if head_offset.length > offset.length:
+            joint, offset = head, head_offset
+    
+    if offset.length < 1e-4 * chain_length:
+        root_z = Vector(root_matrix.col[2])
+        offset = root_z - axis * (root_z.dot(axis) / axis.length_squared)
+        joint = bones[chain_bones[len(chain_bones)//2]].head_local
+    
+    head = joint + offset.normalized() * distance * chain_length
+    tail = head + root_y * 0.5
+    
+    # Pole angle
+    pole_normal = axis.cross(head - start)
+    pole_axis = pole_normal.cross(root_y)
+    if pole_axis.length_squared == 0.:
+        return head, tail, 0.
+    angle = root_x.angle(pole_axis)
+    if root_x.cross(pole_axis).dot(root_y) > 0.:
+        angle = -angle
+    
+    return head, tail, angle
+
+# Create the IK rigs for a list of chains.
+# Each chain is a dictionary with the "bones" key, containing the bone names ordered from the root to the tip.
+# The optional keys "last_bone_use", "bendy", "bendy_segments" and "custom_shape" override the settings.
+# The optional keys "pole_bone" and "pole_angle" (in degrees) connect the IK to an already available pole bone,
+# while the optional key "pole_auto" creates a pole placed in the bend plane of the chain, with the pole angle computed automatically.
+# The optional key "mirror" overrides the Build Mirrored setting, to create the IK also on the mirrored chain.
+# All the edit bones work is done in a single Edit mode session, and all the constraints in a single Pose mode session,
+# so that the number of mode switches does not depend on the number of chains.
+def mustardtools_ik_chain_build(arm, chains, settings):
+    
+    name_prefix = settings.ms_naming_prefix
+    
+    IKChainControllerBoneName = name_prefix + ".IK.Controller"
+    IKChainConstraintName = name_prefix + " IKChain"
+    IKChainPoleBoneName = name_prefix + ".IK.Pole"
+    
+    chains = mustardtools_ik_chain_mirror(arm, chains, settings)
+    
+    # Compute the automatic poles before changing mode, using the rest position of the bones
+    poles = {}
+    for c, chain in enumerate(chains):
+        if chain.get("pole_auto", False) and chain.get("pole_bone", "") == "":
+            chain_length = len(chain["bones"]) - 1 if chain.get("last_bone_use", settings.ik_chain_last_bone_use) else len(chain["bones"])
+            poles[c] = mustardtools_ik_chain_pole(arm.data.bones, chain["bones"][:chain_length], settings.ik_chain_pole_distance)
+    
+    stats = {"chains": len(chains), "mode_switches": 0, "edit_time": 0., "pose_time": 0.}
+    
+    # Edit mode session
+    start_time = time.time()
+    stats["mode_switches"] += mustardtools_mode_set(arm, 'EDIT')
+    
+    # Index the edit bones once, instead of searching them by name for every bone
+    edit_bones = {b.name: b for b in arm.data.edit_bones}
+    
+    rigs = []
+    controllers = {}
+    for c, chain in enumerate(chains):
+        
+        chain_bones = chain["bones"]
+        chain_length = len(chain_bones)
+        last_bone_use = chain.get("last_bone_use", settings.ik_chain_last_bone_use)
+        bendy = chain.get("bendy", settings.ik_chain_bendy)
+        
+        if bendy:
+            bendy_segments = chain.get("bendy_segments", settings.ik_chain_bendy_segments)
+            for bone_name in chain_bones:
+                edit_bones[bone_name].bbone_segments = bendy_segments
+            if last_bone_use:
+                edit_bones[chain_bones[chain_length-1]].bbone_segments = 1
+            
+            arm.data.display_type = "BBONE"
+        
+        if last_bone_use:
+            
+            IK_main_bone_edit = edit_bones[chain_bones[chain_length-1]]
+            IK_main_bone_edit.parent = None
+            IK_main_bone_edit.use_deform = False
+            chain_last_bone_name = chain_bones[chain_length-2]
+            chain_length = chain_length - 1
+        
+        else:
+            
+            chain_last_bone_edit = edit_bones[chain_bones[chain_length-1]]
+            IK_main_bone_edit = arm.data.edit_bones.new(IKChainControllerBoneName)
+            IK_main_bone_edit.use_deform = False
+            if chain.get("mirror_of") in controllers:
+                # X-flip of the controller of the original chain
+                head, tail, roll = controllers[chain["mirror_of"]]
+                IK_main_bone_edit.head = (-head.x, head.y, head.z)
+                IK_main_bone_edit.tail = (-tail.x, tail.y, tail.z)
+                IK_main_bone_edit.roll = -roll
+            else:
+                IK_main_bone_edit.head = chain_last_bone_edit.tail
+                IK_main_bone_edit.tail = 2. * chain_last_bone_edit.tail - chain_last_bone_edit.head
+                controllers[c] = (IK_main_bone_edit.head.copy(), IK_main_bone_edit.tail.copy(), IK_main_bone_edit.roll)
+            chain_last_bone_name = chain_bones[chain_length-1]
+        
+        IK_pole_bone_name = ""
+        if c in poles:
+            IK_pole_bone_edit = arm.data.edit_bones.new(IKChainPoleBoneName)
+            IK_pole_bone_edit.use_deform = False
+            IK_pole_bone_edit.head = poles[c][0]
+            IK_pole_bone_edit.tail = poles[c][1]
+            IK_pole_bone_name = IK_pole_bone_edit.name
+        
+        # Save the names, as changing mode will erase the bone data
+        rigs.append((c, chain, chain_last_bone_name, IK_main_bone_edit.name, IK_pole_bone_name, chain_length, last_bone_use))
+    
+    stats["edit_time"] = time.time() - start_time
+    
+    # Pose mode session
+    start_time = time.time()
+    stats["mode_switches"] += mustardtools_mode_set(arm, 'POSE')
+    
+    for c, chain, chain_last_bone_name, IK_main_bone_name, IK_pole_bone_name, chain_length, last_bone_use in rigs:
+        
+        IK_main_bone = arm.pose.bones[IK_main_bone_name]
+        IK_main_bone.custom_shape = chain.get("custom_shape", settings.ik_chain_last_bone_custom_shape)
+        IK_main_bone.use_custom_shape_bone_size = True
+        
+        IKConstr = arm.pose.bones[chain_last_bone_name].constraints.new('IK')
+        IKConstr.name = IKChainConstraintName
+        IKConstr.use_rotation = True
+        IKConstr.target = arm
+        IKConstr.subtarget = IK_main_bone_name
+        IKConstr.chain_count = chain_length
+        
+        if chain.get("pole_bone", "") != "":
+            IKConstr.pole_target = arm
+            IKConstr.pole_subtarget = chain["pole_bone"]
+            IKConstr.pole_angle = chain.get("pole_angle", settings.ik_chain_pole_angle) * 3.141593/ 180.
+        elif IK_pole_bone_name != "":
+            IK_pole_bone = arm.pose.bones[IK_pole_bone_name]
+            IK_pole_bone.custom_shape = settings.ik_chain_pole_bone_custom_shape
+            IK_pole_bone.use_custom_shape_bone_size = True
+            IKConstr.pole_target = arm
+            IKConstr.pole_subtarget = IK_pole_bone_name
+            IKConstr.pole_angle = poles[c][2]
+        
+        # Record the component on the armature
+        component = mustardtools_rig_component_new(arm, "IK_CHAIN", chain_last_bone_name)
+        mustardtools_rig_component_add(component, "CONSTRAINT", IKConstr.name, bone=chain_last_bone_name)
+        if not last_bone_use:
+            mustardtools_rig_component_add(component, "BONE", IK_main_bone_name)
+        if IK_pole_bone_name != "":
+            mustardtools_rig_component_add(component, "BONE", IK_pole_bone_name)
+        for bone_name in chain["bones"]:
+            mustardtools_rig_component_add(component, "CHAIN", bone_name)
+    
+    stats["pose_time"] = time.time() - start_time
+    
+    if settings.ms_debug:
+        print("MustardTools IK Chain - " + str(stats["chains"]) + " chains created with " + str(stats["mode_switches"]) + " mode switches")
+        print("MustardTools IK Chain - Edit mode time: " + "{:.4f}".format(stats["edit_time"]) + " s, Pose mode time: " + "{:.4f}".format(stats["pose_time"]) + " s")
+    
+    return stats
+
+# Add the mirrored chains of the chains with the Build Mirrored option.
+# The mirrored chains have the "mirror_of" key with the index of the original chain, and the mirrored pole bone.
+# Chains whose mirror is not found, or is already in the list or has an IK constraint, are not mirrored
+def mustardtools_ik_chain_mirror(arm, chains, settings):
+    
+    mirror = [c for c, chain in enumerate(chains) if chain.get("mirror", settings.ik_chain_mirror) and "mirror_of" not in chain]
+    if len(mirror) == 0:
+        return chains
+    
+    excluded = set(bone for chain in chains for bone in chain["bones"])
+    excluded.update(mustardtools_constraints_summary(arm)["IK"].keys())
+    
+    mirrored_chains = []
+    for i, bones in mustardtools_mirror_chains(arm, [chains[c]["bones"] for c in mirror], excluded):
+        
+        chain = chains[mirror[i]]
+        mirrored_chain = dict(chain, bones=bones, mirror_of=mirror[i])
+        
+        if chain.get("pole_bone", "") != "":
+            pole_bone = mustardtools_mirror_bones(arm, [chain["pole_bone"]])
+            mirrored_chain["pole_bone"] = pole_bone[0] if pole_bone != None else ""
+        
+        mirrored_chains.append(mirrored_chain)
+    
+    if settings.ms_debug:
+        print("MustardTools IK Chain - " + str(len(mirrored_chains)) + " mirrored chains found for " + str(len(mirror)) + " chains")
+    
+    return chains + mirrored_chains
+
+# Find the bones of a chain specification.
+# The bones can be given directly with the "bones" key, or with the "root" and "tip" keys,
+# in which case the chain is found walking the hierarchy from the tip to the root.
+# Returns the bone names ordered from the root to the tip, and an error message (empty if no errors were found)
+def mustardtools_chain_bones_from_spec(arm, spec):
+    
+    bones = arm.data.bones
+    
+    if "bones" in spec:
+        if not isinstance(spec["bones"], list) or not all(isinstance(bone_name, str) for bone_name in spec["bones"]):
+            return None, "Chain with \"bones\" not defined as a list of bone names"
+        for bone_name in spec["bones"]:
+            if bones.get(bone_name) == None:
+                return None, "Bone " + bone_name + " not found"
+        return list(spec["bones"]), ""
+    
+    elif "root" in spec and "tip" in spec:
+        for key in ["root", "tip"]:
+            if not isinstance(spec[key], str):
+                return None, "Chain with \"" + key + "\" not defined as a bone name"
+            if bones.get(spec[key]) == None:
+                return None, "Bone " + spec[key] + " not found"
+        chain_bones = []
+        bone = bones.get(spec["tip"])
+        while bone != None:
+            chain_bones.append(bone.name)
+            if bone.name == spec["root"]:
+                break
+            bone = bone.parent
+        else:
+            return None, "Bone " + spec["root"] + " is not a parent of " + spec["tip"]
+        chain_bones.reverse()
+        return chain_bones, ""
+    
+    return None, "Chain without \"bones\" or \"root\" and \"tip\" definitions"
+
+# Convert a chain specification into a chain that can be used by mustardtools_ik_chain_build.
+# Custom shapes can be given as object names.
+# Returns the chain and an error message (empty if no errors were found)
+def mustardtools_ik_chain_from_spec(arm, spec, settings):
+    
+    if not isinstance(spec, dict):
+        return None, "Chain not defined as a dictionary"
+    
+    chain = dict(spec)
+    bones = arm.data.bones
+    
+    chain["bones"], error = mustardtools_chain_bones_from_spec(arm, spec)
+    if chain["bones"] == None:
+        return None, error
+    
+    if len(chain["bones"]) < 2 or (len(chain["bones"]) < 3 and chain.get("last_bone_use", settings.ik_chain_last_bone_use)):
+        return None, "Chain ending with " + chain["bones"][-1] + " is too short"
+    
+    for bone_name in chain["bones"]:
+        for constraint in arm.pose.bones[bone_name].constraints:
+            if constraint.type == 'IK':
+                return None, "Bone " + bone_name + " already has an IK constraint"
+    
+    if chain.get("pole_bone", "") != "" and bones.get(chain["pole_bone"]) == None:
+        return None, "Pole bone " + chain["pole_bone"] + " not found"
+    
+    if isinstance(chain.get("custom_shape"), str):
+        chain["custom_shape"] = bpy.data.objects.get(chain["custom_shape"])
+    
+    return chain, ""
+
+# Load a list of chain specifications from a JSON file.
+# The file can contain the list of chains, or a dictionary with the "chains" key and
+# the optional "armature" key with the name of the armature to use.
+# A ValueError is raised if the file does not have this structure
+def mustardtools_ik_chain_load_specs(filepath):
+    
+    with open(bpy.path.abspath(filepath), 'r') as f:
+        data = json.load(f)
+    
+    if isinstance(data, list):
+        return None, data
+    
+    if not isinstance(data, dict):
+        raise ValueError("a list of chains or a dictionary with the \"chains\" key is expected")
+    if not isinstance(data.get("chains", []), list):
+        raise ValueError("\"chains\" is not a list")
+    if not isinstance(data.get("armature"), (str, type(None))):
+        raise ValueError("\"armature\" is not an armature name")
+    
+    return data.get("armature"), data.get("chains", [])
+
 class MUSTARDTOOLS_OT_IKChain(bpy.types.Operator):
     """This tool will create an IK rig on the selected chain.\nSelect the bones, the last one being the tip of the chain where the controller will be placed.\n\nCondition: select at least 3 bones"""
     bl_idname = "mustardui.ik_chain"
@@ -226,83 +995,92 @@ class MUSTARDTOOLS_OT_IKChain(bpy.types.Operator):
             if len(chain_bones) < 2:
                 return False
             else:
-                abort_aa = False
-                for bone in chain_bones:
-                    for constraint in bone.constraints:
-                        if constraint.type == 'IK':
-                            abort_aa = True
-                            break
-                
-                if abort_aa:
-                    return False
-                else:
-                    return True
+                IK_bones = mustardtools_constraints_summary(context.object)["IK"]
+                return not any(bone.name in IK_bones for bone in chain_bones)
 
     def execute(self, context):
         
         # Import settings
         settings = bpy.context.scene.mustardtools_settings
-        name_prefix = settings.ms_naming_prefix
-        
-        IKChainControllerBoneName = name_prefix + ".IK.Controller"
-        IKChainConstraintName = name_prefix + " IKChain"
     
         # Definitions
         arm = bpy.context.object
         chain_bones = bpy.context.selected_pose_bones
         chain_length = len(chain_bones)
         chain_last_bone = chain_bones[chain_length-1]
-        chain_pole_bone = chain_bones[int((chain_length-1)/2)]
 
         if settings.ms_debug:
             print("MustardTools IK Chain - Armature selected: " + bpy.context.object.name)
             print("MustardTools IK Chain - Chain length: " + str(chain_length))
             print("MustardTools IK Chain - Last bone: " + chain_last_bone.name)
-            
-        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
         
-        if settings.ik_chain_bendy:
-            for bone in chain_bones:
-                arm.data.edit_bones[bone.name].bbone_segments = settings.ik_chain_bendy_segments
-            if settings.ik_chain_last_bone_use:
-                arm.data.edit_bones[chain_last_bone.name].bbone_segments = 1
-            
-            arm.data.display_type = "BBONE"
+        # Save the names, as changing mode will erase the bone data
+        chain = {"bones": [bone.name for bone in chain_bones]}
         
-        if settings.ik_chain_last_bone_use:
-            
-            IK_main_bone_edit = arm.data.edit_bones[chain_last_bone.name]
-            IK_main_bone_edit.parent = None
-            IK_main_bone_edit.use_deform = False
-            chain_last_bone = chain_bones[chain_length-2]
-            chain_length = chain_length - 1
-            IK_main_bone_name = IK_main_bone_edit.name
+        stats = mustardtools_ik_chain_build(arm, [chain], settings)
         
+        if stats["chains"] > 1:
+            self.report({'INFO'}, 'MustardTools - IK successfully added, also on the mirrored chain.')
+        elif settings.ik_chain_mirror:
+            self.report({'WARNING'}, 'MustardTools - IK successfully added, but the mirrored chain was not found.')
         else:
-            
-            chain_last_bone_edit = arm.data.edit_bones[chain_last_bone.name]
-            IK_main_bone_edit = arm.data.edit_bones.new(IKChainControllerBoneName)
-            IK_main_bone_edit.use_deform = False
-            IK_main_bone_edit.head = chain_last_bone_edit.tail
-            IK_main_bone_edit.tail = 2. * chain_last_bone_edit.tail - chain_last_bone_edit.head
-            IK_main_bone_name = IK_main_bone_edit.name
-
-        bpy.ops.object.mode_set(mode='POSE')
+            self.report({'INFO'}, 'MustardTools - IK successfully added.')
         
-        IK_main_bone = arm.pose.bones[IK_main_bone_name]
-        IK_main_bone.custom_shape = settings.ik_chain_last_bone_custom_shape
-        IK_main_bone.use_custom_shape_bone_size = True
-
-        IKConstr = chain_last_bone.constraints.new('IK')
-        IKConstr.name = IKChainConstraintName
-        IKConstr.use_rotation = True
-        IKConstr.target = arm
-        IKConstr.subtarget = IK_main_bone_name
-        IKConstr.chain_count = chain_length
+        return {'FINISHED'}
 
-        self.report({'INFO'}, 'MustardTools - IK successfully added.')
+class MUSTARDTOOLS_OT_IKChain_Batch(bpy.types.Operator):
+    """This tool will create IK rigs for all the chains defined in a JSON file.\nEach chain is defined by its root and tip bones (or by the list of its bones), and can override the IK Chain settings.\nAll the chains are created with a single Edit/Pose mode switch"""
+    bl_idname = "mustardui.ik_chain_batch"
+    bl_label = "Create from File"
+    bl_options = {'REGISTER','UNDO'}
+    
+    filepath: StringProperty(name='File',
+        description="JSON file with the chains definitions",
+        subtype='FILE_PATH'
+    )
+    filter_glob: StringProperty(default="*.json",
+        options={'HIDDEN'}
+    )
+    
+    @classmethod
+    def poll(cls, context):
+        
+        return context.mode == "POSE" and context.object != None and context.object.type == 'ARMATURE'
+    
+    def execute(self, context):
+        
+        settings = bpy.context.scene.mustardtools_settings
+        
+        try:
+            arm_name, specs = mustardtools_ik_chain_load_specs(self.filepath)
+        except (OSError, ValueError) as e:
+            self.report({'ERROR'}, 'MustardTools - Can not read the chains file: ' + str(e))
+            return {'FINISHED'}
+        
+        arm = bpy.context.object if arm_name == None else bpy.data.objects.get(arm_name)
+        if arm == None or arm.type != 'ARMATURE':
+            self.report({'ERROR'}, 'MustardTools - Armature ' + str(arm_name) + ' not found.')
+            return {'FINISHED'}
+        
+        chains = []
+        for spec in specs:
+            chain, error = mustardtools_ik_chain_from_spec(arm, spec, settings)
+            if chain == None:
+                self.report({'ERROR'}, 'MustardTools - ' + error + '. No IK has been created.')
+                return {'FINISHED'}
+            chains.append(chain)
+        
+        stats = mustardtools_ik_chain_build(arm, chains, settings)
+        
+        self.report({'INFO'}, 'MustardTools - IK successfully added to ' + str(stats["chains"]) + ' chains.')
         
         return {'FINISHED'}
+    
+    def invoke(self, context, event):
+        
+        context.window_manager.fileselect_add(self)
+        
+        return {'RUNNING_MODAL'}
 
 class MUSTARDTOOLS_OT_IKChain_Pole(bpy.types.Operator):
     """This tool will guide you in the creation of a pole for an already available IK rig.\nFor a better automatic generation, select the same chain you used to generate the IK Chain rig"""
@@ -341,17 +1119,9 @@ class MUSTARDTOOLS_OT_IKChain_Pole(bpy.types.Operator):
                     
                     chain_last_bone = chain_bones[chain_length-1]
                     
-                    abort_aa = True
-                    for constraint in chain_last_bone.constraints:
-                        if constraint.type == 'IK':
-                            abort_aa = False
-                            if constraint.pole_target != None and constraint.pole_subtarget != None and constraint.pole_subtarget != "":
-                                abort_aa = True
-                    
-                    if abort_aa:
-                        return False
-                    else:
-                        return True
+                    # The last IK constraint of the bone should not have a pole
+                    IK_bones = mustardtools_constraints_summary(context.object)["IK"]
+                    return chain_last_bone.name in IK_bones and not IK_bones[chain_last_bone.name]
                     
         else:
             
@@ -413,8 +1183,6 @@ class MUSTARDTOOLS_OT_IKChain_Pole(bpy.types.Operator):
             IK_pole_bone_edit.select_head = True
             IK_pole_bone_edit.select_tail = True
             arm.data.edit_bones.active = IK_pole_bone_edit
-                        
-            print(bpy.context.selected_editable_bones)
             
         else:
             
@@ -434,12 +1202,163 @@ class MUSTARDTOOLS_OT_IKChain_Pole(bpy.types.Operator):
             IKConstr.pole_angle = settings.ik_chain_pole_angle * 3.141593/ 180.
             
             settings.ik_chain_pole_status = False
+            
+            # Add the pole to the component of the IK chain
+            component = arm.mustardtools_rig_components.get(mustardtools_rig_component_id("IK_CHAIN", settings.ik_chain_last_bone))
+            if component != None:
+                mustardtools_rig_component_add(component, "BONE", settings.ik_chain_pole_bone)
 
             self.report({'INFO'}, 'MustardTools - IK pole successfully added.')
         
         return {'FINISHED'}
 
-class MUSTARDTOOLS_OT_IKChain_Clean(bpy.types.Operator):
+# Create the poles of the IK constraints without a pole of the bones, without user interaction.
+# The poles are placed in the bend plane of the chains and the pole angles are computed automatically,
+# with a single Edit mode session for all the pole bones and a single Pose mode session for all the constraints.
+# Returns the statistics with the number of poles and of mode switches
+def mustardtools_ik_chain_poles_build(arm, bone_names, settings):
+    
+    IKChain_Pole_Bone_Name = settings.ms_naming_prefix + ".IK.Pole"
+    
+    stats = {"poles": 0, "mode_switches": 0}
+    
+    IK_bones = mustardtools_constraints_summary(arm)["IK"]
+    
+    poles = []
+    for bone_name in bone_names:
+        
+        if bone_name not in IK_bones or IK_bones[bone_name]:
+            continue
+        
+        IKConstr = [c for c in arm.pose.bones[bone_name].constraints if c.type == 'IK'][-1]
+        chain_bones = mustardtools_ik_chain_bones(arm, bone_name, IKConstr.chain_count)
+        if len(chain_bones) < 2:
+            continue
+        
+        head, tail, angle = mustardtools_ik_chain_pole(arm.data.bones, chain_bones, settings.ik_chain_pole_distance)
+        poles.append({"bone": bone_name, "constraint": IKConstr.name, "head": head, "tail": tail, "angle": angle})
+    
+    if len(poles) == 0:
+        return stats
+    
+    # Edit mode session
+    stats["mode_switches"] += mustardtools_mode_set(arm, 'EDIT')
+    
+    for pole in poles:
+        IK_pole_bone_edit = arm.data.edit_bones.new(IKChain_Pole_Bone_Name)
+        IK_pole_bone_edit.use_deform = False
+        IK_pole_bone_edit.head = pole["head"]
+        IK_pole_bone_edit.tail = pole["tail"]
+        
+        # Save the name, as changing mode will erase the bone data
+        pole["name"] = IK_pole_bone_edit.name
+    
+    # Pose mode session
+    stats["mode_switches"] += mustardtools_mode_set(arm, 'POSE')
+    
+    for pole in poles:
+        
+        IK_pole_bone = arm.pose.bones[pole["name"]]
+        IK_pole_bone.custom_shape = settings.ik_chain_pole_bone_custom_shape
+        IK_pole_bone.use_custom_shape_bone_size = True
+        
+        IKConstr = arm.pose.bones[pole["bone"]].constraints[pole["constraint"]]
+        IKConstr.use_rotation = True
+        IKConstr.pole_target = arm
+        IKConstr.pole_subtarget = pole["name"]
+        IKConstr.pole_angle = pole["angle"]
+        
+        # Add the pole to the component of the IK chain
+        component = arm.mustardtools_rig_components.get(mustardtools_rig_component_id("IK_CHAIN", pole["bone"]))
+        if component != None:
+            mustardtools_rig_component_add(component, "BONE", pole["name"])
+        
+        if settings.ms_debug:
+            print("MustardTools IK Chain - Pole " + pole["name"] + " added to " + pole["bone"] + " with angle " + "{:.1f}".format(math.degrees(pole["angle"])))
+    
+    stats["poles"] = len(poles)
+    
+    return stats
+
+class MUSTARDTOOLS_OT_IKChain_PoleAuto(bpy.types.Operator):
+    """This tool will create the poles of the IK rigs without a pole, placing them in the bend plane of the chains.\nThe pole angles are computed automatically"""
+    bl_idname = "mustardui.ik_chainpole_auto"
+    bl_label = "Add Poles Automatically"
+    bl_options = {'REGISTER','UNDO'}
+    
+    source: EnumProperty(name='Bones',
+        items=[("SELECTED", "Selected", "Add the poles to the IK rigs of the selected bones"),
+               ("ALL", "All", "Add the poles to all the IK rigs of the armature")],
+        default="SELECTED"
+    )
+    
+    @classmethod
+    def poll(cls, context):
+        
+        settings = bpy.context.scene.mustardtools_settings
+        
+        if context.mode != "POSE" or settings.ik_chain_pole_status:
+            return False
+        
+        IK_bones = mustardtools_constraints_summary(context.object)["IK"]
+        return not all(IK_bones.values())
+    
+    def execute(self, context):
+        
+        settings = bpy.context.scene.mustardtools_settings
+        
+        arm = bpy.context.object
+        
+        if self.source == "ALL":
+            bone_names = [bone.name for bone in arm.pose.bones]
+        else:
+            bone_names = [bone.name for bone in bpy.context.selected_pose_bones]
+        
+        stats = mustardtools_ik_chain_poles_build(arm, bone_names, settings)
+        
+        if stats["poles"] == 0:
+            self.report({'WARNING'}, 'MustardTools - No IK rig without a pole found.')
+        else:
+            self.report({'INFO'}, 'MustardTools - ' + str(stats["poles"]) + ' IK poles successfully added.')
+        
+        return {'FINISHED'}
+    
+    def invoke(self, context, event):
+        
+        return context.window_manager.invoke_props_dialog(self)
+
+# Collect the IK constraints of the bones, and the controller and pole bones to remove with them.
+# The elements of recorded components are used when available, otherwise the constraint targets are followed.
+# Returns the list of (bone, constraint) names and the list of bone names
+def mustardtools_ik_chain_clean_collect(arm, bone_names):
+    
+    constraints = []
+    bones = []
+    
+    for bone_name in bone_names:
+        
+        component = arm.mustardtools_rig_components.get(mustardtools_rig_component_id("IK_CHAIN", bone_name))
+        
+        for constraint in arm.pose.bones[bone_name].constraints:
+            
+            if constraint.type != 'IK':
+                continue
+            
+            constraints.append((bone_name, constraint.name))
+            
+            if component != None and any(element.type == "CONSTRAINT" and element.name == constraint.name for element in component.elements):
+                bones.extend(element.name for element in component.elements if element.type == "BONE")
+                continue
+            
+            # Constraints not recorded in the registry (e.g. created by older versions)
+            if constraint.target == arm and constraint.subtarget != "":
+                bones.append(constraint.subtarget)
+            if constraint.pole_target == arm and constraint.pole_subtarget != "":
+                bones.append(constraint.pole_subtarget)
+    
+    return constraints, bones
+
+class MUSTARDTOOLS_OT_IKChain_Clean(bpy.types.Operator):
     """This tool will clean the available IK constraints in the selected bones.\nSelect a bone with an IK constraint to enable the tool.\nA confirmation box will appear"""
     bl_idname = "mustardui.ik_chainclean"
     bl_label = "Remove IK"
@@ -465,17 +1384,8 @@ class MUSTARDTOOLS_OT_IKChain_Clean(bpy.types.Operator):
             if len(chain_bones) < 1:
                 return False
             else:
-                abort_aa = True
-                for bone in chain_bones:
-                    for constraint in bone.constraints:
-                        if constraint.type == 'IK':
-                            abort_aa = False
-                            break
-                
-                if abort_aa:
-                    return False
-                else:
-                    return True
+                constraint_bones = mustardtools_constraints_summary(context.object)["IK"]
+                return any(bone.name in constraint_bones for bone in chain_bones)
 
     def execute(self, context):
         
@@ -484,53 +1394,26 @@ class MUSTARDTOOLS_OT_IKChain_Clean(bpy.types.Operator):
             
         # Definitions
         arm = bpy.context.object
-        chain_bones = bpy.context.selected_pose_bones
-        chain_length = len(chain_bones)
-        chain_last_bone = chain_bones[chain_length-1]
-        chain_pole_bone = chain_bones[int((chain_length-1)/2)]
-            
-        removed_constr = 0
-        removed_bones = 0
+        chain_bones = [bone.name for bone in bpy.context.selected_pose_bones]
         
-        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+        constraints, bones = mustardtools_ik_chain_clean_collect(arm, chain_bones)
+        
+        # Remove the records of the removed components
+        for component in mustardtools_rig_components_find(arm, "IK_CHAIN", chain_bones):
+            arm.mustardtools_rig_components.remove(arm.mustardtools_rig_components.find(component.name))
+        
+        removed = mustardtools_rig_remove(arm, constraints, [],
+                                          bones if self.delete_bones else [],
+                                          chain_bones if self.reset_bendy else [],
+                                          settings)
+        removed_constr = removed["constraints"]
+        removed_bones = removed["bones"]
         
         if self.reset_bendy:
-            for bone in chain_bones:
-                arm.data.edit_bones[bone.name].bbone_segments = 1
             arm.data.display_type = "OCTAHEDRAL"
             if settings.ms_debug:
                 print("MustardTools IK Chain - Bendy bones resetted")
         
-        bpy.ops.object.mode_set(mode='POSE', toggle=False)
-
-        for bone in chain_bones:
-            for constraint in bone.constraints:
-                if constraint.type == 'IK':
-                    if self.delete_bones:
-                        
-                        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
-                        
-                        if constraint.target != None and constraint.subtarget != None and constraint.subtarget != "":
-                            IKArm = constraint.target
-                            IKBone = IKArm.data.edit_bones[constraint.subtarget]
-                            IKBone_name = IKBone.name
-                            IKArm.data.edit_bones.remove(IKBone)
-                            if settings.ms_debug:
-                                print("MustardTools IK Chain - Bone " + IKBone_name + " removed from Armature " + IKArm.name)
-                            removed_bones = removed_bones + 1
-                        if constraint.pole_target != None and constraint.pole_subtarget != None and constraint.pole_subtarget != "":
-                            IKArm2 = constraint.pole_target
-                            IKBone2 = IKArm2.data.edit_bones[constraint.pole_subtarget]
-                            IKBone2_name = IKBone2.name
-                            IKArm2.data.edit_bones.remove(IKBone2)
-                            if settings.ms_debug:
-                                print("MustardTools IK Chain - Bone " + IKBone2_name + " removed from Armature " + IKArm2.name)
-                            removed_bones = removed_bones + 1
-                        
-                        bpy.ops.object.mode_set(mode='POSE')
-                    
-                    bone.constraints.remove(constraint)
-                    removed_constr = removed_constr + 1
         if self.delete_bones:
             self.report({'INFO'}, 'MustardTools - '+ str(removed_constr) +' IK constraints and '+ str(removed_bones) +' Bones successfully removed.')
         else:
@@ -570,147 +1453,259 @@ class MUSTARDTOOLS_OT_IKChain_Clean(bpy.types.Operator):
 #    IK Spline Tool
 # ------------------------------------------------------------------------
 
-class MUSTARDTOOLS_OT_IKSpline(bpy.types.Operator):
-    """This tool will create an IK spline on the selected chain.\nSelect the bones, the last one being the tip of the chain.\n\nConditions:\n    - select at least 4 bones\n    - the number of controllers should be lower than the number of bones - 1"""
-    bl_idname = "mustardui.ik_spline"
-    bl_label = "Create"
-    bl_options = {'REGISTER','UNDO'}
+# Compute the points of the IK spline curve on a chain, from the heads and tails of its bones (arrays with shape (n,3)).
+# The points are placed on the heads of bones evenly spaced in the chain, or at even distances along the chain
+# if arc_length is True. The last point is always on the head of the last bone.
+# Returns the points, and the tails of the controller bones placed on them
+def mustardtools_ik_spline_points(heads, tails, num, arc_length):
     
-    @classmethod
-    def poll(cls, context):
+    chain_length = len(heads)
+    
+    if not arc_length:
+        points_bones = [int(chain_length/(num-1)*i) for i in range(0,num-1)] + [chain_length-1]
+        return heads[points_bones], tails[points_bones]
+    
+    # Distance of each head from the root, along the chain
+    arc = np.concatenate(([0.], np.cumsum(np.linalg.norm(np.diff(heads, axis=0), axis=1))))
+    samples = np.linspace(0., arc[-1], num)
+    
+    points = np.stack([np.interp(samples, arc, heads[:,k]) for k in range(0,3)], axis=1)
+    
+    # The controller bones follow the direction of the bone they are placed on
+    points_bones = np.clip(np.searchsorted(arc, samples, side='right') - 1, 0, chain_length-1)
+    points_bones[-1] = chain_length-1
+    
+    return points, points + (tails[points_bones] - heads[points_bones])
+
+# Compute the handles of bezier points (array with shape (n,3)) as Blender does for AUTO handles.
+# Returns the left and right handles
+def mustardtools_bezier_auto_handles(points):
+    
+    # Previous and next points, extrapolated at the ends of the curve
+    prev_points = np.concatenate(([2. * points[0] - points[1]], points[:-1]))
+    next_points = np.concatenate((points[1:], [2. * points[-1] - points[-2]]))
+    
+    dvec_a = points - prev_points
+    dvec_b = next_points - points
+    len_a = np.linalg.norm(dvec_a, axis=1)
+    len_b = np.linalg.norm(dvec_b, axis=1)
+    len_a[len_a == 0.] = 1.
+    len_b[len_b == 0.] = 1.
+    
+    tvec = dvec_b / len_b[:,None] + dvec_a / len_a[:,None]
+    length = np.linalg.norm(tvec, axis=1) * 2.5614
+    length[length == 0.] = 1.
+    
+    # Avoid too different handle lengths
+    len_a = np.minimum(len_a, 5. * len_b)
+    len_b = np.minimum(len_b, 5. * len_a)
+    
+    handles_left = points - tvec * (len_a / length)[:,None]
+    handles_right = points + tvec * (len_b / length)[:,None]
+    
+    return handles_left, handles_right
+
+# Find the chains in a set of bones of an armature.
+# A chain starts on a bone whose parent is not in the set, and continues on its child as long as
+# exactly one child is in the set (on branches, every child starts a new chain).
+# Returns the chains as lists of bone names ordered from the root to the tip
+def mustardtools_find_chains(arm, bone_names):
+    
+    bone_names = set(bone_names)
+    bones = arm.data.bones
+    
+    roots = [bone for bone in bones if bone.name in bone_names and (bone.parent == None or bone.parent.name not in bone_names)]
+    
+    chains = []
+    while len(roots) > 0:
         
-        settings = bpy.context.scene.mustardtools_settings
+        bone = roots.pop(0)
+        chain = [bone.name]
         
-        if context.mode != "POSE" or bpy.context.selected_pose_bones == None:
-            return False
-        else:
-            
-            chain_bones = bpy.context.selected_pose_bones
-            
-            if settings.ik_spline_number > len(chain_bones)-1:
-                return False
-            if len(chain_bones) < 3:
-                return False
-            else:
-                abort_aa = False
-                for bone in chain_bones:
-                    for constraint in bone.constraints:
-                        if constraint.type == 'SPLINE_IK':
-                            abort_aa = True
-                            break
-                
-                if abort_aa:
-                    return False
-                else:
-                    return True
-
-    def execute(self, context):
+        while True:
+            children = [child for child in bone.children if child.name in bone_names]
+            if len(children) != 1:
+                roots += children
+                break
+            bone = children[0]
+            chain.append(bone.name)
         
-        # Import settings
-        settings = bpy.context.scene.mustardtools_settings
-        name_prefix = settings.ms_naming_prefix
-        num = settings.ik_spline_number
+        chains.append(chain)
+    
+    return chains
+
+# Create the IK spline rigs on a list of chains of bones, each one given as bone names ordered from the root to the tip.
+# The objects are linked in the collection (the collection of the current context if not specified).
+# With the Build Mirrored option, the rigs are created also on the mirrored chains, flipping the X coordinates of the curves.
+# The curves and the hooks are created with the data API (without Edit mode on the curves and hook operators),
+# and the controller bones of all the chains are created in a single Edit mode session.
+# Returns True if the location of the armature has not been applied (which might generate odd results),
+# and the statistics with the number of mode switches and the time spent on each chain
+def mustardtools_ik_spline_build(arm, chains, settings, collection=None):
+    
+    # Import settings
+    name_prefix = settings.ms_naming_prefix
+    num = settings.ik_spline_number
+    
+    # Naming convention
+    IKSpline_Curve_Name = name_prefix + ".IKSpline.Curve"
+    IKSpline_Bone_Name = name_prefix + ".IKSpline.Bone"
+    IKSpline_Hook_Modifier_Name = name_prefix + ".IKSpline.Hook"
+    IKSpline_Empty_Name = name_prefix + ".IKSpline.Empty"
+    IKSpline_Constraint_Name = name_prefix + ".IKSpline"
+    
+    # Definitions
+    if collection == None:
+        collection = bpy.context.collection
+    
+    # Add the mirrored chains, which are created in the same Edit mode session
+    mirror_of = {}
+    if settings.ik_spline_mirror:
+        excluded = mustardtools_constraints_summary(arm)["SPLINE_IK"]
+        mirrored_chains = mustardtools_mirror_chains(arm, chains, excluded)
+        for c, bones in mirrored_chains:
+            mirror_of[len(chains) + len(mirror_of)] = c
+        chains = chains + [bones for c, bones in mirrored_chains]
         
-        # Naming convention
-        IKSpline_Curve_Name = name_prefix + ".IKSpline.Curve"
-        IKSpline_Bone_Name = name_prefix + ".IKSpline.Bone"
-        IKSpline_Hook_Modifier_Name = name_prefix + ".IKSpline.Hook"
-        IKSpline_Empty_Name = name_prefix + ".IKSpline.Empty"
-        IKSpline_Constraint_Name = name_prefix + ".IKSpline"
+        if settings.ms_debug:
+            print("MustardTools IK Spline - " + str(len(mirror_of)) + " mirrored chains found")
     
-        # Definitions
-        arm = bpy.context.object
-        chain_bones = bpy.context.selected_pose_bones
-        chain_length = len(chain_bones)
-        chain_last_bone = chain_bones[chain_length-1]
+    stats = {"chains": len(chains), "chains_bones": chains, "mode_switches": 0, "chain_times": [0.] * len(chains), "time": 0.}
+    build_start_time = time.time()
+    
+    # Progress is shown for the three passes on the chains
+    wm = bpy.context.window_manager
+    wm.progress_begin(0, 3 * len(chains))
+    
+    # Output a warning if the location has not been applied to the armature
+    warning = False
+    if arm.location.x != 0. or arm.location.y != 0. or arm.location.z != 0.:
+        print("MustardTools IK Spline - Apply the location on the armature with Ctrl+A in Object mode!")
+        warning = True
+    
+    if settings.ms_debug:
+        print("MustardTools IK Spline - Armature selected: " + arm.name)
+        print("MustardTools IK Spline - Chains: " + str(len(chains)))
+    
+    # Fetch heads and tails of all the bones at once, as changing mode will erase the bone data
+    bones_index = {bone.name: i for i, bone in enumerate(arm.pose.bones)}
+    all_heads = np.empty(len(bones_index) * 3, dtype=np.float32)
+    all_tails = np.empty(len(bones_index) * 3, dtype=np.float32)
+    arm.pose.bones.foreach_get("head", all_heads)
+    arm.pose.bones.foreach_get("tail", all_tails)
+    all_heads = all_heads.reshape(-1, 3)
+    all_tails = all_tails.reshape(-1, 3)
+    
+    # First pass: create the curves
+    rigs = []
+    for c, chain_bones in enumerate(chains):
         
-        # Output a warning if the location has not been applied to the armature
-        warning = 0
-        if arm.location.x != 0. or arm.location.y != 0. or arm.location.z != 0.:
-            self.report({'WARNING'}, 'MustardTools - The Armature selected seems not to have location applied. This might generate odd results!')
-            print("MustardTools IK Spline - Apply the location on the armature with Ctrl+A in Object mode!")
-            warning += 1
+        start_time = time.time()
+        
+        chain_length = len(chain_bones)
+        chain_index = [bones_index[bone] for bone in chain_bones]
+        heads = all_heads[chain_index]
+        tails = all_tails[chain_index]
         
         if settings.ms_debug:
-            print("MustardTools IK Spline - Armature selected: " + bpy.context.object.name)
             print("MustardTools IK Spline - Chain length: " + str(chain_length))
         
-        # Create the curve in Object mode
-        bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
-        
         curveData = bpy.data.curves.new(IKSpline_Curve_Name, type='CURVE')
         curveData.dimensions = '3D'
         curveData.use_path = True
-        
-        # Create the path for the curve in Edit mode
-        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+        curveData.resolution_u = settings.ik_spline_resolution
         
         polyline = curveData.splines.new('BEZIER')
         polyline.bezier_points.add(num-1)
         
-        # Fill the curve with the points, and also create controller bones
-        b = []
-        b_name = []
-        
-        for i in range(0,num-1):
-            # Create the point to insert in the curve, at the head of the bone
-            (x,y,z) = (chain_bones[int(chain_length/(num-1)*i)].head.x,
-                        chain_bones[int(chain_length/(num-1)*i)].head.y,
-                        chain_bones[int(chain_length/(num-1)*i)].head.z)
-            polyline.bezier_points[i].co = (x, y, z)
-            # Use AUTO to generate handles (should be changed later to ALIGNED to enable rotations)
-            polyline.bezier_points[i].handle_right_type = 'AUTO'
-            polyline.bezier_points[i].handle_left_type = 'AUTO'
-            
-            # Create the controller bone
+        if c in mirror_of:
+            
+            # X-flip of the curve of the original chain
+            flip = np.array([-1., 1., 1.])
+            rig = rigs[mirror_of[c]]
+            points, points_tails = rig["points"] * flip, rig["points_tails"] * flip
+            handles_left, handles_right = rig["handles_left"] * flip, rig["handles_right"] * flip
+        
+        else:
+            
+            # Points of the curve (where the controller bones are placed)
+            points, points_tails = mustardtools_ik_spline_points(heads, tails, num, settings.ik_spline_arc_length)
+            handles_left, handles_right = mustardtools_bezier_auto_handles(points)
+            
+            # The handles of the last point are aligned with the last bone
+            handles_right[num-1] = heads[chain_length-1] + (heads[chain_length-1] - heads[chain_length-2])/2
+            handles_left[num-1] = heads[chain_length-2] + (heads[chain_length-1] - heads[chain_length-2])/2
+        
+        # Set the handle types first, as changing them recomputes the handles
+        # ALIGNED handles are used to enable rotations
+        for point in polyline.bezier_points:
+            point.handle_right_type = 'ALIGNED'
+            point.handle_left_type = 'ALIGNED'
+        
+        polyline.bezier_points.foreach_set("co", points.astype(np.float32).ravel())
+        polyline.bezier_points.foreach_set("handle_left", handles_left.astype(np.float32).ravel())
+        polyline.bezier_points.foreach_set("handle_right", handles_right.astype(np.float32).ravel())
+        curveData.update_tag()
+        
+        rigs.append({"bones": chain_bones, "points": points, "points_tails": points_tails,
+                     "handles_left": handles_left, "handles_right": handles_right,
+                     "curve": curveData, "b_name": [], "b_matrix": []})
+        
+        stats["chain_times"][c] += time.time() - start_time
+        wm.progress_update(c)
+    
+    # Second pass: create the controller bones of all the chains in Edit mode
+    stats["mode_switches"] += mustardtools_mode_set(arm, 'EDIT')
+    
+    # Index the edit bones once, instead of searching them by name for every bone
+    edit_bones = {b.name: b for b in arm.data.edit_bones}
+    
+    for c, rig in enumerate(rigs):
+        
+        start_time = time.time()
+        
+        for i in range(0,num):
+            
             b = arm.data.edit_bones.new(IKSpline_Bone_Name)
             b.use_deform = False
-            b.head = chain_bones[int(chain_length/(num-1)*i)].head
-            b.tail = chain_bones[int(chain_length/(num-1)*i)].tail
+            b.head = rig["points"][i]
+            b.tail = rig["points_tails"][i]
             
-            # Save the name, as changing context will erase the bone data
-            b_name.append(b.name)
+            # Save the name and the matrix, as changing mode will erase the bone data
+            rig["b_name"].append(b.name)
+            rig["b_matrix"].append(b.matrix.copy())
             
             if settings.ms_debug:
-                print("MustardTools IK Spline - Bone created with head: " + str(b[i].head.x) + " , " + str(b[i].head.y) + " , " + str(b[i].head.z))
-                print("                                       and tail: " + str(b[i].tail.x) + " , " + str(b[i].tail.y) + " , " + str(b[i].tail.z))
-        
-        # The same as above, but for the last bone
-        i += 1
-        (x,y,z) = (chain_bones[chain_length-1].head.x,chain_bones[chain_length-1].head.y,chain_bones[chain_length-1].head.z)
-        (x2,y2,z2) = (chain_bones[chain_length-2].head.x,chain_bones[chain_length-2].head.y,chain_bones[chain_length-2].head.z)
-        polyline.bezier_points[i].co = (x, y, z)
-        polyline.bezier_points[i].handle_right = ( x+(x-x2)/2 , y+(y-y2)/2, z+(z-z2)/2)
-        polyline.bezier_points[i].handle_left = (x2+(x-x2)/2, y2+(y-y2)/2, z2+(z-z2)/2)
-        polyline.bezier_points[i].handle_right_type = 'ALIGNED'
-        polyline.bezier_points[i].handle_left_type = 'ALIGNED'
-        
-        b = arm.data.edit_bones.new(IKSpline_Bone_Name)
-        b.use_deform = False
-        b.head = chain_bones[chain_length-1].head
-        b.tail = chain_bones[chain_length-1].tail
-        b_name.append(b.name)
-        
-        if settings.ms_debug:
-            print("MustardTools IK Spline - Bone created with head: " + str(b[i].head.x) + " , " + str(b[i].head.y) + " , " + str(b[i].head.z))
-            print("                                       and tail: " + str(b[i].tail.x) + " , " + str(b[i].tail.y) + " , " + str(b[i].tail.z))
+                print("MustardTools IK Spline - Bone created with head: " + str(b.head.x) + " , " + str(b.head.y) + " , " + str(b.head.z))
+                print("                                       and tail: " + str(b.tail.x) + " , " + str(b.tail.y) + " , " + str(b.tail.z))
         
         # Enable bendy bones if the option has been selected
         if settings.ik_spline_bendy:
-            for bone in chain_bones:
-                arm.data.edit_bones[bone.name].bbone_segments = settings.ik_spline_bendy_segments
+            for bone in rig["bones"]:
+                edit_bones[bone].bbone_segments = settings.ik_spline_bendy_segments
             
             # Switch to B-Bone view for the Armature bones
             arm.data.display_type = "BBONE"
         
-        # GO back to Object mode
-        bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
+        stats["chain_times"][c] += time.time() - start_time
+        wm.progress_update(len(chains) + c)
+    
+    # Go back to Pose mode
+    stats["mode_switches"] += mustardtools_mode_set(arm, 'POSE')
+    
+    # Third pass: create empties, curve objects, hooks and constraints
+    for c, rig in enumerate(rigs):
+        
+        start_time = time.time()
+        
+        b_name = rig["b_name"]
+        points = rig["points"]
         
         # Create empties
         e = []
         for i in range(0,num):
             e.append( bpy.data.objects.new(IKSpline_Empty_Name, None) )
-            e[i].location=curveData.splines[0].bezier_points[i].co
+            e[i].location=points[i]
             constraint=e[i].constraints.new('COPY_TRANSFORMS')
             constraint.target = arm
             constraint.subtarget = b_name[i]
@@ -718,12 +1713,12 @@ class MUSTARDTOOLS_OT_IKSpline(bpy.types.Operator):
                 e[i].empty_display_type="SPHERE"
             else:
                 e[i].empty_display_type="CIRCLE"
-            bpy.context.collection.objects.link(e[i])
+            collection.objects.link(e[i])
             e[i].hide_render = True
             e[i].hide_viewport = True
             if settings.ms_debug:
                 print("MustardTools IK Spline - Empty created at: " + str(e[i].location.x) + " , " + str(e[i].location.y) + " , " + str(e[i].location.z))
-            
+        
         # Set bones custom shape if selected in the options, else use the Empty default shapes
         if settings.ik_spline_first_bone_custom_shape != None:
             bone = arm.pose.bones[b_name[0]]
@@ -745,185 +1740,284 @@ class MUSTARDTOOLS_OT_IKSpline(bpy.types.Operator):
                 bone.custom_shape = e[i]
                 bone.use_custom_shape_bone_size = True
         
-        # Create curve object
-        curveOB = bpy.data.objects.new(IKSpline_Curve_Name, curveData)
-        
-        # Create hook modifiers
-        m = []
-        for i in range(0,num):
-            m.append( curveOB.modifiers.new(IKSpline_Hook_Modifier_Name, 'HOOK') )
-            m[i].object = e[i]
-        
-        # Link the curve in the scene and use as active object
-        bpy.context.collection.objects.link(curveOB)
-        context.view_layer.objects.active = curveOB
+        # Create curve object and link it in the scene
+        curveOB = bpy.data.objects.new(IKSpline_Curve_Name, rig["curve"])
+        collection.objects.link(curveOB)
         
-        # Go in Edit mode
-        bpy.ops.object.editmode_toggle()
-        
-        # Hook the curve points to the empties
+        # Create hook modifiers, and hook the curve points to the empties
         for i in range(0,num):
             
-            select_index = i
-            for j, point in enumerate(curveData.splines[0].bezier_points) :
-                point.select_left_handle = j == select_index
-                point.select_right_handle = j == select_index
-                point.select_control_point = j == select_index
+            hook = curveOB.modifiers.new(IKSpline_Hook_Modifier_Name, 'HOOK')
+            hook.object = e[i]
             
-            bpy.ops.object.hook_assign(modifier=m[i].name)
-            bpy.ops.object.hook_reset(modifier=m[i].name)
+            # Every bezier point has 3 vertices: left handle, control point and right handle
+            hook.vertex_indices_set([3*i, 3*i+1, 3*i+2])
+            hook.center = points[i]
             
-            # Change the handle type to ALIGNED to enable rotations
-            curveData.splines[0].bezier_points[i].handle_right_type = 'ALIGNED'
-            curveData.splines[0].bezier_points[i].handle_left_type = 'ALIGNED'
-        
-        bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
+            # Same as the hook Reset, using the matrix the empty gets from the controller bone in rest position
+            hook.matrix_inverse = (arm.matrix_world @ rig["b_matrix"][i]).inverted() @ curveOB.matrix_world
         
         # Create Spline IK modifier
-        IKSplineConstr = chain_last_bone.constraints.new('SPLINE_IK')
+        IKSplineConstr = arm.pose.bones[rig["bones"][-1]].constraints.new('SPLINE_IK')
         IKSplineConstr.name = IKSpline_Constraint_Name
         IKSplineConstr.target = curveOB
-        IKSplineConstr.chain_count = chain_length
+        IKSplineConstr.chain_count = len(rig["bones"])
         IKSplineConstr.y_scale_mode = "BONE_ORIGINAL"
         IKSplineConstr.xz_scale_mode = "BONE_ORIGINAL"
         
-        # Final settings cleanup
-        curveData.resolution_u = settings.ik_spline_resolution
-        
-        # Go back to pose mode
-        context.view_layer.objects.active = arm
-        bpy.ops.object.mode_set(mode='POSE')
-        
-        # Final messag, if no warning were raised during the execution
-        if warning == 0:
-            self.report({'INFO'}, 'MustardTools - IK spline rig successfully created.')
+        # Record the component on the armature
+        component = mustardtools_rig_component_new(arm, "IK_SPLINE", rig["bones"][-1])
+        mustardtools_rig_component_add(component, "CONSTRAINT", IKSplineConstr.name, bone=rig["bones"][-1])
+        mustardtools_rig_component_add(component, "OBJECT", curveOB.name, object=curveOB)
+        for i in range(0,num):
+            mustardtools_rig_component_add(component, "BONE", b_name[i])
+            mustardtools_rig_component_add(component, "OBJECT", e[i].name, object=e[i])
+        for bone_name in rig["bones"]:
+            mustardtools_rig_component_add(component, "CHAIN", bone_name)
         
-        return {'FINISHED'}
+        stats["chain_times"][c] += time.time() - start_time
+        wm.progress_update(2 * len(chains) + c)
     
-class MUSTARDTOOLS_OT_IKSpline_Clean(bpy.types.Operator):
-    """This tool will remove the IK spline.\nSelect a bone with an IK constraint to enable the tool.\nA confirmation box will appear"""
-    bl_idname = "mustardui.ik_splineclean"
-    bl_label = "Clean"
-    bl_options = {'REGISTER','UNDO'}
+    wm.progress_end()
     
-    delete_bones: BoolProperty(name='Delete bones',
-        description="Delete controller and pole bones",
-        default=True
-    )
-    reset_bendy: BoolProperty(name='Reset Bendy Bones',
-        description="Reset bendy bones to standard bones",
-        default=True
-    )
+    stats["time"] = time.time() - build_start_time
+    
+    if settings.ms_debug:
+        print("MustardTools IK Spline - " + str(stats["chains"]) + " chains created with " + str(stats["mode_switches"]) + " mode switches in " + "{:.4f}".format(stats["time"]) + " s")
+    
+    return warning, stats
+
+class MUSTARDTOOLS_OT_IKSpline(bpy.types.Operator):
+    """This tool will create an IK spline on the selected chain.\nSelect the bones, the last one being the tip of the chain.\n\nConditions:\n    - select at least 4 bones\n    - the number of controllers should be lower than the number of bones - 1"""
+    bl_idname = "mustardui.ik_spline"
+    bl_label = "Create"
+    bl_options = {'REGISTER','UNDO'}
     
     @classmethod
     def poll(cls, context):
+        
+        settings = bpy.context.scene.mustardtools_settings
+        
         if context.mode != "POSE" or bpy.context.selected_pose_bones == None:
             return False
         else:
             
             chain_bones = bpy.context.selected_pose_bones
             
-            if len(chain_bones) < 1:
+            if settings.ik_spline_number > len(chain_bones)-1:
+                return False
+            if len(chain_bones) < 3:
                 return False
             else:
-                abort_aa = True
-                for bone in chain_bones:
-                    for constraint in bone.constraints:
-                        if constraint.type == 'SPLINE_IK':
-                            abort_aa = False
-                            break
-                
-                if abort_aa:
-                    return False
-                else:
-                    return True
+                spline_bones = mustardtools_constraints_summary(context.object)["SPLINE_IK"]
+                return not any(bone.name in spline_bones for bone in chain_bones)
 
     def execute(self, context):
         
+        # Import settings
         settings = bpy.context.scene.mustardtools_settings
         
+        # Definitions
         arm = bpy.context.object
-        chain_bones = bpy.context.selected_pose_bones
+        chain_bones = [bone.name for bone in bpy.context.selected_pose_bones]
         
-        e = []
+        warning, stats = mustardtools_ik_spline_build(arm, [chain_bones], settings)
+        
+        # Output a warning if the location has not been applied to the armature
+        if warning:
+            self.report({'WARNING'}, 'MustardTools - The Armature selected seems not to have location applied. This might generate odd results!')
+        elif settings.ik_spline_mirror and stats["chains"] == 1:
+            self.report({'WARNING'}, 'MustardTools - IK spline rig successfully created, but the mirrored chain was not found.')
+        # Final messag, if no warning were raised during the execution
+        else:
+            self.report({'INFO'}, 'MustardTools - IK spline rig successfully created.')
+        
+        return {'FINISHED'}
+    
+class MUSTARDTOOLS_OT_IKSpline_Batch(bpy.types.Operator):
+    """This tool will create an IK spline on every chain found in the selected bones (or in the children of the active bone).\nChains are separated where bones are not connected by a parent relation, or where the hierarchy branches.\nChains too short for the number of controllers are skipped"""
+    bl_idname = "mustardui.ik_spline_batch"
+    bl_label = "Create on all Chains"
+    bl_options = {'REGISTER','UNDO'}
+    
+    source: EnumProperty(name='Bones',
+        items=[("SELECTED", "Selected", "Find the chains in the selected bones"),
+               ("CHILDREN", "Children of Active", "Find the chains in all the children of the active bone")],
+        default="SELECTED"
+    )
+    
+    @classmethod
+    def poll(cls, context):
         
-        removed_constr = 0
-        removed_bones = 0
+        if context.mode != "POSE" or bpy.context.selected_pose_bones == None:
+            return False
         
-        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+        return len(bpy.context.selected_pose_bones) > 0
+    
+    def execute(self, context):
         
-        if self.reset_bendy:
-            for bone in chain_bones:
-                arm.data.edit_bones[bone.name].bbone_segments = 1
-            arm.data.display_type = "OCTAHEDRAL"
-            if settings.ms_debug:
-                print("MustardTools IK Spline - Bendy bones resetted")
+        settings = bpy.context.scene.mustardtools_settings
+        num = settings.ik_spline_number
         
-        bpy.ops.object.mode_set(mode='POSE', toggle=False)
-
-        for bone in chain_bones:
-            for constraint in bone.constraints:
-                if constraint.type == 'SPLINE_IK':
-                    
-                        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
-                        
-                        if constraint.target != None:
-                            IKCurve = constraint.target
-                            for hook_mod in IKCurve.modifiers:
-                                if hook_mod.object != None:
-                                    
-                                    IKEmpty = hook_mod.object
-                                    e.append(IKEmpty.name)
-                                    
-                                    if self.delete_bones:
-                                        for e_constraint in IKEmpty.constraints:
-                                            if e_constraint.type=="COPY_TRANSFORMS":
-                                                if e_constraint.target != None and e_constraint.subtarget != None and e_constraint.subtarget != "":
-                                                    IKArm = e_constraint.target
-                                                    IKBone = IKArm.data.edit_bones[e_constraint.subtarget]
-                                                    IKBone_name = IKBone.name
-                                                    IKArm.data.edit_bones.remove(IKBone)
-                                                    if settings.ms_debug:
-                                                        print("MustardTools IK Spline - Bone " + IKBone_name + " removed from Armature " + IKArm.name)
-                                                    removed_bones = removed_bones + 1
-                                    
-                        bpy.ops.object.mode_set(mode='OBJECT')
-                        bpy.ops.object.select_all(action='DESELECT')
-                        for empty_name in e:
-                            empty = bpy.data.objects[empty_name]
-                            bpy.context.collection.objects.unlink(empty)
-                            bpy.data.objects.remove(empty)
-                    
-                        bpy.ops.object.select_all(action='DESELECT')
-                        IKCurve = constraint.target
-                        IKCurve_name = IKCurve.name
-                        bpy.context.collection.objects.unlink(IKCurve)
-                        bpy.data.objects.remove(IKCurve)
-                        if settings.ms_debug:
-                            print("MustardTools IK Spline - Curve " + IKCurve_name + " removed.")
-                        
-                        bpy.ops.object.mode_set(mode='POSE')
-                    
-                        IKConstr_name = constraint.name
-                        bone.constraints.remove(constraint)
-                        removed_constr = removed_constr + 1
-                        if settings.ms_debug:
-                            print("MustardTools IK Spline - Constraint " + IKConstr_name + " removed from " + bone.name + ".")
+        arm = bpy.context.object
         
-        if self.delete_bones:
-            self.report({'INFO'}, 'MustardTools - '+ str(removed_constr) +' IK constraints and '+ str(removed_bones) +' Bones successfully removed.')
+        if self.source == "CHILDREN":
+            if bpy.context.active_pose_bone == None:
+                self.report({'ERROR'}, 'MustardTools - No active bone.')
+                return {'FINISHED'}
+            bone_names = [bone.name for bone in bpy.context.active_pose_bone.bone.children_recursive]
         else:
-            self.report({'INFO'}, 'MustardTools - '+ str(removed_constr) +' IK constraints successfully removed.')
+            bone_names = [bone.name for bone in bpy.context.selected_pose_bones]
         
-        return {'FINISHED'}
-    
-    def invoke(self, context, event):
+        chains = []
+        skipped = 0
+        for chain in mustardtools_find_chains(arm, bone_names):
+            if len(chain) < 3 or num > len(chain)-1 or any(c.type == 'SPLINE_IK' for bone in chain for c in arm.pose.bones[bone].constraints):
+                skipped += 1
+                continue
+            chains.append(chain)
         
-        return context.window_manager.invoke_props_dialog(self)
-            
-    def draw(self, context):
+        if len(chains) == 0:
+            self.report({'ERROR'}, 'MustardTools - No chain long enough for ' + str(num) + ' controllers found.')
+            return {'FINISHED'}
         
-        layout = self.layout
+        # Link all the objects in a new collection, which is linked to the scene only at the end
+        collection = bpy.data.collections.new(settings.ms_naming_prefix + ".IKSpline")
+        
+        warning, stats = mustardtools_ik_spline_build(arm, chains, settings, collection=collection)
+        
+        bpy.context.collection.children.link(collection)
+        
+        # Timing summary
+        for chain, chain_time in zip(stats["chains_bones"], stats["chain_times"]):
+            print("MustardTools IK Spline - " + chain[0] + " -> " + chain[-1] + " (" + str(len(chain)) + " bones): " + "{:.2f}".format(chain_time * 1000.) + " ms")
+        print("MustardTools IK Spline - " + str(stats["chains"]) + " chains created in " + "{:.4f}".format(stats["time"]) + " s, with " + str(stats["mode_switches"]) + " mode switches")
+        
+        if warning:
+            self.report({'WARNING'}, 'MustardTools - The Armature selected seems not to have location applied. This might generate odd results!')
+        else:
+            self.report({'INFO'}, 'MustardTools - ' + str(stats["chains"]) + ' IK spline rigs created in ' + "{:.2f}".format(stats["time"]) + ' s (' + str(skipped) + ' chains skipped).')
+        
+        return {'FINISHED'}
+    
+    def invoke(self, context, event):
+        
+        return context.window_manager.invoke_props_dialog(self)
+    
+# Collect the Spline IK constraints of the bones, with the curves, empties and controller bones to remove with them.
+# The elements of recorded components are used when available, otherwise the curve hooks are followed.
+# Returns the list of (bone, constraint) names, the list of objects and the list of bone names
+def mustardtools_ik_spline_clean_collect(arm, bone_names):
+    
+    constraints = []
+    objects = []
+    bones = []
+    
+    for bone_name in bone_names:
+        
+        component = arm.mustardtools_rig_components.get(mustardtools_rig_component_id("IK_SPLINE", bone_name))
+        
+        for constraint in arm.pose.bones[bone_name].constraints:
+            
+            if constraint.type != 'SPLINE_IK':
+                continue
+            
+            constraints.append((bone_name, constraint.name))
+            
+            if component != None and any(element.type == "CONSTRAINT" and element.name == constraint.name for element in component.elements):
+                objects.extend(element.object for element in component.elements if element.type == "OBJECT")
+                bones.extend(element.name for element in component.elements if element.type == "BONE")
+                continue
+            
+            # Constraints not recorded in the registry (e.g. created by older versions)
+            if constraint.target == None:
+                continue
+            objects.append(constraint.target)
+            for hook_mod in constraint.target.modifiers:
+                if hook_mod.type != 'HOOK' or hook_mod.object == None:
+                    continue
+                objects.append(hook_mod.object)
+                for e_constraint in hook_mod.object.constraints:
+                    if e_constraint.type == "COPY_TRANSFORMS" and e_constraint.target == arm and e_constraint.subtarget != "":
+                        bones.append(e_constraint.subtarget)
+    
+    return constraints, objects, bones
+
+class MUSTARDTOOLS_OT_IKSpline_Clean(bpy.types.Operator):
+    """This tool will remove the IK spline.\nSelect a bone with an IK constraint to enable the tool.\nA confirmation box will appear"""
+    bl_idname = "mustardui.ik_splineclean"
+    bl_label = "Clean"
+    bl_options = {'REGISTER','UNDO'}
+    
+    delete_bones: BoolProperty(name='Delete bones',
+        description="Delete controller and pole bones",
+        default=True
+    )
+    reset_bendy: BoolProperty(name='Reset Bendy Bones',
+        description="Reset bendy bones to standard bones",
+        default=True
+    )
+    
+    @classmethod
+    def poll(cls, context):
+        if context.mode != "POSE" or bpy.context.selected_pose_bones == None:
+            return False
+        else:
+            
+            chain_bones = bpy.context.selected_pose_bones
+            
+            if len(chain_bones) < 1:
+                return False
+            else:
+                constraint_bones = mustardtools_constraints_summary(context.object)["SPLINE_IK"]
+                return any(bone.name in constraint_bones for bone in chain_bones)
+
+    def execute(self, context):
+        
+        settings = bpy.context.scene.mustardtools_settings
+        
+        arm = bpy.context.object
+        chain_bones = [bone.name for bone in bpy.context.selected_pose_bones]
+        
+        constraints, objects, bones = mustardtools_ik_spline_clean_collect(arm, chain_bones)
+        
+        # Remove the records of the removed components
+        for component in mustardtools_rig_components_find(arm, "IK_SPLINE", chain_bones):
+            arm.mustardtools_rig_components.remove(arm.mustardtools_rig_components.find(component.name))
+        
+        removed = mustardtools_rig_remove(arm, constraints, objects,
+                                          bones if self.delete_bones else [],
+                                          chain_bones if self.reset_bendy else [],
+                                          settings)
+        removed_constr = removed["constraints"]
+        removed_bones = removed["bones"]
+        
+        # Remove the curve datablocks leaked by the previous versions of the cleanup
+        orphan_curves = [curve for curve in bpy.data.curves if curve.users == 0 and curve.name.startswith(settings.ms_naming_prefix + ".IKSpline.Curve")]
+        if len(orphan_curves) > 0:
+            bpy.data.batch_remove(orphan_curves)
+            if settings.ms_debug:
+                print("MustardTools IK Spline - " + str(len(orphan_curves)) + " orphaned curves removed")
+        
+        if self.reset_bendy:
+            arm.data.display_type = "OCTAHEDRAL"
+            if settings.ms_debug:
+                print("MustardTools IK Spline - Bendy bones resetted")
+        
+        if self.delete_bones:
+            self.report({'INFO'}, 'MustardTools - '+ str(removed_constr) +' IK constraints and '+ str(removed_bones) +' Bones successfully removed.')
+        else:
+            self.report({'INFO'}, 'MustardTools - '+ str(removed_constr) +' IK constraints successfully removed.')
+        
+        return {'FINISHED'}
+    
+    def invoke(self, context, event):
+        
+        return context.window_manager.invoke_props_dialog(self)
+            
+    def draw(self, context):
+        
+        layout = self.layout
         
         chain_bones = bpy.context.selected_pose_bones
         
@@ -944,44 +2038,544 @@ class MUSTARDTOOLS_OT_IKSpline_Clean(bpy.types.Operator):
         box.label(text="        - " + str(IK_num) + " Spline IK constraints.")
         box.label(text="        - " + str(IK_num_nMUI) + " of which are not Mustard Tools generated.")
 
+# ------------------------------------------------------------------------
+#    Mirror
+# ------------------------------------------------------------------------
+
+mustardtools_mirror_sides = {"L": "R", "R": "L", "l": "r", "r": "l",
+                             "Left": "Right", "Right": "Left", "left": "right", "right": "left", "LEFT": "RIGHT", "RIGHT": "LEFT"}
+
+# Patterns of the side in the bone names, in order of priority:
+# side suffix (Lip.L, lip_l_01, Lip.L.001), side word suffix (LipLeft), side prefix (L_Lip, Left.Lip),
+# side prefix in camel case (lLipCorner, mixamorig:LeftHand), and the last character as fallback (Lipl)
+mustardtools_mirror_patterns = [re.compile(pattern) for pattern in [
+    r"^(?P<a>.+?[._\- ])(?P<side>L|R|l|r|Left|Right|left|right|LEFT|RIGHT)(?P<b>(?:[._]?\d+)?)$",
+    r"^(?P<a>.*[a-z0-9])(?P<side>Left|Right)(?P<b>(?:[._]?\d+)?)$",
+    r"^(?P<a>(?:.*:)?)(?P<side>L|R|l|r|Left|Right|left|right|LEFT|RIGHT)(?P<b>[._\- ].+)$",
+    r"^(?P<a>(?:.*:)?)(?P<side>l|r|Left|Right|left|right)(?P<b>[A-Z].*)$",
+    r"^(?P<a>.+)(?P<side>L|R|l|r)(?P<b>)$",
+]]
+
+# Find the mirrored name of a bone.
+# Returns None if the name is not using any of the known conventions
+def mustardtools_mirror_name(name):
+    
+    for pattern in mustardtools_mirror_patterns:
+        match = pattern.match(name)
+        if match != None:
+            return match.group("a") + mustardtools_mirror_sides[match.group("side")] + match.group("b")
+    
+    return None
+
+# Cache with the mirror maps of the armatures, used to find the mirrored bones without parsing the names every time.
+# The map of an armature is built again when its bones are added, removed or renamed
+mustardtools_mirror_cache = {}
+
+# Find the mirror map of an armature, with the left bones mapped to the right ones and vice versa.
+# Only the bones whose mirrored bone is in the armature are in the map
+def mustardtools_mirror_map(armature):
+    
+    key = armature.data.as_pointer()
+    names = tuple(armature.data.bones.keys())
+    
+    cached = mustardtools_mirror_cache.get(key)
+    if cached != None and cached[0] == names:
+        return cached[1]
+    
+    names_set = set(names)
+    mirror_map = {}
+    for name in names:
+        if name in mirror_map:
+            continue
+        mirror = mustardtools_mirror_name(name)
+        if mirror != None and mirror != name and mirror in names_set:
+            mirror_map[name] = mirror
+            mirror_map.setdefault(mirror, name)
+    
+    mustardtools_mirror_cache[key] = (names, mirror_map)
+    
+    return mirror_map
+
+# Find the mirrored bones of a list of bones of an armature.
+# The mirror map is used first, then the bone whose head and tail are the closest to the X-flipped ones
+# (within the tolerance, relative to the length of the bone) for bones not using any naming convention.
+# Returns None if a bone can not be mirrored, or if it is its own mirror (a bone in the center of the armature)
+def mustardtools_mirror_bones(armature, bone_names, tolerance=0.05):
+    
+    mirror_map = mustardtools_mirror_map(armature)
+    bones = armature.data.bones
+    
+    heads = None
+    mirrored = []
+    for name in bone_names:
+        
+        mirror = mirror_map.get(name)
+        
+        if mirror == None:
+            
+            # Fetch heads and tails of all the bones at once, only if needed
+            if heads is None:
+                flip = np.array([-1., 1., 1.], dtype=np.float32)
+                heads = np.empty(len(bones) * 3, dtype=np.float32)
+                tails = np.empty(len(bones) * 3, dtype=np.float32)
+                bones.foreach_get("head_local", heads)
+                bones.foreach_get("tail_local", tails)
+                heads = heads.reshape(-1, 3)
+                tails = tails.reshape(-1, 3)
+            
+            i = bones.find(name)
+            distances = np.linalg.norm(heads - heads[i] * flip, axis=1) + np.linalg.norm(tails - tails[i] * flip, axis=1)
+            j = int(np.argmin(distances))
+            if j == i or distances[j] > tolerance * max(bones[i].length, 1e-4):
+                return None
+            mirror = bones[j].name
+        
+        mirrored.append(mirror)
+    
+    return mirrored
+
+# Find the mirrored chains of a list of chains of an armature, each one given as bone names.
+# Chains that can not be mirrored, or whose mirrored bones are in other chains or in the excluded bones, are skipped.
+# Returns the list of the index of the chain and its mirrored bones
+def mustardtools_mirror_chains(armature, chains, excluded=set()):
+    
+    used = set(excluded)
+    for chain in chains:
+        used.update(chain)
+    
+    mirrored_chains = []
+    for c, chain in enumerate(chains):
+        
+        mirrored = mustardtools_mirror_bones(armature, chain)
+        if mirrored == None or any(bone in used for bone in mirrored):
+            continue
+        
+        used.update(mirrored)
+        mirrored_chains.append((c, mirrored))
+    
+    return mirrored_chains
+
 # ------------------------------------------------------------------------
 #    Mouth Controller
 # ------------------------------------------------------------------------
 
-class MUSTARDTOOLS_OT_MouthController(bpy.types.Operator):
-    """This tool will create a mouth controller.\nThe control will be assigned to a bone that you should create in advance, and selected in the Controller Settings.\nRun the tool in Pose mode"""
-    bl_idname = "mustardui.mouth_controller"
-    bl_label = "Apply"
-    bl_options = {'REGISTER','UNDO'}
+# Add a driver to switch on/off the property path of driver_object with a custom property of the armature.
+# SIMPLE_EXPRESSION creates a scripted driver whose expression is evaluated without the Python interpreter
+def mustardtools_add_driver(armature, driver_object, path, prop_name, driver_type="AVERAGE"):
+    
+    driver_object.driver_remove(path)
+    driver = driver_object.driver_add(path)
+    
+    driver = driver.driver
+    if driver_type == "SIMPLE_EXPRESSION":
+        driver.type = "SCRIPTED"
+        driver.expression = "var"
+    else:
+        driver.type = "AVERAGE"
+    var = driver.variables.new()
+    var.name                 = 'var'
+    var.targets[0].id        = armature
+    var.targets[0].data_path = '["' + prop_name + '"]'
+
+# Bones used by the Mouth Controller: role -> (setting with the bone name, setting to mirror if the Mirror option is enabled)
+mustardtools_mouth_controller_roles = {
+    "jaw": ("jaw_bone", None),
+    "edge_L": ("edge_bone_L", None),
+    "edge_R": ("edge_bone_R", "edge_bone_L"),
+    "center_top": ("center_bone_top", None),
+    "center_bot": ("center_bone_bot", None),
+    "middle1_L_top": ("middle1_bone_L_top", None),
+    "middle1_R_top": ("middle1_bone_R_top", "middle1_bone_L_top"),
+    "middle1_L_bot": ("middle1_bone_L_bot", None),
+    "middle1_R_bot": ("middle1_bone_R_bot", "middle1_bone_L_bot"),
+    "middle2_L_top": ("middle2_bone_L_top", None),
+    "middle2_R_top": ("middle2_bone_R_top", "middle2_bone_L_top"),
+    "middle2_L_bot": ("middle2_bone_L_bot", None),
+    "middle2_R_bot": ("middle2_bone_R_bot", "middle2_bone_L_bot"),
+}
+
+# Constraints used by the Mouth Controller: kind -> (constraint type, name suffix)
+mustardtools_mouth_controller_kinds = {
+    "MAIN": ('TRANSFORM', "_MouthControllerConstraint"),
+    "ROT": ('TRANSFORM', "_MouthControllerConstraintRot"),
+    "FLOOR": ('LIMIT_DISTANCE', "_MouthControllerFloor"),
+    "LIMIT_LOC": ('LIMIT_LOCATION', "_MouthControllerConstraint"),
+    "LIMIT_ROT": ('LIMIT_ROTATION', "_MouthControllerConstraintRot"),
+}
+
+# Location fields of the lip bones.
+# side is -1 for the left bones and 1 for the right bones, from_x the sign of the X input on non-MHX rigs
+def mustardtools_mouth_controller_lip_fields(side, from_x, correction_x, correction_z):
+    
+    mhx = [("from_min_x", (1., "range")), ("map_to_x_from", "X"), ("to_min_x", (side, "transform", correction_x)),
+           ("from_min_z", (1., "range")), ("map_to_y_from", "Z"), ("to_min_y", (1., "transform", correction_z))]
+    std = [("from_min_x", (from_x, "range")), ("map_to_z_from", "X"), ("to_min_z", (side, "transform", correction_x)),
+           ("from_min_z", (1., "range")), ("map_to_x_from", "Z"), ("to_min_x", (-side, "transform", correction_z))]
+    
+    return mhx, std
+
+# Rotation fields of the edge and middle 2 bones
+def mustardtools_mouth_controller_rot_fields(coefficient, *factors):
+    
+    mhx = [("map_from", "ROTATION"), ("from_min_z_rot", (90/180*3.14,)), ("map_to_z_from", "Z"), ("to_min_z", (-coefficient,) + factors)]
+    std = [("map_from", "ROTATION"), ("from_min_z_rot", (90/180*3.14,)), ("map_to_y_from", "Z"), ("to_min_y", (coefficient,) + factors)]
+    
+    return mhx, std
+
+# Rotation fields of the middle 1 bones (only used on MHX rigs)
+def mustardtools_mouth_controller_rot_mhx_fields(side):
     
-    def check_mirror(self, bone):
+    return [("map_from", "ROTATION"), ("map_to", "ROTATION"), ("from_min_z_rot", (90/180*3.14,)),
+            ("map_to_y_from", "Z"), ("to_min_y_rot", (-side * 120/180*3.14,))], None
+
+# Mouth Controller constraints.
+# Every row is (bone role, constraint kind, target bone role, fields for MHX rigs, fields for other rigs), where fields are
+# (attribute, value) pairs and numeric values are (coefficient, factors...), with the factors taken from the settings.
+# If the fields are None, the constraint is not created for that kind of rig.
+# The rows of a bone are in the order of its constraint stack
+mustardtools_mouth_controller_table = [
+    ("jaw", "MAIN", None,
+        [("from_min_y", (1., "range")), ("map_to", "ROTATION"), ("map_to_x_from", "Y"), ("to_min_x_rot", (-10. * 3.14 * 120./180., "transform"))],
+        [("from_min_y", (1., "range")), ("map_to_z_from", "Y"), ("to_min_z", (-1., "transform"))]),
+    ("edge_L", "MAIN", None,
+        [("from_min_x", (1., "range")), ("map_to_x_from", "X"), ("to_min_x", (-1., "transform")),
+         ("from_min_y", (1., "range")), ("map_to_z_from", "Y"), ("to_min_z", (1., "transform", "edge_z"))],
+        [("from_min_x", (1., "range")), ("map_to_z_from", "X"), ("to_min_z", (-1., "transform")),
+         ("from_min_z", (1., "range")), ("map_to_x_from", "Z"), ("to_min_x", (1., "transform", "edge_z"))]),
+    ("edge_L", "ROT", None) + mustardtools_mouth_controller_rot_fields(1., "transform"),
+    ("edge_R", "MAIN", None,
+        [("from_min_x", (1., "range")), ("map_to_x_from", "X"), ("to_min_x", (1., "transform")),
+         ("from_min_y", (1., "range")), ("map_to_z_from", "Y"), ("to_min_z", (1., "transform", "edge_z"))],
+        [("from_min_x", (-1., "range")), ("map_to_z_from", "X"), ("to_min_z", (1., "transform")),
+         ("from_min_z", (1., "range")), ("map_to_x_from", "Z"), ("to_min_x", (-1., "transform", "edge_z"))]),
+    ("edge_R", "ROT", None) + mustardtools_mouth_controller_rot_fields(1., "transform"),
+    ("center_top", "MAIN", None,
+        [("from_min_z", (1., "range")), ("map_to_y_from", "Z"), ("to_min_y", (1., "transform", "center_z"))],
+        [("from_min_z", (1., "range")), ("map_to_x_from", "Z"), ("to_min_x", (1., "transform", "center_z"))]),
+    ("center_top", "FLOOR", "center_bot",
+        [("distance", (0.015, "floor"))],
+        [("distance", (0.015, "floor"))]),
+    ("center_bot", "MAIN", None,
+        [("from_min_z", (1., "range")), ("map_to_y_from", "Z"), ("to_min_y", (1., "transform", "center_z"))],
+        [("from_min_z", (1., "range")), ("map_to_x_from", "Z"), ("to_min_x", (1., "transform", "center_z"))]),
+    ("middle1_L_top", "MAIN", None) + mustardtools_mouth_controller_lip_fields(-1., 1., "middle1_x", "middle1_z"),
+    ("middle1_L_top", "ROT", None) + mustardtools_mouth_controller_rot_mhx_fields(-1.),
+    ("middle1_L_top", "FLOOR", "middle1_L_bot",
+        [("distance", (0.01, "floor"))],
+        [("distance", (0.01, "floor"))]),
+    ("middle1_R_top", "MAIN", None) + mustardtools_mouth_controller_lip_fields(1., -1., "middle1_x", "middle1_z"),
+    ("middle1_R_top", "ROT", None) + mustardtools_mouth_controller_rot_mhx_fields(1.),
+    ("middle1_R_top", "FLOOR", "middle1_R_bot",
+        [("distance", (0.01, "floor"))],
+        [("distance", (0.01, "floor"))]),
+    ("middle1_L_bot", "MAIN", None) + mustardtools_mouth_controller_lip_fields(-1., 1., "middle1_x", "middle1_z"),
+    ("middle1_R_bot", "MAIN", None) + mustardtools_mouth_controller_lip_fields(1., 1., "middle1_x", "middle1_z"),
+    ("middle2_L_top", "MAIN", None) + mustardtools_mouth_controller_lip_fields(-1., 1., "middle2_x", "middle2_z"),
+    ("middle2_L_top", "ROT", None) + mustardtools_mouth_controller_rot_fields(0.25, "transform", "middle2_z"),
+    ("middle2_L_top", "FLOOR", "middle2_L_bot",
+        [("distance", (0.008, "floor"))],
+        [("distance", (0.008, "floor"))]),
+    ("middle2_R_top", "MAIN", None) + mustardtools_mouth_controller_lip_fields(1., 1., "middle2_x", "middle2_z"),
+    ("middle2_R_top", "ROT", None) + mustardtools_mouth_controller_rot_fields(0.25, "transform", "middle2_z"),
+    ("middle2_R_top", "FLOOR", "middle2_R_bot",
+        [("distance", (0.008, "floor"))],
+        [("distance", (0.008, "floor"))]),
+    ("middle2_L_bot", "MAIN", None) + mustardtools_mouth_controller_lip_fields(-1., 1., "middle2_x", "middle2_z"),
+    ("middle2_L_bot", "ROT", None) + mustardtools_mouth_controller_rot_fields(0.25, "transform", "middle2_z"),
+    ("middle2_R_bot", "MAIN", None) + mustardtools_mouth_controller_lip_fields(1., 1., "middle2_x", "middle2_z"),
+    ("middle2_R_bot", "ROT", None) + mustardtools_mouth_controller_rot_fields(0.25, "transform", "middle2_z"),
+]
+
+# Limits of the controller bone
+mustardtools_mouth_controller_limits = [
+    ("LIMIT_LOC", [("owner_space", "LOCAL"),
+                   ("use_max_x", True), ("max_x", (1/10, "range")), ("use_min_x", True), ("min_x", (-1/15, "range")),
+                   ("use_max_y", True), ("max_y", (1/20, "range")), ("use_min_y", True), ("min_y", (-1/5, "range")),
+                   ("use_max_z", True), ("max_z", (1/15, "range")), ("use_min_z", True), ("min_z", (-1/15, "range"))]),
+    ("LIMIT_ROT", [("owner_space", "LOCAL"),
+                   ("use_limit_x", True), ("max_x", (0.,)), ("min_x", (0.,)),
+                   ("use_limit_y", True), ("max_y", (0.,)), ("min_y", (0.,)),
+                   ("use_limit_z", True), ("max_z", (20/180*3.14,)), ("min_z", (-20/180*3.14,))]),
+]
+
+# Factors used by the values of the Mouth Controller table.
+# The range is the movement of the controller bone mapped by the constraints, while the transform ratio
+# is the movement of the bones at the end of the range
+def mustardtools_mouth_controller_factors(profile):
+    
+    return {"range": 0.1,
+            "transform": profile.mouth_controller_transform_ratio,
+            "floor": profile.mouth_controller_floor_correction,
+            "edge_z": profile.mouth_controller_edge_bone_correction_z,
+            "center_z": profile.mouth_controller_center_bone_correction_z,
+            "middle1_x": profile.mouth_controller_middle1_bone_correction_x,
+            "middle1_z": profile.mouth_controller_middle1_bone_correction_z,
+            "middle2_x": profile.mouth_controller_middle2_bone_correction_x,
+            "middle2_z": profile.mouth_controller_middle2_bone_correction_z}
+
+# Set the fields of a constraint from the Mouth Controller table
+def mustardtools_mouth_controller_set_fields(constr, fields, factors):
+    
+    for attribute, value in fields:
+        if isinstance(value, tuple):
+            coefficient = value[0]
+            for factor in value[1:]:
+                coefficient = coefficient * factors[factor]
+            value = coefficient
+        setattr(constr, attribute, value)
+
+# Get the constraint of a pose bone by name, creating it if not available
+def mustardtools_mouth_controller_constraint(pose_bone, type, name):
+    
+    constr = pose_bone.constraints.get(name)
+    if constr == None:
+        constr = pose_bone.constraints.new(type)
+        constr.name = name
+    
+    return constr
+
+# Resolve the names of the bones used by the Mouth Controller, mirroring the left bones if the Mirror option is enabled.
+# Returns the bones by role, or None and the error message
+def mustardtools_mouth_controller_bones(profile):
+    
+    if profile.mouth_controller_mirror:
+        mirror_map = mustardtools_mirror_map(profile.mouth_controller_armature)
+    
+    bones = {}
+    for role, (setting, mirror_setting) in mustardtools_mouth_controller_roles.items():
         
-        string_check = bone[len(bone)-1]
+        if role.startswith("middle2") and profile.mouth_controller_number_bones != 2:
+            continue
         
-        if string_check == "l":
-            bone = bone[:-1]+"r"
-        elif string_check == "r":
-            bone = bone[:-1]+"l"
-        elif string_check == "L":
-            bone = bone[:-1]+"R"
-        elif string_check == "R":
-            bone = bone[:-1]+"L"
+        if profile.mouth_controller_mirror and mirror_setting != None:
+            bone = mirror_map.get(getattr(profile, "mouth_controller_" + mirror_setting))
+            if bone == None:
+                return None, 'MustardTools - Bones are not correctly named for Mirror option.'
         else:
-            return bone, False
+            bone = getattr(profile, "mouth_controller_" + setting)
         
-        return bone, True
+        bones[role] = bone
+    
+    return bones, ""
+
+# Update the fields depending on the factors in the constraints already created by the Mouth Controller.
+# Constraints are not created if missing. Returns the number of updated constraints
+def mustardtools_mouth_controller_update(settings, profile, factor_names):
+    
+    armature = profile.mouth_controller_armature
+    if armature == None or profile.mouth_controller_armature_controller == None:
+        return 0
+    
+    bones, message = mustardtools_mouth_controller_bones(profile)
+    if bones == None:
+        return 0
+    
+    factors = mustardtools_mouth_controller_factors(profile)
+    
+    rows = [(role, kind, fields_mhx if profile.mouth_controller_mhx else fields_std) for role, kind, target_role, fields_mhx, fields_std in mustardtools_mouth_controller_table]
+    rows += [("controller", kind, fields) for kind, fields in mustardtools_mouth_controller_limits]
+    bones["controller"] = profile.mouth_controller_bone
+    
+    updated = 0
+    for role, kind, fields in rows:
+        
+        if fields == None or role not in bones:
+            continue
+        
+        # Only the fields depending on the updated factors
+        fields = [field for field in fields if isinstance(field[1], tuple) and any(factor in factor_names for factor in field[1][1:])]
+        if len(fields) == 0:
+            continue
+        
+        owner = profile.mouth_controller_armature_controller if role == "controller" else armature
+        pose_bone = owner.pose.bones.get(bones[role])
+        if pose_bone == None:
+            continue
+        constr = pose_bone.constraints.get(settings.ms_naming_prefix + mustardtools_mouth_controller_kinds[kind][1])
+        if constr == None:
+            continue
+        
+        mustardtools_mouth_controller_set_fields(constr, fields, factors)
+        updated += 1
+    
+    if settings.ms_debug:
+        print("MustardTools - Mouth Controller updated " + str(updated) + " constraints")
+    
+    return updated
+
+# Mute or unmute the constraints of the mouth controller, when the switch of the armature is changed
+def mustardtools_mouth_controller_mute_update(self, context):
+    
+    settings = bpy.context.scene.mustardtools_settings
+    names = [settings.ms_naming_prefix + "_MouthControllerConstraint", settings.ms_naming_prefix + "_MouthControllerConstraintRot", settings.ms_naming_prefix + "_MouthControllerFloor"]
+    
+    if self.type != "ARMATURE":
+        return
+    
+    for bone in self.pose.bones:
+        for constr in bone.constraints:
+            # The limits of the controller bone are not switched, as with the drivers
+            if constr.name in names and constr.type in ['TRANSFORM', 'LIMIT_DISTANCE']:
+                constr.mute = self.mustardtools_mouth_controller_mute
+
+bpy.types.Object.mustardtools_mouth_controller_mute = bpy.props.BoolProperty(name="Mouth Controller Mute",
+                                                    description="Switch off the mouth controller",
+                                                    default=False,
+                                                    update=mustardtools_mouth_controller_mute_update)
+
+# Create the mouth controller with the armatures and bones set in the profile (the settings, if not specified).
+# The pose bones of the armature indexed by name can be passed, to share them between calls.
+# Returns False and the error message if the controller could not be created
+def mustardtools_mouth_controller_apply(settings, profile=None, armature_bones=None):
+    
+    if profile == None:
+        profile = settings
+    
+    mhx = profile.mouth_controller_mhx
+    
+    armature = profile.mouth_controller_armature
+    armature_controller = profile.mouth_controller_armature_controller
+    controller_bone = profile.mouth_controller_bone
+    
+    # Resolve bones before changing anything, so that the controller is not partially created
+    bones, message = mustardtools_mouth_controller_bones(profile)
+    if bones == None:
+        return False, message
+    
+    if armature_bones == None:
+        armature_bones = armature.pose.bones
     
-    def add_driver(self, armature, driver_object, path, prop_name):
+    pose_bones = {}
+    for role, bone in bones.items():
+        pose_bones[role] = armature_bones.get(bone)
+        if pose_bones[role] == None:
+            return False, 'MustardTools - Bone ' + bone + ' not found in ' + armature.name + '.'
+    
+    controller_pose_bone = armature_controller.pose.bones.get(controller_bone)
+    if controller_pose_bone == None:
+        return False, 'MustardTools - Bone ' + controller_bone + ' not found in ' + armature_controller.name + '.'
+    
+    factors = mustardtools_mouth_controller_factors(profile)
+    
+    # Record the component on the armature, to clean it without searching the bones
+    component = mustardtools_rig_component_new(armature, "MOUTH_CONTROLLER", controller_bone)
+    
+    driver_type = profile.mouth_controller_driver_type
+    if profile.mouth_controller_create_driver and driver_type != "SWITCH":
+        mouth_controller_driver_name = "Mouth Controller Mute"
+        armature[mouth_controller_driver_name] = False
+        mustardtools_rig_component_add(component, "PROPERTY", mouth_controller_driver_name, object=armature)
+    
+    for role, kind, target_role, fields_mhx, fields_std in mustardtools_mouth_controller_table:
         
-        driver_object.driver_remove(path)
-        driver = driver_object.driver_add(path)
+        fields = fields_mhx if mhx else fields_std
+        if role not in pose_bones or fields == None:
+            continue
         
-        driver = driver.driver
-        driver.type = "AVERAGE"
-        var = driver.variables.new()
-        var.name                 = 'var'
-        var.targets[0].id        = armature
-        var.targets[0].data_path = '["' + prop_name + '"]'
+        if settings.ms_debug:
+            print("MustardTools - Mouth Controller working on " + bones[role] + " (" + kind + ")")
+        
+        type, name = mustardtools_mouth_controller_kinds[kind]
+        constr = mustardtools_mouth_controller_constraint(pose_bones[role], type, settings.ms_naming_prefix + name)
+        
+        if kind == "FLOOR":
+            constr.target = armature
+            constr.subtarget = bones[target_role]
+            constr.limit_mode = "LIMITDIST_OUTSIDE"
+            if profile.mouth_controller_body_object != None:
+                constr.target_space = "CUSTOM"
+                constr.owner_space = "CUSTOM"
+                constr.space_object = profile.mouth_controller_body_object
+        else:
+            constr.target = armature_controller
+            constr.subtarget = controller_bone
+            constr.use_motion_extrapolate = True
+            constr.target_space = "LOCAL"
+            constr.owner_space = "LOCAL"
+        
+        mustardtools_mouth_controller_set_fields(constr, fields, factors)
+        mustardtools_rig_component_add(component, "CONSTRAINT", constr.name, bone=bones[role], object=armature)
+        
+        if profile.mouth_controller_create_driver:
+            if driver_type == "SWITCH":
+                constr.driver_remove('mute')
+                constr.mute = armature.mustardtools_mouth_controller_mute
+            else:
+                mustardtools_add_driver(armature, constr, 'mute', mouth_controller_driver_name, driver_type)
+                mustardtools_rig_component_add(component, "DRIVER", constr.path_from_id('mute'), object=armature)
+    
+    # Controller bone limits
+    if settings.ms_debug:
+        print("MustardTools - Mouth Controller adding bone limits")
+    
+    for kind, fields in mustardtools_mouth_controller_limits:
+        type, name = mustardtools_mouth_controller_kinds[kind]
+        constr = mustardtools_mouth_controller_constraint(controller_pose_bone, type, settings.ms_naming_prefix + name)
+        mustardtools_mouth_controller_set_fields(constr, fields, factors)
+        mustardtools_rig_component_add(component, "CONSTRAINT", constr.name, bone=controller_bone, object=armature_controller)
+    
+    # Apply custom shape
+    controller_pose_bone.custom_shape = profile.mouth_controller_bone_custom_shape
+    mustardtools_rig_component_add(component, "CUSTOM_SHAPE", controller_bone, object=armature_controller)
+    
+    return True, 'MustardTools - Mouth Controller successfully created.'
+
+# Remove the mouth controller from the armatures set in the profile (the settings, if not specified).
+# The elements recorded when the controller was applied are removed, otherwise all the bones of the armature are searched.
+# Returns the number of removed constraints and drivers, and the list of the removed items
+def mustardtools_mouth_controller_clean(settings, profile=None, armature_bones=None):
+    
+    if profile == None:
+        profile = settings
+    
+    armature = profile.mouth_controller_armature
+    armature_controller = profile.mouth_controller_armature_controller
+    controller_bone = profile.mouth_controller_bone
+    
+    component = armature.mustardtools_rig_components.get(mustardtools_rig_component_id("MOUTH_CONTROLLER", controller_bone))
+    if component != None:
+        return mustardtools_rig_components_remove(armature, [component], settings)
+    
+    # Mouth controllers created by older versions
+    mouth_controller_name = settings.ms_naming_prefix + "_MouthControllerConstraint"
+    mouth_controller_rot_name = settings.ms_naming_prefix + "_MouthControllerConstraintRot"
+    mouth_controller_floor_name = settings.ms_naming_prefix + "_MouthControllerFloor"
+    
+    if armature_bones == None:
+        armature_bones = {bone.name: bone for bone in armature.pose.bones}
+    
+    removed = {"constraints": 0, "drivers": 0, "objects": 0, "bones": 0, "items": []}
+    for bone in armature_bones.values():
+        for constr in [c for c in bone.constraints if c.name in [mouth_controller_name, mouth_controller_rot_name, mouth_controller_floor_name]]:
+            if settings.ms_debug:
+                print("MustardTools Mouth Controller - Constraint "+constr.name+" removed from "+bone.name)
+            
+            # Remove the driver with the constraint, otherwise it is left broken on the armature
+            if armature.animation_data != None:
+                fcurve = armature.animation_data.drivers.find(constr.path_from_id('mute'))
+                if fcurve != None:
+                    armature.animation_data.drivers.remove(fcurve)
+                    removed["drivers"] += 1
+            
+            removed["items"].append("Constraint " + constr.name + " of " + bone.name)
+            bone.constraints.remove(constr)
+            removed["constraints"] += 1
+    
+    controller_bone = armature_controller.pose.bones.get(controller_bone)
+    if controller_bone != None:
+        controller_bone.custom_shape = None
+    
+    mouth_controller_driver_name = "Mouth Controller Mute"
+    if hasattr(armature, '["' + mouth_controller_driver_name + '"]'):
+        del armature[mouth_controller_driver_name]
+    
+    return removed
+
+class MUSTARDTOOLS_OT_MouthController(bpy.types.Operator):
+    """This tool will create a mouth controller.\nThe control will be assigned to a bone that you should create in advance, and selected in the Controller Settings.\nRun the tool in Pose mode"""
+    bl_idname = "mustardui.mouth_controller"
+    bl_label = "Apply"
+    bl_options = {'REGISTER','UNDO'}
     
     @classmethod
     def poll(cls, context):
@@ -1003,1175 +2597,1829 @@ class MUSTARDTOOLS_OT_MouthController(bpy.types.Operator):
     def execute(self, context):
         
         settings = bpy.context.scene.mustardtools_settings
-        mouth_controller_name = settings.ms_naming_prefix + "_MouthControllerConstraint"
-        mouth_controller_rot_name = settings.ms_naming_prefix + "_MouthControllerConstraintRot"
-        mouth_controller_floor_name = settings.ms_naming_prefix + "_MouthControllerFloor"
-        mirror = settings.mouth_controller_mirror
-        mhx = settings.mouth_controller_mhx
-        
-        floor_correction = settings.mouth_controller_floor_correction
-        transform_min = 0.1
-        transform_ratio = settings.mouth_controller_transform_ratio
-        middle1_correction_x = settings.mouth_controller_middle1_bone_correction_x
-        middle2_correction_x = settings.mouth_controller_middle2_bone_correction_x
-        middle1_correction_z = settings.mouth_controller_middle1_bone_correction_z
-        middle2_correction_z = settings.mouth_controller_middle2_bone_correction_z
-        edge_correction_z = settings.mouth_controller_edge_bone_correction_z
-        center_correction_z = settings.mouth_controller_center_bone_correction_z
-                
-        armature = settings.mouth_controller_armature
-        armature_controller = settings.mouth_controller_armature_controller
-        controller_bone = settings.mouth_controller_bone
-        
-        if settings.mouth_controller_create_driver:
-            mouth_controller_driver_name = "Mouth Controller Mute"
-            armature[mouth_controller_driver_name] = False
-        
-        # Jaw bone
-        bone = settings.mouth_controller_jaw_bone
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_name
-        else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
-        
-        constr.from_min_y = transform_min
-        
-        if mhx:
-            constr.map_to = "ROTATION"
-            constr.map_to_x_from = "Y"
-            constr.to_min_x_rot = -transform_min * 10. * 3.14 * 120./180.
-        else:
-            constr.map_to_z_from = "Y"
-            constr.to_min_z = -transform_min
-        
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
         
-        # Edge bones
-        if settings.ms_debug:
-            print("MustardTools - Mouth Controller working on edge bones")
-        
-        bone = settings.mouth_controller_edge_bone_L
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_name
-        else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
-        
-        if mhx:
-            constr.from_min_x = transform_min
-            constr.map_to_x_from = "X"
-            constr.to_min_x = -transform_min
-            
-            constr.from_min_y = transform_min
-            constr.map_to_z_from = "Y"
-            constr.to_min_z = transform_min * edge_correction_z
-        else:
-            constr.from_min_x = transform_min
-            constr.map_to_z_from = "X"
-            constr.to_min_z = -transform_min
-            
-            constr.from_min_z = transform_min
-            constr.map_to_x_from = "Z"
-            constr.to_min_x = transform_min * edge_correction_z
-        
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        res, message = mustardtools_mouth_controller_apply(settings)
         
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_rot_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_rot_name
+        if res:
+            self.report({'INFO'}, message)
         else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_rot_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
+            self.report({'ERROR'}, message)
         
-        constr.map_from = "ROTATION"
+        return {'FINISHED'}
+
+
+class MUSTARDTOOLS_OT_MouthControllerClean(bpy.types.Operator):
+    """This tool will clean all setting related to a mouth controller generated by this addon.\nThe armatures which are cleaned are the ones set in the settings.\nRun the tool in Pose mode"""
+    bl_idname = "mustardui.mouth_controller_clean"
+    bl_label = "Apply"
+    bl_options = {'REGISTER','UNDO'}
+    
+    @classmethod
+    def poll(cls, context):
         
-        constr.from_min_z_rot = 90/180*3.14
+        settings = bpy.context.scene.mustardtools_settings
+        armature = settings.mouth_controller_armature
+        armature_controller = settings.mouth_controller_armature_controller
+        bone_controller = settings.mouth_controller_bone
         
-        if mhx:
-            constr.map_to_z_from = "Z"
-            constr.to_min_z = -transform_min
+        if context.mode != "POSE" or armature == None or armature_controller == None or bone_controller == "":
+            return False
+        if settings.mouth_controller_mirror and (settings.mouth_controller_jaw_bone == "" and settings.mouth_controller_center_bone_top == "" or settings.mouth_controller_center_bone_bot == "" or settings.mouth_controller_edge_bone_L == "" or settings.mouth_controller_middle1_bone_L_top == "" or settings.mouth_controller_middle1_bone_L_bot == "" or  (settings.mouth_controller_number_bones > 1 and (settings.mouth_controller_middle2_bone_L_top == "" or settings.mouth_controller_middle2_bone_L_bot == ""))):
+            return False
         else:
-            constr.map_to_y_from = "Z"
-            constr.to_min_y = transform_min
-        
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+            return True
+
+    def execute(self, context):
         
-        if mirror:
-            bone, mirror_check = self.check_mirror(settings.mouth_controller_edge_bone_L)
-            
-            if not mirror_check:
-                self.report({'ERROR'}, 'MustardTools - Bones are not correctly named for Mirror option.')
-                return {'FINISHED'}
-        else:
-            bone = settings.mouth_controller_edge_bone_R
+        settings = bpy.context.scene.mustardtools_settings
         
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_name
-        else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
-        
-        if mhx:
-            constr.from_min_x = transform_min
-            constr.map_to_x_from = "X"
-            constr.to_min_x = transform_min
-            
-            constr.from_min_y = transform_min
-            constr.map_to_z_from = "Y"
-            constr.to_min_z = transform_min * edge_correction_z
-        else:
-            constr.from_min_x = -transform_min
-            constr.map_to_z_from = "X"
-            constr.to_min_z = transform_min
-            
-            constr.from_min_z = transform_min
-            constr.map_to_x_from = "Z"
-            constr.to_min_x = -transform_min * edge_correction_z
+        removed = mustardtools_mouth_controller_clean(settings)
+        removed_constr = removed["constraints"]
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        for item in removed["items"]:
+            print("MustardTools Mouth Controller - " + item + " removed")
         
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_rot_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_rot_name
+        if removed["drivers"] > 0:
+            self.report({'INFO'}, 'MustardTools - '+ str(removed_constr) +' constraints and '+ str(removed["drivers"]) +' drivers successfully removed.')
         else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_rot_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
-        
-        constr.map_from = "ROTATION"
+            self.report({'INFO'}, 'MustardTools - '+ str(removed_constr) +' constraints successfully removed.')
         
-        constr.from_min_z_rot = 90/180*3.14
+        return {'FINISHED'}
+
+# Copy the Mouth Controller properties between the settings and a profile
+# The correction updates are suspended during the copy, otherwise they would be applied to the previous armature
+def mustardtools_mouth_controller_profile_copy(source, target):
+    
+    global mustardtools_mouth_controller_update_suspended
+    
+    mustardtools_mouth_controller_update_suspended = True
+    try:
+        for prop in MustardTools_MouthControllerProfile.__annotations__.keys():
+            if prop.startswith("mouth_controller_"):
+                setattr(target, prop, getattr(source, prop))
+    finally:
+        mustardtools_mouth_controller_update_suspended = False
+
+class MUSTARDTOOLS_OT_MouthControllerProfile_Add(bpy.types.Operator):
+    """Store the current Mouth Controller settings in the profile of the armature.\nThe profile is overwritten if already available"""
+    bl_idname = "mustardui.mouth_controller_profile_add"
+    bl_label = "Store Profile"
+    bl_options = {'REGISTER','UNDO'}
+    
+    @classmethod
+    def poll(cls, context):
+        
+        settings = bpy.context.scene.mustardtools_settings
+        return settings.mouth_controller_armature != None
+    
+    def execute(self, context):
+        
+        settings = bpy.context.scene.mustardtools_settings
+        name = settings.mouth_controller_armature.name
         
-        if mhx:
-            constr.map_to_z_from = "Z"
-            constr.to_min_z = -transform_min
+        index = settings.mouth_controller_profiles.find(name)
+        if index < 0:
+            profile = settings.mouth_controller_profiles.add()
+            profile.name = name
+            index = len(settings.mouth_controller_profiles) - 1
         else:
-            constr.map_to_y_from = "Z"
-            constr.to_min_y = transform_min
+            profile = settings.mouth_controller_profiles[index]
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        mustardtools_mouth_controller_profile_copy(settings, profile)
+        settings.mouth_controller_profiles_index = index
+        
+        self.report({'INFO'}, 'MustardTools - Profile ' + name + ' stored.')
+        
+        return {'FINISHED'}
+
+class MUSTARDTOOLS_OT_MouthControllerProfile_Load(bpy.types.Operator):
+    """Load the selected profile in the Mouth Controller settings"""
+    bl_idname = "mustardui.mouth_controller_profile_load"
+    bl_label = "Load Profile"
+    bl_options = {'REGISTER','UNDO'}
+    
+    @classmethod
+    def poll(cls, context):
+        
+        settings = bpy.context.scene.mustardtools_settings
+        return settings.mouth_controller_profiles_index < len(settings.mouth_controller_profiles)
+    
+    def execute(self, context):
         
-        # Center bones
+        settings = bpy.context.scene.mustardtools_settings
+        profile = settings.mouth_controller_profiles[settings.mouth_controller_profiles_index]
+        
+        mustardtools_mouth_controller_profile_copy(profile, settings)
+        
+        # Apply the loaded corrections to the constraints of the new armature, if already created
+        updated = mustardtools_mouth_controller_update(settings, settings, mustardtools_mouth_controller_factor_names)
         if settings.ms_debug:
-            print("MustardTools - Mouth Controller working on center bones")
+            print("MustardTools Mouth Controller - Profile " + profile.name + " loaded, " + str(updated) + " constraints updated")
         
-        bone = settings.mouth_controller_center_bone_top
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_name
-        else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
-        
-        if mhx:
-            constr.from_min_z = transform_min
-            constr.map_to_y_from = "Z"
-            constr.to_min_y = transform_min * center_correction_z
-        else:
-            constr.from_min_z = transform_min
-            constr.map_to_x_from = "Z"
-            constr.to_min_x = transform_min * center_correction_z
-            
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        self.report({'INFO'}, 'MustardTools - Profile ' + profile.name + ' loaded.')
         
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_floor_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('LIMIT_DISTANCE')
-            constr.name = mouth_controller_floor_name
-        else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_floor_name]
-        constr.target = armature
-        constr.subtarget = settings.mouth_controller_center_bone_bot
-        constr.distance = 0.015 * floor_correction
-        constr.limit_mode = "LIMITDIST_OUTSIDE"
-        if settings.mouth_controller_body_object != None:
-            constr.target_space = "CUSTOM"
-            constr.owner_space = "CUSTOM"
-            constr.space_object = settings.mouth_controller_body_object
+        return {'FINISHED'}
+
+class MUSTARDTOOLS_OT_MouthControllerProfile_Remove(bpy.types.Operator):
+    """Remove the selected profile.\nThe Mouth Controller of the character is not removed"""
+    bl_idname = "mustardui.mouth_controller_profile_remove"
+    bl_label = "Remove Profile"
+    bl_options = {'REGISTER','UNDO'}
+    
+    @classmethod
+    def poll(cls, context):
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        settings = bpy.context.scene.mustardtools_settings
+        return settings.mouth_controller_profiles_index < len(settings.mouth_controller_profiles)
+    
+    def execute(self, context):
         
-        bone = settings.mouth_controller_center_bone_bot
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_name
-        else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
-        
-        if mhx:
-            constr.from_min_z = transform_min
-            constr.map_to_y_from = "Z"
-            constr.to_min_y = transform_min * center_correction_z
-        else:
-            constr.from_min_z = transform_min
-            constr.map_to_x_from = "Z"
-            constr.to_min_x = transform_min * center_correction_z
+        settings = bpy.context.scene.mustardtools_settings
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        settings.mouth_controller_profiles.remove(settings.mouth_controller_profiles_index)
+        settings.mouth_controller_profiles_index = max(settings.mouth_controller_profiles_index - 1, 0)
         
-        # Middle bones 1 top
-        if settings.ms_debug:
-            print("MustardTools - Mouth Controller working on middle bones 1 top")
+        return {'FINISHED'}
+
+class MUSTARDTOOLS_OT_MouthController_Batch(bpy.types.Operator):
+    """Apply or clean the Mouth Controller on all the enabled profiles"""
+    bl_idname = "mustardui.mouth_controller_batch"
+    bl_label = "Batch"
+    bl_options = {'REGISTER','UNDO'}
+    
+    action: EnumProperty(name='Action',
+        items=[("APPLY", "Apply", "Apply the Mouth Controller of the profiles"),
+               ("CLEAN", "Clean", "Remove the Mouth Controller of the profiles")],
+        default="APPLY"
+    )
+    
+    @classmethod
+    def poll(cls, context):
         
-        bone = settings.mouth_controller_middle1_bone_L_top
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_name
-        else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
-        
-        if mhx:
-            constr.from_min_x = transform_min
-            constr.map_to_x_from = "X"
-            constr.to_min_x = -transform_min * middle1_correction_x
-            
-            constr.from_min_z = transform_min
-            constr.map_to_y_from = "Z"
-            constr.to_min_y = transform_min * middle1_correction_z
-        else:
-            constr.from_min_x = transform_min
-            constr.map_to_z_from = "X"
-            constr.to_min_z = -transform_min * middle1_correction_x
-            
-            constr.from_min_z = transform_min
-            constr.map_to_x_from = "Z"
-            constr.to_min_x = transform_min * middle1_correction_z
+        settings = bpy.context.scene.mustardtools_settings
+        return any(profile.enabled for profile in settings.mouth_controller_profiles)
+    
+    def execute(self, context):
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        settings = bpy.context.scene.mustardtools_settings
+        
+        start_time = time.time()
+        
+        # Index the pose bones once for each armature, as more profiles can share the same armature
+        armatures_bones = {}
+        
+        done = 0
+        failed = 0
+        for profile in settings.mouth_controller_profiles:
             
-        #  Rotation constraint
-        if mhx:
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_rot_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-                constr.name = mouth_controller_rot_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_rot_name]
-            constr.target = armature_controller
-            constr.subtarget = controller_bone
-            constr.use_motion_extrapolate = True
-            constr.target_space = "LOCAL"
-            constr.owner_space = "LOCAL"
+            if not profile.enabled:
+                continue
+            
+            profile_start_time = time.time()
             
-            constr.map_from = "ROTATION"
-            constr.map_to = "ROTATION"
+            armature = profile.mouth_controller_armature
+            if armature == None or profile.mouth_controller_armature_controller == None:
+                print("MustardTools Mouth Controller - " + profile.name + ": armatures not set")
+                failed += 1
+                continue
             
-            constr.from_min_z_rot = 90/180*3.14
+            if armature.name not in armatures_bones:
+                armatures_bones[armature.name] = {bone.name: bone for bone in armature.pose.bones}
+            armature_bones = armatures_bones[armature.name]
             
-            constr.map_to_y_from = "Z"
-            constr.to_min_y_rot = 120/180*3.14
+            if self.action == "APPLY":
+                res, message = mustardtools_mouth_controller_apply(settings, profile, armature_bones)
+            else:
+                removed = mustardtools_mouth_controller_clean(settings, profile, armature_bones)
+                res, message = True, str(removed["constraints"]) + ' constraints and ' + str(removed["drivers"]) + ' drivers removed'
+            
+            if res:
+                done += 1
+            else:
+                failed += 1
+            
+            print("MustardTools Mouth Controller - " + profile.name + ": " + message.replace('MustardTools - ', '') + " (" + "{:.2f}".format((time.time() - profile_start_time) * 1000.) + " ms)")
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        total_time = time.time() - start_time
         
-        #  Lips distance constraint
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_floor_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('LIMIT_DISTANCE')
-            constr.name = mouth_controller_floor_name
+        if failed > 0:
+            self.report({'WARNING'}, 'MustardTools - ' + str(done) + ' characters done, ' + str(failed) + ' failed. Check the console for more informations.')
         else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_floor_name]
-        constr.target = armature
-        constr.subtarget = settings.mouth_controller_middle1_bone_L_bot
-        constr.distance = 0.01 * floor_correction
-        constr.limit_mode = "LIMITDIST_OUTSIDE"
-        if settings.mouth_controller_body_object != None:
-            constr.target_space = "CUSTOM"
-            constr.owner_space = "CUSTOM"
-            constr.space_object = settings.mouth_controller_body_object
+            self.report({'INFO'}, 'MustardTools - ' + str(done) + ' characters done in ' + "{:.2f}".format(total_time) + ' s.')
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
-            
-        if mirror:
-            bone, mirror_check = self.check_mirror(settings.mouth_controller_middle1_bone_L_top)
-            
-            if not mirror_check:
-                self.report({'ERROR'}, 'MustardTools - Bones are not correctly named for Mirror option.')
-                return {'FINISHED'}
-        else:
-            bone = settings.mouth_controller_middle1_bone_R_top
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_name
+        return {'FINISHED'}
+
+# Naming conventions for the Smart Search.
+# Roles are the mouth_controller_* settings without the side: bones of the left side are written (the right ones are found
+# swapping the side), and names starting with "re:" are regular expressions on the normalized names, where {side} is the side.
+# Names are compared after normalization (see mustardtools_bone_name_normalize), so that different side conventions match
+mustardtools_mouth_controller_conventions = [
+    {"name": "Auto-Rig Pro", "mhx": False, "number_bones": 2,
+     "roles": {"jaw_bone": "c_jawbone.x", "center_bone_top": "c_lips_top.x", "center_bone_bot": "c_lips_bot.x",
+               "edge_bone": "c_lips_smile.l", "middle1_bone_top": "c_lips_top.l", "middle1_bone_bot": "c_lips_bot.l",
+               "middle2_bone_top": "c_lips_top_01.l", "middle2_bone_bot": "c_lips_bot_01.l"}},
+    {"name": "MHX", "mhx": True, "number_bones": 2, "settings": {"mouth_controller_edge_bone_correction_z": 0.8},
+     "roles": {"jaw_bone": "lowerJaw", "center_bone_top": "LipUpperMiddle", "center_bone_bot": "LipLowerMiddle",
+               "edge_bone": "LipCorner.L", "middle1_bone_top": "LipUpperInner.L", "middle1_bone_bot": "LipLowerInner.L",
+               "middle2_bone_top": "LipUpperOuter.L", "middle2_bone_bot": "LipLowerOuter.L"}},
+    {"name": "DAZ Genesis", "mhx": False, "number_bones": 2,
+     "roles": {"jaw_bone": "lowerJaw", "center_bone_top": "LipUpperMiddle", "center_bone_bot": "LipLowerMiddle",
+               "edge_bone": "lLipCorner", "middle1_bone_top": "lLipUpperInner", "middle1_bone_bot": "lLipLowerInner",
+               "middle2_bone_top": "lLipUpperOuter", "middle2_bone_bot": "lLipLowerOuter"}},
+    {"name": "Rigify", "mhx": False, "number_bones": 1,
+     "roles": {"jaw_bone": "jaw_master", "center_bone_top": "lip.T", "center_bone_bot": "lip.B",
+               "edge_bone": "lips.L", "middle1_bone_top": "lip.T.L.001", "middle1_bone_bot": "lip.B.L.001"}},
+    # Character Creator and Mixamo skeletons have no lip bones: only the jaw is found
+    {"name": "Character Creator", "mhx": False, "number_bones": 1,
+     "roles": {"jaw_bone": "CC_Base_JawRoot"}},
+    {"name": "Mixamo", "mhx": False, "number_bones": 1,
+     "roles": {"jaw_bone": "re:^jaw$"}},
+]
+
+# Roles of the conventions: the bones settings of the left side, without the side
+mustardtools_mouth_controller_convention_roles = set(setting.replace("_L", "") for setting, mirror_setting in mustardtools_mouth_controller_roles.values() if mirror_setting == None)
+
+# Normalize a bone name for the Smart Search: lower case, without namespaces (e.g. mixamorig:),
+# and with the side (l/r prefixes, .L/_l/Left suffixes, also before a .001 number) moved to a .l or .r suffix
+def mustardtools_bone_name_normalize(name):
+    
+    name = name.split(":")[-1]
+    side = ""
+    
+    # DAZ style prefix (lLipCorner)
+    match = re.match(r'^([lr])(?=[A-Z])', name)
+    if match:
+        side = match.group(1)
+        name = name[1:]
+    
+    name = name.lower()
+    
+    match = re.match(r'^(left|right)[._ -]?', name)
+    if match and side == "":
+        side = match.group(1)[0]
+        name = name[match.end():]
+    
+    match = re.search(r'[._ -](l|r|left|right)(\.\d+)?$', name)
+    if match and side == "":
+        side = match.group(1)[0]
+        name = name[:match.start()] + (match.group(2) if match.group(2) else "")
+    
+    if side == "":
+        return name
+    
+    match = re.search(r'\.\d+$', name)
+    if match:
+        return name[:match.start()] + "." + side + match.group(0)
+    
+    return name + "." + side
+
+# Check a setting of a user-defined convention: only the Mouth Controller settings with a simple value can be set.
+# Returns an error message, empty if the setting can be used
+mustardtools_mouth_controller_convention_setting_types = {'BOOLEAN': bool, 'INT': int, 'FLOAT': (int, float), 'STRING': str, 'ENUM': str}
+
+def mustardtools_mouth_controller_convention_setting_check(key, value):
+    
+    if not key.startswith("mouth_controller_") or key not in MustardTools_Settings.__annotations__:
+        return "unknown setting " + key
+    
+    prop = MustardTools_Settings.bl_rna.properties[key]
+    types = mustardtools_mouth_controller_convention_setting_types.get(prop.type)
+    if types == None or getattr(prop, "is_array", False):
+        return "the setting " + key + " can not be set by a convention"
+    if not isinstance(value, types) or (isinstance(value, bool) and prop.type != 'BOOLEAN'):
+        return "the value of " + key + " is not valid"
+    if prop.type == 'ENUM' and value not in prop.enum_items.keys():
+        return "the value of " + key + " is not one of " + ", ".join(prop.enum_items.keys())
+    
+    return ""
+
+# Check a user-defined convention, which should have the same format of the built-in conventions.
+# Returns an error message, empty if the convention can be used
+def mustardtools_mouth_controller_convention_check(convention):
+    
+    if not isinstance(convention, dict):
+        return "not defined as a dictionary"
+    if not isinstance(convention.get("name", ""), str):
+        return "\"name\" is not a string"
+    if not isinstance(convention.get("mhx", False), bool):
+        return "\"mhx\" is not a boolean"
+    if convention.get("number_bones", 1) not in [1, 2] or isinstance(convention.get("number_bones", 1), bool):
+        return "\"number_bones\" is not 1 or 2"
+    
+    roles = convention.get("roles")
+    if not isinstance(roles, dict):
+        return "\"roles\" not defined as a dictionary"
+    for role, name in roles.items():
+        if role not in mustardtools_mouth_controller_convention_roles:
+            return "unknown role " + role
+        if not isinstance(name, str):
+            return "the bone name of " + role + " is not a string"
+        if name.startswith("re:"):
+            try:
+                re.compile(name[3:].replace("{side}", "l"))
+            except re.error as e:
+                return "the regular expression of " + role + " is not valid: " + str(e)
+    
+    settings = convention.get("settings", {})
+    if not isinstance(settings, dict):
+        return "\"settings\" not defined as a dictionary"
+    for key, value in settings.items():
+        error = mustardtools_mouth_controller_convention_setting_check(key, value)
+        if error != "":
+            return error
+    
+    return ""
+
+# Load the user-defined conventions from a JSON file (a list with the same format of the built-in conventions).
+# Conventions which are not valid are skipped. The file is loaded again only if modified
+mustardtools_mouth_controller_conventions_cache = {}
+
+def mustardtools_mouth_controller_conventions_load(filepath):
+    
+    if filepath == "":
+        return []
+    
+    filepath = bpy.path.abspath(filepath)
+    try:
+        mtime = os.path.getmtime(filepath)
+    except OSError:
+        print("MustardTools Mouth Controller - Conventions file " + filepath + " not found")
+        return []
+    
+    cached = mustardtools_mouth_controller_conventions_cache.get(filepath)
+    if cached != None and cached[0] == mtime:
+        return cached[1]
+    
+    try:
+        with open(filepath, "r") as f:
+            conventions = json.load(f)
+    except (OSError, ValueError) as e:
+        print("MustardTools Mouth Controller - Conventions file " + filepath + " not valid: " + str(e))
+        return []
+    
+    if isinstance(conventions, dict):
+        conventions = [conventions]
+    if not isinstance(conventions, list):
+        print("MustardTools Mouth Controller - Conventions file " + filepath + " not valid: a list of conventions is expected")
+        return []
+    
+    valid_conventions = []
+    for i, convention in enumerate(conventions):
+        error = mustardtools_mouth_controller_convention_check(convention)
+        if error != "":
+            print("MustardTools Mouth Controller - Convention " + str(i) + " of " + filepath + " skipped: " + error)
+            continue
+        convention.setdefault("name", os.path.basename(filepath))
+        valid_conventions.append(convention)
+    
+    mustardtools_mouth_controller_conventions_cache[filepath] = (mtime, valid_conventions)
+    
+    return valid_conventions
+
+# Patterns of a convention, as {(role, side): (exact normalized name or None, compiled pattern or None)}
+def mustardtools_mouth_controller_convention_patterns(convention):
+    
+    patterns = {}
+    for role, name in convention["roles"].items():
+        sides = ["l", "r"] if role.startswith("edge") or role.startswith("middle") else [""]
+        for side in sides:
+            if name.startswith("re:"):
+                patterns[(role, side)] = (None, re.compile(name[3:].replace("{side}", side)))
+            else:
+                normalized = mustardtools_bone_name_normalize(name)
+                if side == "r":
+                    normalized = re.sub(r'\.l(\.\d+)?$', r'.r\1', normalized)
+                patterns[(role, side)] = (normalized, None)
+    
+    return patterns
+
+# Find the bones of the mouth with the known naming conventions, with a single pass on the bones of the armature.
+# When more bones match the regular expression of a role, the one nearest to the jaw is used.
+# Returns the convention that matched more roles, with the bones found as {setting: bone name}
+def mustardtools_mouth_controller_search(armature, conventions):
+    
+    bones = armature.data.bones
+    heads = np.empty(len(bones) * 3, dtype=np.float32)
+    bones.foreach_get("head_local", heads)
+    heads = heads.reshape(-1, 3)
+    
+    conventions_patterns = [mustardtools_mouth_controller_convention_patterns(convention) for convention in conventions]
+    regex_patterns = [(c, key, pattern) for c, patterns in enumerate(conventions_patterns) for key, (exact, pattern) in patterns.items() if pattern != None]
+    
+    # Single pass on the bones: name index and regular expression candidates
+    index = {}
+    candidates = {}
+    for i, bone in enumerate(bones):
+        normalized = mustardtools_bone_name_normalize(bone.name)
+        index.setdefault(normalized, i)
+        for c, key, pattern in regex_patterns:
+            if pattern.search(normalized):
+                candidates.setdefault((c, key), []).append(i)
+    
+    best = None
+    for c, (convention, patterns) in enumerate(zip(conventions, conventions_patterns)):
+        
+        found = {}
+        for key, (exact, pattern) in patterns.items():
+            if exact != None:
+                if exact in index:
+                    found[key] = index[exact]
+            elif (c, key) in candidates:
+                found[key] = candidates[(c, key)]
+        
+        # Geometric heuristics: the candidate nearest to the jaw
+        jaw = found.get(("jaw_bone", ""))
+        if isinstance(jaw, list):
+            jaw = jaw[0]
+            found[("jaw_bone", "")] = jaw
+        for key, value in found.items():
+            if isinstance(value, list):
+                if jaw != None:
+                    found[key] = min(value, key=lambda i: float(np.linalg.norm(heads[i] - heads[jaw])))
+                else:
+                    found[key] = value[0]
+        
+        # Score: number of roles found, with exact names preferred to normalized ones
+        score = len(found) + 0.01 * sum(1 for (role, side), i in found.items() if bones[i].name == convention["roles"][role])
+        if len(found) > 0 and (best == None or score > best[0]):
+            best = (score, convention, found)
+    
+    if best == None:
+        return None, {}
+    
+    score, convention, found = best
+    result = {}
+    for (role, side), i in found.items():
+        if side == "":
+            result["mouth_controller_" + role] = bones[i].name
         else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
-        
-        if mhx:
-            constr.from_min_x = transform_min
-            constr.map_to_x_from = "X"
-            constr.to_min_x = transform_min * middle1_correction_x
-            
-            constr.from_min_z = transform_min
-            constr.map_to_y_from = "Z"
-            constr.to_min_y = transform_min * middle1_correction_z
+            # edge_bone -> edge_bone_L, middle1_bone_top -> middle1_bone_L_top
+            parts = role.split("_")
+            parts.insert(2, side.upper())
+            result["mouth_controller_" + "_".join(parts)] = bones[i].name
+    
+    return convention, result
+
+# Check if the right bones can be found from the left ones with the Mirror option
+def mustardtools_mouth_controller_bones_mirror(armature, bones):
+    
+    mirror_map = mustardtools_mirror_map(armature)
+    pairs = [(prop, prop.replace("_L", "_R")) for prop in bones.keys() if "_L" in prop]
+    return len(pairs) > 0 and all(bones.get(prop_R) == mirror_map.get(bones[prop_L]) for prop_L, prop_R in pairs)
+
+class MUSTARDTOOLS_OT_MouthControllerSmartSearch(bpy.types.Operator):
+    """This tool will search for standard names of the lips bones.\nRun the tool in Pose mode"""
+    bl_idname = "mustardui.mouth_controller_search"
+    bl_label = "Search"
+    bl_options = {'REGISTER','UNDO'}
+    
+    @classmethod
+    def poll(cls, context):
+        
+        settings = bpy.context.scene.mustardtools_settings
+        armature = settings.mouth_controller_armature
+        
+        if context.mode != "POSE" or armature == None:
+            return False
         else:
-            constr.from_min_x = -transform_min
-            constr.map_to_z_from = "X"
-            constr.to_min_z = transform_min * middle1_correction_x
-            
-            constr.from_min_z = transform_min
-            constr.map_to_x_from = "Z"
-            constr.to_min_x = -transform_min * middle1_correction_z
+            return True
+
+    def execute(self, context):
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        settings = bpy.context.scene.mustardtools_settings
+        armature = settings.mouth_controller_armature
         
-        #  Rotation constraint
-        if mhx:
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_rot_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-                constr.name = mouth_controller_rot_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_rot_name]
-            constr.target = armature_controller
-            constr.subtarget = controller_bone
-            constr.use_motion_extrapolate = True
-            constr.target_space = "LOCAL"
-            constr.owner_space = "LOCAL"
-            
-            constr.map_from = "ROTATION"
-            constr.map_to = "ROTATION"
-            
-            constr.from_min_z_rot = 90/180*3.14
-            
-            constr.map_to_y_from = "Z"
-            constr.to_min_y_rot = -120/180*3.14
+        conventions = mustardtools_mouth_controller_conventions + mustardtools_mouth_controller_conventions_load(settings.mouth_controller_conventions_file)
         
+        start_time = time.time()
+        convention, bones = mustardtools_mouth_controller_search(armature, conventions)
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        if convention == None:
+            self.report({'INFO'}, 'MustardTools - No convention found. Insert bones manually.')
+            return {'FINISHED'}
         
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_floor_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('LIMIT_DISTANCE')
-            constr.name = mouth_controller_floor_name
-        else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_floor_name]
-        constr.target = armature
-        if mirror:
-            constr_subtarget, mirror_check = self.check_mirror(settings.mouth_controller_middle1_bone_L_bot)
-            
-            if not mirror_check:
-                self.report({'ERROR'}, 'MustardTools - Bones are not correctly named for Mirror option.')
-                return {'FINISHED'}
-            
-            constr.subtarget = constr_subtarget
-        else:
-            constr.subtarget = settings.mouth_controller_middle1_bone_R_bot
-        constr.distance = 0.01 * floor_correction
-        constr.limit_mode = "LIMITDIST_OUTSIDE"
-        if settings.mouth_controller_body_object != None:
-            constr.target_space = "CUSTOM"
-            constr.owner_space = "CUSTOM"
-            constr.space_object = settings.mouth_controller_body_object
+        # Clear the bones found by a previous search, which could be missing in this convention
+        for setting, mirror_setting in mustardtools_mouth_controller_roles.values():
+            setattr(settings, "mouth_controller_" + setting, "")
+        for prop, bone in bones.items():
+            setattr(settings, prop, bone)
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        settings.mouth_controller_mhx = convention.get("mhx", False)
+        settings.mouth_controller_number_bones = convention.get("number_bones", 2 if "middle2_bone_top" in convention["roles"] else 1)
+        # The settings of the user-defined conventions are checked when the conventions are loaded
+        for prop, value in convention.get("settings", {}).items():
+            setattr(settings, prop, value)
+        
+        # Use the Mirror option only if the right bones can be found from the left ones
+        settings.mouth_controller_mirror = mustardtools_mouth_controller_bones_mirror(armature, bones)
         
-        # Middle bones 1 bottom
         if settings.ms_debug:
-            print("MustardTools - Mouth Controller working on middle bones 1 bottom")
+            print("MustardTools Mouth Controller - Smart Search done in " + "{:.2f}".format((time.time() - start_time) * 1000.) + " ms")
+            for prop, bone in bones.items():
+                print("MustardTools Mouth Controller - " + prop + ": " + bone)
         
-        bone = settings.mouth_controller_middle1_bone_L_bot
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_name
-        else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
-        
-        if mhx:
-            constr.from_min_x = transform_min
-            constr.map_to_x_from = "X"
-            constr.to_min_x = -transform_min * middle1_correction_x
-            
-            constr.from_min_z = transform_min
-            constr.map_to_y_from = "Z"
-            constr.to_min_y = transform_min * middle1_correction_z
-        else:
-            constr.from_min_x = transform_min
-            constr.map_to_z_from = "X"
-            constr.to_min_z = -transform_min * middle1_correction_x
-            
-            constr.from_min_z = transform_min
-            constr.map_to_x_from = "Z"
-            constr.to_min_x = transform_min * middle1_correction_z
+        self.report({'INFO'}, 'MustardTools - ' + convention["name"] + ' convention used to fill ' + str(len(bones)) + ' properties.')
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        return {'FINISHED'}
+
+# Classify the lips bones of an armature with their position, for rigs without a naming convention.
+# The candidates are the bones passed, or the bones with the head near the tail of the jaw (within radius times the jaw length).
+# Heads are projected in the face plane (X and Z of the armature): the bones on the sides are the edges,
+# the others are split in top and bottom by the line between the edges, and ordered from the center to the edges.
+# Returns the bones as {setting: bone name} and the number of middle bones, or None and the error message
+def mustardtools_mouth_controller_classify(armature, jaw_bone, bone_names=None, radius=0.6):
+    
+    bones = armature.data.bones
+    jaw = bones.get(jaw_bone)
+    if jaw == None:
+        return None, 'MustardTools - Set the Jaw bone to classify the lips bones.'
+    
+    heads = np.empty(len(bones) * 3, dtype=np.float32)
+    bones.foreach_get("head_local", heads)
+    heads = heads.reshape(-1, 3)
+    names = [bone.name for bone in bones]
+    
+    if bone_names != None:
+        candidates = np.array([i for i, name in enumerate(names) if name in bone_names and name != jaw_bone], dtype=np.int64)
+    else:
+        distances = np.linalg.norm(heads - np.array(jaw.tail_local, dtype=np.float32), axis=1)
+        candidates = np.flatnonzero(distances < radius * jaw.length)
+        candidates = candidates[candidates != bones.find(jaw_bone)]
+    
+    # Bones with the same head (e.g. deform and control bones) are considered once
+    if len(candidates) > 0:
+        unique = np.unique(np.round(heads[candidates], 5), axis=0, return_index=True)[1]
+        candidates = candidates[np.sort(unique)]
+    
+    if len(candidates) < 5:
+        return None, 'MustardTools - At least 5 lips bones are needed to classify them (' + str(len(candidates)) + ' found).'
+    
+    # Projection in the face plane, centered on the mouth
+    points = heads[candidates][:, [0, 2]]
+    points = points - points.mean(axis=0)
+    x = points[:, 0]
+    z = points[:, 1]
+    
+    # Edges: the farthest bones on each side (left is +X)
+    edge_L = int(np.argmax(x))
+    edge_R = int(np.argmin(x))
+    width = x[edge_L] - x[edge_R]
+    if width <= 0.:
+        return None, 'MustardTools - The lips bones are not spread on the X axis.'
+    
+    # Top and bottom: above or below the line between the edges
+    line_z = z[edge_R] + (x - x[edge_R]) * (z[edge_L] - z[edge_R]) / width
+    top = z > line_z
+    
+    others = np.ones(len(candidates), dtype=bool)
+    others[[edge_L, edge_R]] = False
+    
+    # Center: the nearest bones to the middle of the edges
+    center_x = (x[edge_L] + x[edge_R]) / 2.
+    side_x = x - center_x
+    
+    result = {"mouth_controller_jaw_bone": jaw_bone,
+              "mouth_controller_edge_bone_L": names[candidates[edge_L]],
+              "mouth_controller_edge_bone_R": names[candidates[edge_R]]}
+    groups = {}
+    for position, mask in [("top", others & top), ("bot", others & ~top)]:
+        
+        indices = np.flatnonzero(mask)
+        if len(indices) == 0:
+            return None, 'MustardTools - No ' + ("top" if position == "top" else "bottom") + ' lips bones found.'
+        
+        center = indices[np.argmin(np.abs(side_x[indices]))]
+        result["mouth_controller_center_bone_" + position] = names[candidates[center]]
+        
+        indices = indices[indices != center]
+        groups[("L", position)] = indices[side_x[indices] > 0.]
+        groups[("R", position)] = indices[side_x[indices] < 0.]
+    
+    # Middle bones: 1 or 2 for each side, evenly spaced between the center and the edges
+    number_bones = min(2, min(len(indices) for indices in groups.values()))
+    if number_bones == 0:
+        return None, 'MustardTools - No middle lips bones found on both sides.'
+    
+    for (side, position), indices in groups.items():
+        available = list(indices)
+        for m in range(number_bones):
+            target = (m + 1) / (number_bones + 1)
+            nearest = min(available, key=lambda i: abs(float(np.abs(side_x[i]) / (width / 2.)) - target))
+            available.remove(nearest)
+            result["mouth_controller_middle" + str(m+1) + "_bone_" + side + "_" + position] = names[candidates[nearest]]
+    
+    return result, number_bones
+
+class MUSTARDTOOLS_OT_MouthControllerClassify(bpy.types.Operator):
+    """This tool will find the lips bones from their position, for rigs without standard names.\nThe selected bones are classified, or the bones near the tip of the Jaw bone if less than 5 bones are selected.\nRun the tool in Pose mode"""
+    bl_idname = "mustardui.mouth_controller_classify"
+    bl_label = "Classify"
+    bl_options = {'REGISTER','UNDO'}
+    
+    radius: FloatProperty(name='Radius',
+        description="Distance from the tip of the Jaw bone where bones are searched, relative to the Jaw bone length",
+        default=0.6,
+        min=0.01
+    )
+    
+    @classmethod
+    def poll(cls, context):
         
-        if mirror:
-            bone, mirror_check = self.check_mirror(settings.mouth_controller_middle1_bone_L_bot)
-            
-            if not mirror_check:
-                self.report({'ERROR'}, 'MustardTools - Bones are not correctly named for Mirror option.')
-                return {'FINISHED'}
-        else:
-            bone = settings.mouth_controller_middle1_bone_R_bot
-        if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-            constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-            constr.name = mouth_controller_name
-        else:
-            constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-        constr.target = armature_controller
-        constr.subtarget = controller_bone
-        constr.use_motion_extrapolate = True
-        constr.target_space = "LOCAL"
-        constr.owner_space = "LOCAL"
-        
-        if mhx:
-            constr.from_min_x = transform_min
-            constr.map_to_x_from = "X"
-            constr.to_min_x = transform_min * middle1_correction_x
-            
-            constr.from_min_z = transform_min
-            constr.map_to_y_from = "Z"
-            constr.to_min_y = transform_min * middle1_correction_z
-        else:
-            constr.from_min_x = transform_min
-            constr.map_to_z_from = "X"
-            constr.to_min_z = transform_min * middle1_correction_x
-            
-            constr.from_min_z = transform_min
-            constr.map_to_x_from = "Z"
-            constr.to_min_x = -transform_min * middle1_correction_z
+        settings = bpy.context.scene.mustardtools_settings
         
-        if settings.mouth_controller_create_driver:
-            self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+        return context.mode == "POSE" and settings.mouth_controller_armature != None and settings.mouth_controller_jaw_bone != ""
+    
+    def execute(self, context):
         
-        if settings.mouth_controller_number_bones == 2:
-            
-            if settings.ms_debug:
-                print("MustardTools - Mouth Controller detected Mirror")
-            
-            # Middle bones 2 top
-            if settings.ms_debug:
-                print("MustardTools - Mouth Controller working on middle bones 2 top")
-            
-            #  Location constraint
-            bone = settings.mouth_controller_middle2_bone_L_top
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-                constr.name = mouth_controller_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-            constr.target = armature_controller
-            constr.subtarget = controller_bone
-            constr.use_motion_extrapolate = True
-            constr.target_space = "LOCAL"
-            constr.owner_space = "LOCAL"
-            
-            if mhx:
-                constr.from_min_x = transform_min
-                constr.map_to_x_from = "X"
-                constr.to_min_x = -transform_min * middle2_correction_x
-                
-                constr.from_min_z = transform_min
-                constr.map_to_y_from = "Z"
-                constr.to_min_y = transform_min * middle2_correction_z
-            else:
-                constr.from_min_x = transform_min
-                constr.map_to_z_from = "X"
-                constr.to_min_z = -transform_min * middle2_correction_x
-                
-                constr.from_min_z = transform_min
-                constr.map_to_x_from = "Z"
-                constr.to_min_x = transform_min * middle2_correction_z
-            
-            if settings.mouth_controller_create_driver:
-                self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
-            
-            #  Rotation constraint
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_rot_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-                constr.name = mouth_controller_rot_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_rot_name]
-            constr.target = armature_controller
-            constr.subtarget = controller_bone
-            constr.use_motion_extrapolate = True
-            constr.target_space = "LOCAL"
-            constr.owner_space = "LOCAL"
-            
-            constr.map_from = "ROTATION"
-            
-            constr.from_min_z_rot = 90/180*3.14
-            
-            if mhx:
-                constr.map_to_z_from = "Z"
-                constr.to_min_z = -transform_min/4. * middle2_correction_z
-            else:
-                constr.map_to_y_from = "Z"
-                constr.to_min_y = transform_min/4. * middle2_correction_z
-            
-            if settings.mouth_controller_create_driver:
-                self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
-            
-            #  Lower lip Constraint
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_floor_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('LIMIT_DISTANCE')
-                constr.name = mouth_controller_floor_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_floor_name]
-            constr.target = armature
-            constr.subtarget = settings.mouth_controller_middle2_bone_L_bot
-            constr.distance = 0.008 * floor_correction
-            constr.limit_mode = "LIMITDIST_OUTSIDE"
-            if settings.mouth_controller_body_object != None:
-                constr.target_space = "CUSTOM"
-                constr.owner_space = "CUSTOM"
-                constr.space_object = settings.mouth_controller_body_object
-            
-            if settings.mouth_controller_create_driver:
-                self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
-            
-            #  Location constraint
-            if mirror:
-                bone, mirror_check = self.check_mirror(settings.mouth_controller_middle2_bone_L_top)
-                
-                if not mirror_check:
-                    self.report({'ERROR'}, 'MustardTools - Bones are not correctly named for Mirror option.')
-                    return {'FINISHED'}
-            else:
-                bone = settings.mouth_controller_middle2_bone_R_top
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-                constr.name = mouth_controller_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-            constr.target = armature_controller
-            constr.subtarget = controller_bone
-            constr.use_motion_extrapolate = True
-            constr.target_space = "LOCAL"
-            constr.owner_space = "LOCAL"
+        settings = bpy.context.scene.mustardtools_settings
+        armature = settings.mouth_controller_armature
+        
+        bone_names = None
+        if bpy.context.selected_pose_bones != None and len(bpy.context.selected_pose_bones) >= 5:
+            bone_names = set(bone.name for bone in bpy.context.selected_pose_bones if bone.id_data == armature)
+        
+        start_time = time.time()
+        bones, number_bones = mustardtools_mouth_controller_classify(armature, settings.mouth_controller_jaw_bone, bone_names, self.radius)
+        
+        if bones == None:
+            self.report({'ERROR'}, number_bones)
+            return {'FINISHED'}
+        
+        for prop, bone in bones.items():
+            setattr(settings, prop, bone)
+        settings.mouth_controller_number_bones = number_bones
+        settings.mouth_controller_mirror = mustardtools_mouth_controller_bones_mirror(armature, bones)
+        
+        if settings.ms_debug:
+            for prop, bone in bones.items():
+                print("MustardTools Mouth Controller - " + prop + ": " + bone)
+        
+        self.report({'INFO'}, 'MustardTools - ' + str(len(bones)) + ' bones classified in ' + "{:.2f}".format((time.time() - start_time) * 1000.) + ' ms.')
+        
+        return {'FINISHED'}
+
+# ------------------------------------------------------------------------
+#    Merge Images To Grayscale
+# ------------------------------------------------------------------------
+
+# Read the pixels of an image in a float32 array with shape (height, width, channels).
+# The pixels are copied once from the image buffer, and the array is a view on them
+def mustardtools_image_pixels(image):
+    
+    width, height = image.size
+    pixels = np.empty(width * height * image.channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    
+    return pixels.reshape(height, width, image.channels)
+
+# Kernels of the resampling filters, with their support (in pixels of the source image, when upscaling)
+mustardtools_resample_filters = {
+    "AREA": (lambda x: ((x >= -0.5) & (x < 0.5)).astype(np.float64), 0.5),
+    "BILINEAR": (lambda x: np.maximum(0., 1. - np.abs(x)), 1.),
+    "LANCZOS": (lambda x: np.where(np.abs(x) < 3., np.sinc(x) * np.sinc(x / 3.), 0.), 3.),
+}
+
+# Number of rows of the destination image resampled at the same time, to bound the memory used on large images
+mustardtools_resample_strip = 256
+
+# Compute the weights to resample an axis from size_in to size_out pixels.
+# When downscaling, the Area filter uses the exact coverage of the source pixels, while the other
+# filters are stretched by the scale factor.
+# Returns the indices of the source pixels and their weights, with shape (size_out, taps)
+def mustardtools_resample_weights(size_in, size_out, filter):
+    
+    scale = size_in / size_out
+    
+    if filter == "AREA" and scale > 1.:
+        start = np.arange(size_out) * scale
+        indices = np.floor(start).astype(np.int64)[:, None] + np.arange(int(np.ceil(scale)) + 1)[None, :]
+        weights = np.clip(np.minimum(indices + 1, start[:, None] + scale) - np.maximum(indices, start[:, None]), 0., None)
+    
+    else:
+        kernel, support = mustardtools_resample_filters["BILINEAR" if filter == "AREA" else filter]
+        filter_scale = max(scale, 1.)
+        centers = (np.arange(size_out) + 0.5) * scale - 0.5
+        taps = 2 * int(np.ceil(support * filter_scale)) + 1
+        indices = np.floor(centers - support * filter_scale).astype(np.int64)[:, None] + np.arange(taps)[None, :]
+        weights = kernel((indices - centers[:, None]) / filter_scale)
+    
+    weights /= np.maximum(weights.sum(axis=1, keepdims=True), 1e-12)
+    
+    return np.clip(indices, 0, size_in - 1), weights.astype(np.float32)
+
+# Resample a channel (array with shape (height, width)) to a new width and height, with separable filters.
+# The rows of the result are computed in strips, so that the temporary arrays are bounded by the size of a strip
+# (the whole image is resampled at once if strip is None). The result is written in out, if given
+def mustardtools_resample(source, width, height, filter="AREA", strip=mustardtools_resample_strip, out=None):
+    
+    if source.shape == (height, width):
+        return source
+    
+    rows_indices, rows_weights = mustardtools_resample_weights(source.shape[0], height, filter)
+    cols_indices, cols_weights = mustardtools_resample_weights(source.shape[1], width, filter)
+    
+    if strip == None:
+        strip = height
+    
+    result = np.empty((height, width), dtype=np.float32) if out is None else out
+    for r in range(0, height, strip):
+        
+        rows = slice(r, min(r + strip, height))
+        
+        # Vertical pass, on the source rows needed by the strip
+        vertical = np.zeros((rows.stop - rows.start, source.shape[1]), dtype=np.float32)
+        for t in range(rows_indices.shape[1]):
+            vertical += source[rows_indices[rows, t]] * rows_weights[rows, t, None]
+        
+        # Horizontal pass
+        horizontal = result[rows]
+        horizontal[:] = 0.
+        for t in range(cols_indices.shape[1]):
+            horizontal += vertical[:, cols_indices[:, t]] * cols_weights[None, :, t]
+    
+    # Lanczos can overshoot near edges
+    if filter == "LANCZOS":
+        np.clip(result, 0., 1., out=result)
+    
+    return result
+
+# Compare the resampling strategies on a random image, measuring the throughput (in megapixels of the source
+# per second) and the peak memory allocated by the resampling (traced with tracemalloc, which includes NumPy).
+# OpenCV is included if available (its memory is not traced).
+# Returns the results, one for each strategy
+def mustardtools_resample_benchmark(size=8192, target=2048):
+    
+    import tracemalloc
+    
+    source = np.random.default_rng(0).random((size, size), dtype=np.float32)
+    
+    strategies = []
+    for filter in mustardtools_resample_filters.keys():
+        strategies.append((filter + " full", lambda filter=filter: mustardtools_resample(source, target, target, filter, None)))
+        strategies.append((filter + " strips", lambda filter=filter: mustardtools_resample(source, target, target, filter)))
+    try:
+        import cv2
+        strategies.append(("OpenCV AREA", lambda: cv2.resize(source, (target, target), interpolation=cv2.INTER_AREA)))
+        strategies.append(("OpenCV LANCZOS", lambda: cv2.resize(source, (target, target), interpolation=cv2.INTER_LANCZOS4)))
+    except ImportError:
+        pass
+    
+    results = []
+    for name, function in strategies:
+        
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start_time
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        
+        results.append({"strategy": name, "megapixels_per_second": size * size / 1e6 / elapsed, "peak_mb": peak / 1048576.})
+    
+    return results
+
+# Find the size of the packed image from the sizes (width, height) of the images, with the Resolution setting.
+# Returns the width and the height
+def mustardtools_merge_images_size(sizes, settings):
+    
+    resolution = settings.merge_images_to_grayscale_resolution
+    
+    if resolution == "EXPLICIT":
+        return settings.merge_images_to_grayscale_width, settings.merge_images_to_grayscale_height
+    
+    widths = [size[0] for size in sizes]
+    heights = [size[1] for size in sizes]
+    
+    if resolution == "MIN":
+        return min(widths), min(heights)
+    elif resolution == "POWER_OF_TWO":
+        return tuple(2 ** int(round(math.log2(max(max(sizes), 1)))) for sizes in [widths, heights])
+    
+    return max(widths), max(heights)
+
+# Create the definition of a channel of the packed image.
+# The channel is taken from a channel (0 to 3 for R, G, B and A) of the image of the node, or filled with the value if
+# the node is not set. The values can be inverted, and then remapped in the (min, max) range
+def mustardtools_merge_images_channel(node=None, channel=0, value=0., invert=False, remap=(0., 1.)):
+    
+    return {"node": node, "image": node.image if node != None else None, "channel": channel,
+            "value": value, "invert": invert, "remap": tuple(remap)}
+
+# Read the channels of the images of the channels definitions, to be packed with mustardtools_pack_channels.
+# Every image is read only once, even if more channels are taken from it, and only the channels used are kept in memory.
+# If the size (width, height) is given, the channels are resampled to it with the filter, otherwise the images should have the same size.
+# With resample disabled, the channels are kept at the size of their images, to be resampled later by mustardtools_pack_resampled.
+# Returns the channels (an array, or the value for constant channels), or None and the error message
+def mustardtools_pack_sources(channels, size=None, filter="AREA", resample=True):
+    
+    sources = [channel["value"] for channel in channels]
+    
+    images = {}
+    for c, channel in enumerate(channels):
+        if channel["image"] != None:
+            images.setdefault(channel["image"].name, (channel["image"], []))[1].append(c)
+    
+    if len(images) == 0:
+        return None, 'MustardTools - At least one channel should be taken from an image.'
+    
+    shape = None
+    for image, indices in images.values():
+        
+        if image.size[0] == 0 or image.size[1] == 0:
+            return None, 'MustardTools - Image ' + image.name + ' can not be loaded.'
+        
+        pixels = mustardtools_image_pixels(image)
+        
+        if shape == None:
+            shape = pixels.shape[:2]
+        elif pixels.shape[:2] != shape and size == None:
+            return None, 'MustardTools - Images with different sizes can not be merged.'
+        
+        for c in indices:
+            if channels[c]["channel"] >= pixels.shape[2]:
+                return None, 'MustardTools - Image ' + image.name + ' has only ' + str(pixels.shape[2]) + ' channels.'
+            sources[c] = np.ascontiguousarray(pixels[:, :, channels[c]["channel"]])
+        
+        del pixels
+        
+        if size != None and resample:
+            for c in indices:
+                sources[c] = mustardtools_resample(sources[c], size[0], size[1], filter)
+    
+    return sources, ""
+
+# Pack the channels in a RGBA array (with alpha set to 1 if only 3 channels are given),
+# applying the inversion and the remap of the channels definitions in place.
+# Only NumPy is used, so that the channels can be packed outside of the main thread
+def mustardtools_pack_channels(sources, channels):
+    
+    shape = next(source.shape for source in sources if isinstance(source, np.ndarray))
+    
+    packed = np.ones((shape[0], shape[1], 4), dtype=np.float32)
+    for c, (source, channel) in enumerate(zip(sources, channels)):
+        
+        view = packed[:, :, c]
+        view[:] = source
+        
+        if channel["invert"]:
+            np.subtract(1., view, out=view)
+        remap_min, remap_max = channel["remap"]
+        if remap_min != 0. or remap_max != 1.:
+            view *= remap_max - remap_min
+            view += remap_min
+    
+    return packed
+
+# Resample the channels read by mustardtools_pack_sources to the size (width, height), and pack them.
+# As for mustardtools_pack_channels, only NumPy is used, so that the resampling can also run outside of the main thread
+def mustardtools_pack_resampled(sources, channels, size, filter="AREA"):
+    
+    sources = [mustardtools_resample(source, size[0], size[1], filter) if isinstance(source, np.ndarray) else source for source in sources]
+    
+    return mustardtools_pack_channels(sources, channels)
+
+# Create a new Non-Color image with the pixels of a RGBA array.
+# With alpha, the alpha channel is used as a data channel (Channel Packed alpha mode)
+def mustardtools_image_new(name, pixels, alpha=False):
+    
+    height, width = pixels.shape[:2]
+    image = bpy.data.images.new(name, width, height, alpha=alpha)
+    image.colorspace_settings.name = 'Non-Color'
+    if alpha:
+        image.alpha_mode = 'CHANNEL_PACKED'
+    image.pixels.foreach_set(pixels.ravel())
+    image.update()
+    
+    return image
+
+# Pack the channels of the images in a new image, without reading or writing files.
+# The new image has alpha only if 4 channels are given.
+# Returns the new image, or None and the error message
+def mustardtools_pack_images(channels, name, size=None, filter="AREA"):
+    
+    sources, message = mustardtools_pack_sources(channels, size, filter)
+    if sources == None:
+        return None, message
+    
+    return mustardtools_image_new(name, mustardtools_pack_channels(sources, channels), len(channels) == 4), ""
+
+# Save an image in a PNG file, creating the folder if needed
+def mustardtools_save_image(image, filepath):
+    
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    
+    image.filepath_raw = filepath
+    image.file_format = 'PNG'
+    image.save()
+
+# Find the file of an image which can be read directly, without loading the image in Blender.
+# Returns the absolute path, or None for packed, generated, modified and missing images
+def mustardtools_image_file(image):
+    
+    if image.source != 'FILE' or image.packed_file != None or image.is_dirty:
+        return None
+    
+    filepath = bpy.path.abspath(image.filepath, library=image.library)
+    
+    return filepath if os.path.isfile(filepath) else None
+
+# Find the channel to read from pixels with n channels for a channel (0 to 3 for R, G, B and A), as Blender does
+# when it loads an image: the gray of grayscale images is copied in R, G and B, and the alpha is 1 if missing.
+# Returns the index of the channel, or None for a missing alpha
+def mustardtools_pixels_channel(n, channel):
+    
+    if channel < 3:
+        return channel if n >= 3 else 0
+    
+    return 3 if n == 4 else (1 if n == 2 else None)
+
+# Import OpenImageIO (available in recent Blender versions), used to read and write the images in strips.
+# Returns the module, or None if not available
+def mustardtools_import_oiio():
+    
+    try:
+        import OpenImageIO
+        return OpenImageIO
+    except ImportError:
+        return None
+
+# Pack the channels of the images in strips of rows, writing the new image in a PNG file.
+# The sources are read in strips with OpenImageIO into scratch files mapped in memory (.npy), and the new image is written
+# in strips, so that the memory used is bounded to a few strips regardless of the size of the images.
+# Without OpenImageIO, or for images without a file, the pixels are copied from Blender into the scratch files, and
+# the new image is created in Blender from a scratch file.
+# The size of the new image is found with the size function from the sizes (width, height) of the images, if given
+# (otherwise the images should have the same size). The channels missing in the files are filled as Blender does.
+# Returns the new image (loaded from the file), or None and the error message
+def mustardtools_pack_images_streaming(channels, filepath, size_function=None, filter="AREA", strip=512):
+    
+    import tempfile
+    
+    oiio = mustardtools_import_oiio()
+    
+    images = {}
+    for c, channel in enumerate(channels):
+        if channel["image"] != None:
+            images.setdefault(channel["image"].name, (channel["image"], []))[1].append(c)
+    
+    if len(images) == 0:
+        return None, 'MustardTools - At least one channel should be taken from an image.'
+    
+    # Shapes of the images, read from the files if possible, to not load the images in Blender
+    inputs = {}
+    shapes = {}
+    message = ""
+    for name, (image, indices) in images.items():
+        
+        image_file = mustardtools_image_file(image) if oiio != None else None
+        inputs[name] = oiio.ImageInput.open(image_file) if image_file != None else None
+        
+        if inputs[name] != None:
+            spec = inputs[name].spec()
+            shapes[name] = (spec.height, spec.width, spec.nchannels)
+        elif image.size[0] == 0 or image.size[1] == 0:
+            message = 'MustardTools - Image ' + image.name + ' can not be loaded.'
+            break
+        else:
+            shapes[name] = (image.size[1], image.size[0], image.channels)
+    
+    if message == "" and all(mustardtools_pixels_channel(shapes[name][2], channels[c]["channel"]) == None for name, (image, indices) in images.items() for c in indices):
+        message = 'MustardTools - At least one channel should be taken from an image, the alpha of images without alpha is constant.'
+    elif message == "" and size_function == None and len(set(shape[:2] for shape in shapes.values())) > 1:
+        message = 'MustardTools - Images with different sizes can not be merged.'
+    
+    if message != "":
+        for image_input in inputs.values():
+            if image_input != None:
+                image_input.close()
+        return None, message
+    
+    if size_function != None:
+        width, height = size_function([(shape[1], shape[0]) for shape in shapes.values()])
+    else:
+        height, width = next(iter(shapes.values()))[:2]
+    
+    strips = list(range(0, height, strip))
+    wm = bpy.context.window_manager
+    wm.progress_begin(0, len(images) + len(strips))
+    output = None
+    
+    with tempfile.TemporaryDirectory() as scratch:
+        try:
             
-            if mhx:
-                constr.from_min_x = transform_min
-                constr.map_to_x_from = "X"
-                constr.to_min_x = transform_min * middle2_correction_x
+            # Read the sources in scratch files, with the rows from the bottom as in Blender
+            sources = [channel["value"] for channel in channels]
+            for i, (name, (image, indices)) in enumerate(images.items()):
                 
-                constr.from_min_z = transform_min
-                constr.map_to_y_from = "Z"
-                constr.to_min_y = transform_min * middle2_correction_z
-            else:
-                constr.from_min_x = transform_min
-                constr.map_to_z_from = "X"
-                constr.to_min_z = transform_min * middle2_correction_x
+                h, w, n = shapes[name]
                 
-                constr.from_min_z = transform_min
-                constr.map_to_x_from = "Z"
-                constr.to_min_x = -transform_min * middle2_correction_z
-            
-            if settings.mouth_controller_create_driver:
-                self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
-            
-            #  Rotation constraint
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_rot_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-                constr.name = mouth_controller_rot_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_rot_name]
-            constr.target = armature_controller
-            constr.subtarget = controller_bone
-            constr.use_motion_extrapolate = True
-            constr.target_space = "LOCAL"
-            constr.owner_space = "LOCAL"
-            
-            constr.map_from = "ROTATION"
-            
-            constr.from_min_z_rot = 90/180*3.14
-            
-            if mhx:
-                constr.map_to_z_from = "Z"
-                constr.to_min_z = -transform_min/4. * middle2_correction_z
-            else:
-                constr.map_to_y_from = "Z"
-                constr.to_min_y = transform_min/4. * middle2_correction_z
-            
-            if settings.mouth_controller_create_driver:
-                self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
-            
-            #  Lower lip Constraint
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_floor_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('LIMIT_DISTANCE')
-                constr.name = mouth_controller_floor_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_floor_name]
-            constr.target = armature
-            if mirror:
-                constr_subtarget, mirror_check = self.check_mirror(settings.mouth_controller_middle2_bone_L_bot)
+                # Missing channels are filled as in Blender, a missing alpha with a constant
+                reads = {}
+                for c in indices:
+                    reads[c] = mustardtools_pixels_channel(n, channels[c]["channel"])
+                    if reads[c] == None:
+                        sources[c] = 1.
+                        del reads[c]
                 
-                if not mirror_check:
-                    self.report({'ERROR'}, 'MustardTools - Bones are not correctly named for Mirror option.')
-                    return {'FINISHED'}
+                if inputs[name] != None:
+                    for c in reads.keys():
+                        sources[c] = np.lib.format.open_memmap(os.path.join(scratch, str(c) + ".npy"), mode='w+', dtype=np.float32, shape=(h, w))
+                    for y in range(0, h, strip):
+                        y_end = min(y + strip, h)
+                        rows = inputs[name].read_scanlines(0, 0, y, y_end, 0, 0, n, oiio.FLOAT).reshape(y_end - y, w, n)
+                        for c, index in reads.items():
+                            sources[c][h-y_end:h-y] = rows[::-1, :, index]
+                    inputs[name].close()
+                    inputs[name] = None
                 
-                constr.subtarget = constr_subtarget
-            else:
-                constr.subtarget = settings.mouth_controller_middle2_bone_R_bot
-            constr.distance = 0.008 * floor_correction
-            constr.limit_mode = "LIMITDIST_OUTSIDE"
-            if settings.mouth_controller_body_object != None:
-                constr.target_space = "CUSTOM"
-                constr.owner_space = "CUSTOM"
-                constr.space_object = settings.mouth_controller_body_object
-            
-            if settings.mouth_controller_create_driver:
-                self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
-            
-            
-            # Middle bones 2 bottom
-            if settings.ms_debug:
-                print("MustardTools - Mouth Controller working on middle bones 2 bottom")
-            
-            bone = settings.mouth_controller_middle2_bone_L_bot
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-                constr.name = mouth_controller_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-            constr.target = armature_controller
-            constr.subtarget = controller_bone
-            constr.use_motion_extrapolate = True
-            constr.target_space = "LOCAL"
-            constr.owner_space = "LOCAL"
-            
-            if mhx:
-                constr.from_min_x = transform_min
-                constr.map_to_x_from = "X"
-                constr.to_min_x = -transform_min * middle2_correction_x
+                else:
+                    pixels = np.lib.format.open_memmap(os.path.join(scratch, "image" + str(i) + ".npy"), mode='w+', dtype=np.float32, shape=(h, w, n))
+                    image.pixels.foreach_get(pixels.reshape(-1))
+                    for c, index in reads.items():
+                        sources[c] = pixels[:, :, index]
                 
-                constr.from_min_z = transform_min
-                constr.map_to_y_from = "Z"
-                constr.to_min_y = transform_min * middle2_correction_z
-            else:
-                constr.from_min_x = transform_min
-                constr.map_to_z_from = "X"
-                constr.to_min_z = -transform_min * middle2_correction_x
+                # Resample in other scratch files
+                for c in reads.keys():
+                    if (h, w) != (height, width):
+                        resampled = np.lib.format.open_memmap(os.path.join(scratch, str(c) + "_resampled.npy"), mode='w+', dtype=np.float32, shape=(height, width))
+                        sources[c] = mustardtools_resample(sources[c], width, height, filter, strip, resampled)
                 
-                constr.from_min_z = transform_min
-                constr.map_to_x_from = "Z"
-                constr.to_min_x = transform_min * middle2_correction_z
-            
-            if settings.mouth_controller_create_driver:
-                self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
-            
-            #  Rotation constraint
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_rot_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-                constr.name = mouth_controller_rot_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_rot_name]
-            constr.target = armature_controller
-            constr.subtarget = controller_bone
-            constr.use_motion_extrapolate = True
-            constr.target_space = "LOCAL"
-            constr.owner_space = "LOCAL"
+                wm.progress_update(i)
             
-            constr.map_from = "ROTATION"
+            # Pack and write the strips, from the top as in the image files
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            alpha = len(channels) == 4
             
-            constr.from_min_z_rot = 90/180*3.14
-            
-            if mhx:
-                constr.map_to_z_from = "Z"
-                constr.to_min_z = -transform_min/4. * middle2_correction_z
+            if oiio != None:
+                output = oiio.ImageOutput.create(filepath)
+                if output == None or not output.open(filepath, oiio.ImageSpec(width, height, 4 if alpha else 3, oiio.UINT8)):
+                    return None, 'MustardTools - Can not write ' + filepath + ': ' + (oiio.geterror() if output == None else output.geterror())
             else:
-                constr.map_to_y_from = "Z"
-                constr.to_min_y = transform_min/4. * middle2_correction_z
-            
-            if settings.mouth_controller_create_driver:
-                self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+                packed_file = np.lib.format.open_memmap(os.path.join(scratch, "packed.npy"), mode='w+', dtype=np.float32, shape=(height, width, 4))
             
-            if mirror:
-                bone, mirror_check = self.check_mirror(settings.mouth_controller_middle2_bone_L_bot)
+            for i, y in enumerate(reversed(strips)):
                 
-                if not mirror_check:
-                    self.report({'ERROR'}, 'MustardTools - Bones are not correctly named for Mirror option.')
-                    return {'FINISHED'}
-            else:
-                bone = settings.mouth_controller_middle2_bone_R_bot
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-                constr.name = mouth_controller_name
-            else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_name]
-            constr.target = armature_controller
-            constr.subtarget = controller_bone
-            constr.use_motion_extrapolate = True
-            constr.target_space = "LOCAL"
-            constr.owner_space = "LOCAL"
-            
-            if mhx:
-                constr.from_min_x = transform_min
-                constr.map_to_x_from = "X"
-                constr.to_min_x = transform_min * middle2_correction_x
+                y_end = min(y + strip, height)
+                packed = mustardtools_pack_channels([source[y:y_end] if isinstance(source, np.ndarray) else source for source in sources], channels)
                 
-                constr.from_min_z = transform_min
-                constr.map_to_y_from = "Z"
-                constr.to_min_y = transform_min * middle2_correction_z
-            else:
-                constr.from_min_x = transform_min
-                constr.map_to_z_from = "X"
-                constr.to_min_z = transform_min * middle2_correction_x
+                if oiio != None:
+                    output.write_scanlines(height-y_end, height-y, 0, np.ascontiguousarray(packed[::-1, :, :4 if alpha else 3]))
+                else:
+                    packed_file[y:y_end] = packed
                 
-                constr.from_min_z = transform_min
-                constr.map_to_x_from = "Z"
-                constr.to_min_x = -transform_min * middle2_correction_z
+                wm.progress_update(len(images) + i)
             
-            if settings.mouth_controller_create_driver:
-                self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
-            
-            #  Rotation constraint
-            if len([m for m in armature.pose.bones[bone].constraints if m.name == mouth_controller_rot_name])<1:
-                constr = armature.pose.bones[bone].constraints.new('TRANSFORM')
-                constr.name = mouth_controller_rot_name
+            if oiio != None:
+                output.close()
+                output = None
+                packed_image = bpy.data.images.load(filepath)
+                packed_image.colorspace_settings.name = 'Non-Color'
+                if alpha:
+                    packed_image.alpha_mode = 'CHANNEL_PACKED'
             else:
-                constr = armature.pose.bones[bone].constraints[mouth_controller_rot_name]
-            constr.target = armature_controller
-            constr.subtarget = controller_bone
-            constr.use_motion_extrapolate = True
-            constr.target_space = "LOCAL"
-            constr.owner_space = "LOCAL"
-            
-            constr.map_from = "ROTATION"
+                packed_image = mustardtools_image_new(os.path.basename(filepath), packed_file, alpha)
+                mustardtools_save_image(packed_image, filepath)
             
-            constr.from_min_z_rot = 90/180*3.14
-            
-            if mhx:
-                constr.map_to_z_from = "Z"
-                constr.to_min_z = -transform_min/4. * middle2_correction_z
-            else:
-                constr.map_to_y_from = "Z"
-                constr.to_min_y = transform_min/4. * middle2_correction_z
+        finally:
             
-            if settings.mouth_controller_create_driver:
-                self.add_driver(armature, constr, 'mute', mouth_controller_driver_name)
+            # Close the files, and the scratch files before removing them
+            for image_input in inputs.values():
+                if image_input != None:
+                    image_input.close()
+            if output != None:
+                output.close()
+            sources = packed = packed_file = pixels = resampled = None
             
-        # Controller bone limits
-        if settings.ms_debug:
-            print("MustardTools - Mouth Controller adding bone limits")
-        
-        bone = controller_bone
-        if len([m for m in armature_controller.pose.bones[bone].constraints if m.name == mouth_controller_name])<1:
-            constr = armature_controller.pose.bones[bone].constraints.new('LIMIT_LOCATION')
-            constr.name = mouth_controller_name
-        else:
-            constr = armature_controller.pose.bones[bone].constraints[mouth_controller_name]
-        constr.owner_space = "LOCAL"
-        
-        constr.use_max_x = True
-        constr.max_x = transform_min/10
-        constr.use_min_x = True
-        constr.min_x = -transform_min/15
-        
-        constr.use_max_y = True
-        constr.max_y = transform_min/20
-        constr.use_min_y = True
-        constr.min_y = -transform_min/5
-        
-        constr.use_max_z = True
-        constr.max_z = transform_min/15
-        constr.use_min_z = True
-        constr.min_z = -transform_min/15
+            wm.progress_end()
+    
+    return packed_image, ""
+
+# Find the links of the consumers of a channel of an image node.
+# The consumers of the alpha are linked to the Alpha output. The consumers of a color channel are linked to the
+# output of a Separate Color node, or directly to the Color output (only for the first channel taken from the node)
+def mustardtools_merge_images_channel_links(node, channel, first):
+    
+    if channel == 3:
+        return list(node.outputs["Alpha"].links)
+    
+    channel_links = []
+    for link in node.outputs["Color"].links:
+        if link.to_node.type in ['SEPARATE_COLOR', 'SEPRGB']:
+            channel_links += list(link.to_node.outputs[channel].links)
+        elif first:
+            channel_links.append(link)
+    
+    return channel_links
+
+# Substitute the image nodes of a node tree with a node of the packed image and a Separate Color node.
+# The consumers of every channel are linked to the new outputs (through a Map Range node restoring the original values,
+# if the channel has been inverted or remapped). The old nodes are removed if they are not used anymore
+def mustardtools_merge_images_substitute(node_tree, channels, packed_image):
+    
+    nodes = node_tree.nodes
+    links = node_tree.links
+    
+    used_nodes = []
+    for channel in channels:
+        if channel["node"] != None and channel["node"] not in used_nodes:
+            used_nodes.append(channel["node"])
+    
+    # Create new node
+    img_node = nodes.new('ShaderNodeTexImage')
+    img_node.location = (sum(n.location[0] for n in used_nodes) / len(used_nodes),
+                         sum(n.location[1] for n in used_nodes) / len(used_nodes))
+    img_node.image = packed_image
+    
+    # Create Separate RGB node
+    sep_node = nodes.new('ShaderNodeSeparateColor')
+    sep_node.location = (img_node.location[0] + 300, img_node.location[1])
+    
+    # Create link to new image to Separate RGB node
+    links.new(img_node.outputs["Color"], sep_node.inputs["Color"])
+    
+    # Restore old nodes links
+    first_nodes = set()
+    for c, channel in enumerate(channels):
+        
+        if channel["node"] == None:
+            continue
+        
+        channel_links = mustardtools_merge_images_channel_links(channel["node"], channel["channel"], channel["node"].name not in first_nodes)
+        if channel["channel"] != 3:
+            first_nodes.add(channel["node"].name)
+        if len(channel_links) == 0:
+            continue
+        
+        output = img_node.outputs["Alpha"] if c == 3 else sep_node.outputs[c]
+        
+        remap_min, remap_max = channel["remap"]
+        if channel["invert"] or ((remap_min != 0. or remap_max != 1.) and remap_min != remap_max):
+            map_node = nodes.new('ShaderNodeMapRange')
+            map_node.location = (sep_node.location[0] + 200, sep_node.location[1] - 250 * c)
+            map_node.inputs["From Min"].default_value = remap_min
+            map_node.inputs["From Max"].default_value = remap_max
+            map_node.inputs["To Min"].default_value = 1. if channel["invert"] else 0.
+            map_node.inputs["To Max"].default_value = 0. if channel["invert"] else 1.
+            links.new(output, map_node.inputs[0])
+            output = map_node.outputs[0]
+        
+        for link in channel_links:
+            links.new(output, link.to_socket)
+    
+    # Remove old nodes, with their Separate Color nodes
+    for n in used_nodes:
+        for link in list(n.outputs["Color"].links):
+            if link.to_node.type in ['SEPARATE_COLOR', 'SEPRGB'] and not any(output.is_linked for output in link.to_node.outputs):
+                nodes.remove(link.to_node)
+        if not any(output.is_linked for output in n.outputs):
+            nodes.remove(n)
+
+# Find the channels definitions of the Custom layout of the settings, with the image nodes of a node tree.
+# Returns the channels definitions (4 if alpha is used), or None and the error message
+def mustardtools_merge_images_layout(node_tree, settings):
+    
+    channels = []
+    for c in ["r", "g", "b", "a"]:
         
+        layout_channel = getattr(settings, "merge_images_to_grayscale_" + c)
         
-        if len([m for m in armature_controller.pose.bones[bone].constraints if m.name == mouth_controller_rot_name])<1:
-            constr = armature_controller.pose.bones[bone].constraints.new('LIMIT_ROTATION')
-            constr.name = mouth_controller_rot_name
-        else:
-            constr = armature_controller.pose.bones[bone].constraints[mouth_controller_rot_name]
-        constr.owner_space = "LOCAL"
+        if layout_channel.source == "NONE":
+            if c == "a":
+                break
+            channels.append(mustardtools_merge_images_channel())
+            continue
         
-        constr.use_limit_x = True
-        constr.max_x = 0.
-        constr.min_x = 0.
+        node = None
+        if layout_channel.source == "IMAGE":
+            node = node_tree.nodes.get(layout_channel.node)
+            if node == None or node.type != "TEX_IMAGE" or node.image == None:
+                return None, 'MustardTools - Image node ' + layout_channel.node + ' not found, or without an image.'
         
-        constr.use_limit_y = True
-        constr.max_y = 0.
-        constr.min_y = 0.
+        channels.append(mustardtools_merge_images_channel(node, int(layout_channel.channel), layout_channel.value,
+                                                          layout_channel.invert, (layout_channel.remap_min, layout_channel.remap_max)))
+    
+    if not any(channel["image"] != None for channel in channels):
+        return None, 'MustardTools - At least one channel should be taken from an image.'
+    
+    return channels, ""
+
+# Merge the channels of image nodes of a node tree into a new image.
+# The pixels are packed in memory, and the new image is saved in the textures folder next to the .blend file
+# only if the Save to Disk option is enabled (otherwise it is packed in the .blend file).
+# Returns False and the error message if the images could not be merged
+def mustardtools_merge_images_to_grayscale(node_tree, channels, settings):
+    
+    # Choose export file name
+    sep = settings.merge_images_to_grayscale_separator
+    image_names = []
+    for channel in channels:
+        if channel["image"] != None and channel["image"].name not in image_names:
+            image_names.append(channel["image"].name)
+    if len(image_names) == 0:
+        return False, 'MustardTools - At least one channel should be taken from an image.'
+    image_name = sep.join(image_names) + ".png"
+    
+    start_time = time.time()
+    filepath = os.path.join(bpy.path.abspath("//textures"), image_name)
+    
+    if settings.merge_images_to_grayscale_streaming:
         
-        constr.use_limit_z = True
-        constr.max_z = 20/180*3.14
-        constr.min_z = -20/180*3.14
+        # Merge in strips, always writing the file
+        packed_image, message = mustardtools_pack_images_streaming(channels, filepath, lambda sizes: mustardtools_merge_images_size(sizes, settings),
+                                                                   settings.merge_images_to_grayscale_filter, settings.merge_images_to_grayscale_strip)
+        if packed_image == None:
+            return False, message
         
-        # Apply custom shape
-        controller_bone = armature_controller.pose.bones[bone]
-        controller_bone.custom_shape = settings.mouth_controller_bone_custom_shape
+        if not settings.merge_images_to_grayscale_save:
+            packed_image.pack()
+    
+    else:
         
-        self.report({'INFO'}, 'MustardTools - Mouth Controller successfully created.')
+        # Merge in memory
+        size = mustardtools_merge_images_size([tuple(channel["image"].size) for channel in channels if channel["image"] != None], settings)
+        packed_image, message = mustardtools_pack_images(channels, image_name, size, settings.merge_images_to_grayscale_filter)
+        if packed_image == None:
+            return False, message
         
-        return {'FINISHED'}
-
+        if settings.merge_images_to_grayscale_save:
+            mustardtools_save_image(packed_image, filepath)
+        else:
+            packed_image.pack()
+    
+    if settings.ms_debug:
+        print("MustardTools Merge Images - " + image_name + " (" + str(packed_image.size[0]) + "x" + str(packed_image.size[1]) + ") merged in " + "{:.2f}".format((time.time() - start_time) * 1000.) + " ms")
+    
+    if settings.merge_images_to_grayscale_substitute_nodes:
+        mustardtools_merge_images_substitute(node_tree, channels, packed_image)
+    
+    return True, 'MustardTools - Images merged.'
 
-class MUSTARDTOOLS_OT_MouthControllerClean(bpy.types.Operator):
-    """This tool will clean all setting related to a mouth controller generated by this addon.\nThe armatures which are cleaned are the ones set in the settings.\nRun the tool in Pose mode"""
-    bl_idname = "mustardui.mouth_controller_clean"
-    bl_label = "Apply"
+class MUSTARDTOOLS_OT_MergeImagesToGrayscale(bpy.types.Operator):
+    """Merge 3 images to a RGB image, or 4 images to a RGBA image.\nWith the Custom layout, the channels are taken from the images set for each channel.\nThe new image is saved to the textures folder, or packed in the .blend file"""
+    bl_idname = "mustardui.merge_images_to_grayscale"
+    bl_label = "Merge Images"
     bl_options = {'REGISTER','UNDO'}
     
     @classmethod
     def poll(cls, context):
         
         settings = bpy.context.scene.mustardtools_settings
-        armature = settings.mouth_controller_armature
-        armature_controller = settings.mouth_controller_armature_controller
-        bone_controller = settings.mouth_controller_bone
         
-        if context.mode != "POSE" or armature == None or armature_controller == None or bone_controller == "":
+        if bpy.context.active_object == None or bpy.context.active_object.active_material == None:
             return False
-        if settings.mouth_controller_mirror and (settings.mouth_controller_jaw_bone == "" and settings.mouth_controller_center_bone_top == "" or settings.mouth_controller_center_bone_bot == "" or settings.mouth_controller_edge_bone_L == "" or settings.mouth_controller_middle1_bone_L_top == "" or settings.mouth_controller_middle1_bone_L_bot == "" or  (settings.mouth_controller_number_bones > 1 and (settings.mouth_controller_middle2_bone_L_top == "" or settings.mouth_controller_middle2_bone_L_bot == ""))):
+        
+        node_tree = bpy.context.active_object.active_material.node_tree
+        if node_tree == None:
             return False
-        else:
+        
+        if settings.merge_images_to_grayscale_layout == "CUSTOM":
             return True
+        
+        # Check if the selected nodes are images
+        selected_images = []
+        for n in node_tree.nodes:
+            if n.select and n.type=="TEX_IMAGE":
+                selected_images.append(n)
+        
+        # And discard if you don't have 3 or 4
+        return len(selected_images) in [3, 4]
 
     def execute(self, context):
         
         settings = bpy.context.scene.mustardtools_settings
-        mouth_controller_name = settings.ms_naming_prefix + "_MouthControllerConstraint"
-        mouth_controller_rot_name = settings.ms_naming_prefix + "_MouthControllerConstraintRot"
-        mouth_controller_floor_name = settings.ms_naming_prefix + "_MouthControllerFloor"
         
-        armature = settings.mouth_controller_armature
-        armature_controller = settings.mouth_controller_armature_controller
-        controller_bone = settings.mouth_controller_bone
-        
-        removed_constr = 0
-        for bone in armature.pose.bones:
-            for constr in bone.constraints:
-                if constr.name == mouth_controller_name or constr.name == mouth_controller_rot_name or constr.name == mouth_controller_floor_name:
-                    if settings.ms_debug:
-                        print("MustardTools Mouth Controller - Constraint "+constr.name+" removed from "+bone.name)
-                    bone.constraints.remove(constr)
-                    removed_constr = removed_constr + 1
-        
-        controller_bone = armature_controller.pose.bones[controller_bone]
-        controller_bone.custom_shape = None
+        # Check active material on active object
+        node_tree = bpy.context.active_object.active_material.node_tree
         
-        mouth_controller_driver_name = "Mouth Controller Mute"
-        if hasattr(armature, '["' + mouth_controller_driver_name + '"]'):
-            del armature[mouth_controller_driver_name]
+        if settings.merge_images_to_grayscale_layout == "CUSTOM":
+            channels, message = mustardtools_merge_images_layout(node_tree, settings)
+            if channels == None:
+                self.report({'ERROR'}, message)
+                return {'FINISHED'}
         
-        self.report({'INFO'}, 'MustardTools - '+ str(removed_constr) +' constraints successfully removed.')
+        else:
+            # Check if the selected nodes are images
+            channels = []
+            for n in node_tree.nodes:
+                if n.select and n.type=="TEX_IMAGE":
+                    if n.image == None:
+                        self.report({'ERROR'}, 'MustardTools - Image node ' + n.name + ' has no image.')
+                        return {'FINISHED'}
+                    channels.append(mustardtools_merge_images_channel(n))
+        
+        res, message = mustardtools_merge_images_to_grayscale(node_tree, channels, settings)
+        
+        if res:
+            self.report({'INFO'}, message)
+        else:
+            self.report({'ERROR'}, message)
         
         return {'FINISHED'}
 
-class MUSTARDTOOLS_OT_MouthControllerSmartSearch(bpy.types.Operator):
-    """This tool will search for standard names of the lips bones.\nRun the tool in Pose mode"""
-    bl_idname = "mustardui.mouth_controller_search"
-    bl_label = "Search"
-    bl_options = {'REGISTER','UNDO'}
+# Roles of the images merged by the batch tool, in the order of the RGB channels (the glTF occlusion, roughness, metallic layout).
+# Every role has the Principled BSDF inputs fed by its images, and the pattern of its image names
+mustardtools_merge_images_roles = [
+    ("Ambient Occlusion", [], re.compile(r"(?<![a-z])ao(?![a-z])|occlusion")),
+    ("Roughness", ["Roughness"], re.compile(r"rough|(?<![a-z])rgh(?![a-z])")),
+    ("Metallic", ["Metallic"], re.compile(r"metal|(?<![a-z])mtl(?![a-z])")),
+]
+
+# Find the Principled BSDF inputs fed by a node, following the links through at most depth nodes
+def mustardtools_merge_images_bsdf_inputs(node, depth=3):
     
-    @classmethod
-    def poll(cls, context):
+    inputs = set()
+    for output in node.outputs:
+        for link in output.links:
+            if link.to_node.type == 'BSDF_PRINCIPLED':
+                inputs.add(link.to_socket.name)
+            elif depth > 1:
+                inputs |= mustardtools_merge_images_bsdf_inputs(link.to_node, depth-1)
+    
+    return inputs
+
+# Find the image nodes of a node tree to merge, one for each role.
+# The role of an image node is found from the Principled BSDF inputs it feeds, or from the name of its image.
+# Returns the nodes ordered as the roles, or None if a role is missing or ambiguous
+def mustardtools_merge_images_find(node_tree):
+    
+    found = [[] for role in mustardtools_merge_images_roles]
+    for node in node_tree.nodes:
         
-        settings = bpy.context.scene.mustardtools_settings
-        armature = settings.mouth_controller_armature
+        if node.type != 'TEX_IMAGE' or node.image == None:
+            continue
         
-        if context.mode != "POSE" or armature == None:
-            return False
-        else:
-            return True
-
-    def execute(self, context):
+        inputs = mustardtools_merge_images_bsdf_inputs(node)
+        roles = [i for i, (role, sockets, pattern) in enumerate(mustardtools_merge_images_roles) if any(socket in inputs for socket in sockets)]
+        if len(roles) == 0:
+            name = node.image.name.lower()
+            roles = [i for i, (role, sockets, pattern) in enumerate(mustardtools_merge_images_roles) if pattern.search(name)]
         
-        settings = bpy.context.scene.mustardtools_settings
-        armature = settings.mouth_controller_armature
+        if len(roles) == 1:
+            found[roles[0]].append(node)
+    
+    if any(len(nodes) != 1 for nodes in found):
+        return None
+    
+    return [nodes[0] for nodes in found]
+
+# Estimate the GPU memory used by an image (RGBA, with 4 bytes per channel for float images)
+def mustardtools_image_vram(image):
+    
+    return image.size[0] * image.size[1] * 4 * (4 if image.is_float else 1)
+
+# Merge the images of all the materials with an image for each role.
+# Triples of images shared by more materials are merged only once. The sources are read in the main thread
+# (as the Blender API is not thread safe), while the channels of the previous triples are packed in a thread pool,
+# with at most workers packed images in memory at the same time.
+# Returns the statistics with the number of merged images and materials, the skipped materials, the errors
+# and the estimated VRAM saved (in bytes)
+def mustardtools_merge_images_batch(materials, settings, workers=4):
+    
+    from concurrent.futures import ThreadPoolExecutor
+    
+    stats = {"images": 0, "materials": 0, "skipped": 0, "errors": [], "vram_saved": 0, "time": 0.}
+    start_time = time.time()
+    
+    # Group the materials by their triple of images
+    groups = {}
+    for material in materials:
         
-        convention = 0
-        for bone in armature.pose.bones:
-            if bone.name == "c_jawbone.x":
-                convention = 1 # auto-rig
-                break
-            if bone.name == "LipCorner.L":
-                convention = 2 # MHX
-                break
-            if bone.name == "LipCorner.l":
-                convention = 3 # MHX
-                break
+        if material.node_tree == None:
+            continue
         
-        if convention==1:
-            settings.mouth_controller_mirror = True
-            settings.mouth_controller_number_bones = 2
-            settings.mouth_controller_jaw_bone = "c_jawbone.x"
-            settings.mouth_controller_center_bone_top = "c_lips_top.x"
-            settings.mouth_controller_center_bone_bot = "c_lips_bot.x"
-            settings.mouth_controller_edge_bone_L = "c_lips_smile.r"
-            settings.mouth_controller_middle1_bone_L_top = "c_lips_top.l"
-            settings.mouth_controller_middle1_bone_L_bot = "c_lips_bot.l"
-            settings.mouth_controller_middle2_bone_L_top = "c_lips_top_01.r"
-            settings.mouth_controller_middle2_bone_L_bot = "c_lips_bot_01.l"
-            self.report({'INFO'}, 'MustardTools - Auto-rig convention used to fill properties.')
-            
-        if convention==2:
-            settings.mouth_controller_mirror = True
-            settings.mouth_controller_number_bones = 2
-            settings.mouth_controller_mhx = True
-            settings.mouth_controller_jaw_bone = "lowerJaw"
-            settings.mouth_controller_center_bone_top = "LipUpperMiddle"
-            settings.mouth_controller_center_bone_bot = "LipLowerMiddle"
-            settings.mouth_controller_edge_bone_L = "LipCorner.L"
-            settings.mouth_controller_middle1_bone_L_top = "LipUpperInner.L"
-            settings.mouth_controller_middle1_bone_L_bot = "LipLowerInner.L"
-            settings.mouth_controller_middle2_bone_L_top = "LipUpperOuter.L"
-            settings.mouth_controller_middle2_bone_L_bot = "LipLowerOuter.L"
-            settings.mouth_controller_edge_bone_correction_z = 0.8
-            self.report({'INFO'}, 'MustardTools - MHX convention used to fill properties.')
-        
-        if convention==3:
-            settings.mouth_controller_mirror = True
-            settings.mouth_controller_number_bones = 2
-            settings.mouth_controller_mhx = True
-            settings.mouth_controller_jaw_bone = "lowerJaw"
-            settings.mouth_controller_center_bone_top = "LipUpperMiddle"
-            settings.mouth_controller_center_bone_bot = "LipLowerMiddle"
-            settings.mouth_controller_edge_bone_L = "LipCorner.l"
-            settings.mouth_controller_middle1_bone_L_top = "LipUpperInner.l"
-            settings.mouth_controller_middle1_bone_L_bot = "LipLowerInner.l"
-            settings.mouth_controller_middle2_bone_L_top = "LipUpperOuter.l"
-            settings.mouth_controller_middle2_bone_L_bot = "LipLowerOuter.l"
-            settings.mouth_controller_edge_bone_correction_z = 0.8
-            self.report({'INFO'}, 'MustardTools - MHX convention used to fill properties.') 
+        nodes = mustardtools_merge_images_find(material.node_tree)
+        if nodes == None:
+            stats["skipped"] += 1
+            continue
         
+        key = tuple(n.image.name for n in nodes)
+        group = groups.setdefault(key, {"channels": [mustardtools_merge_images_channel(n) for n in nodes], "materials": []})
+        group["materials"].append((material, [n.name for n in nodes]))
+    
+    sep = settings.merge_images_to_grayscale_separator
+    sources_images = set()
+    packed_images = []
+    
+    # Create the image of a packed triple, and substitute the nodes of its materials
+    def finish(key, future):
+        
+        image_name = sep.join(key) + ".png"
+        try:
+            packed = future.result()
+        except Exception as e:
+            stats["errors"].append('MustardTools - Image ' + image_name + ' can not be merged: ' + str(e))
+            return
+        packed_image = mustardtools_image_new(image_name, packed)
+        del packed
+        
+        if settings.merge_images_to_grayscale_save:
+            mustardtools_save_image(packed_image, os.path.join(bpy.path.abspath("//textures"), image_name))
         else:
-            self.report({'INFO'}, 'MustardTools - No convention found. Insert bones manually.')
+            packed_image.pack()
         
+        packed_images.append(packed_image)
+        sources_images.update(channel["image"] for channel in groups[key]["channels"])
         
-        return {'FINISHED'}
-
-# ------------------------------------------------------------------------
-#    Merge Images To Grayscale
-# ------------------------------------------------------------------------
+        if settings.merge_images_to_grayscale_substitute_nodes:
+            for material, node_names in groups[key]["materials"]:
+                channels = [mustardtools_merge_images_channel(material.node_tree.nodes[name]) for name in node_names]
+                mustardtools_merge_images_substitute(material.node_tree, channels, packed_image)
+        
+        stats["images"] += 1
+        stats["materials"] += len(groups[key]["materials"])
+        
+        if settings.ms_debug:
+            print("MustardTools Merge Images - " + image_name + " merged for " + str(len(groups[key]["materials"])) + " materials")
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        
+        pending = []
+        for key, group in groups.items():
+            
+            size = mustardtools_merge_images_size([tuple(channel["image"].size) for channel in group["channels"]], settings)
+            # The pixels are read on the main thread, while the resampling and the packing run in the pool
+            sources, message = mustardtools_pack_sources(group["channels"], size, resample=False)
+            if sources == None:
+                stats["errors"].append(message)
+                continue
+            
+            pending.append((key, pool.submit(mustardtools_pack_resampled, sources, group["channels"], size, settings.merge_images_to_grayscale_filter)))
+            del sources
+            
+            if len(pending) >= workers:
+                finish(*pending.pop(0))
+        
+        for key, future in pending:
+            finish(key, future)
+    
+    # Only the sources which are not used anymore free memory on the GPU
+    if settings.merge_images_to_grayscale_substitute_nodes:
+        stats["vram_saved"] = sum(mustardtools_image_vram(image) for image in sources_images if image.users == 0) - sum(mustardtools_image_vram(image) for image in packed_images)
+    
+    stats["time"] = time.time() - start_time
+    
+    return stats
 
-class MUSTARDTOOLS_OT_MergeImagesToGrayscale(bpy.types.Operator):
-    """Merge 3 images to a grayscale image.\nThe new image is saved to the textures folder"""
-    bl_idname = "mustardui.merge_images_to_grayscale"
-    bl_label = "Merge Images"
+class MUSTARDTOOLS_OT_MergeImagesToGrayscale_Batch(bpy.types.Operator):
+    """Merge the ambient occlusion, roughness and metallic images of all the materials.\nThe images are found from the Principled BSDF inputs they feed, or from their names.\nImages shared by more materials are merged only once"""
+    bl_idname = "mustardui.merge_images_to_grayscale_batch"
+    bl_label = "Merge on all Materials"
     bl_options = {'REGISTER','UNDO'}
     
-    @classmethod
-    def poll(cls, context):
+    source: EnumProperty(name='Materials',
+        items=[("ALL", "All", "Merge the images of all the materials of the file"),
+               ("COLLECTION", "Active Collection", "Merge the images of the materials of the objects in the active collection")],
+        default="ALL"
+    )
+    workers: IntProperty(name='Threads',
+        description="Number of images packed at the same time",
+        default=4,
+        min=1,
+        max=32
+    )
+    
+    def execute(self, context):
         
         settings = bpy.context.scene.mustardtools_settings
         
-        if bpy.context.active_object.active_material != None:
-            active_material = bpy.context.active_object.active_material.name
+        if self.source == "COLLECTION":
+            materials = set(slot.material for obj in bpy.context.collection.all_objects for slot in obj.material_slots if slot.material != None)
         else:
-            return False
+            materials = bpy.data.materials
         
-        nodes = bpy.data.materials[active_material].node_tree.nodes
-        links = bpy.data.materials[active_material].node_tree.links
+        stats = mustardtools_merge_images_batch(materials, settings, self.workers)
         
-        # Check if the selected nodes are images
-        selected_images = []
-        for n in nodes:
-            if n.select and n.type=="TEX_IMAGE":
-                selected_images.append(n)
+        for error in stats["errors"]:
+            print(error)
         
-        # And discard if you don't have 3
-        if len(selected_images) != 3:
-            return False
+        skipped = str(stats["skipped"]) + ' materials skipped'
+        if len(stats["errors"]) > 0:
+            self.report({'WARNING'}, 'MustardTools - ' + str(stats["images"]) + ' images merged, ' + str(len(stats["errors"])) + ' images with errors (see the console), ' + skipped + '.')
+        elif stats["images"] == 0:
+            self.report({'WARNING'}, 'MustardTools - No images to merge found, ' + skipped + '.')
+        else:
+            self.report({'INFO'}, 'MustardTools - ' + str(stats["images"]) + ' images merged for ' + str(stats["materials"]) + ' materials in ' + "{:.2f}".format(stats["time"]) + ' s, ' + "{:.1f}".format(stats["vram_saved"] / 1048576.) + ' MB of VRAM saved, ' + skipped + '.')
+        
+        return {'FINISHED'}
+    
+    def invoke(self, context, event):
         
-        return True
+        return context.window_manager.invoke_props_dialog(self)
 
-    def execute(self, context):
+# ------------------------------------------------------------------------
+#    Command Line
+# ------------------------------------------------------------------------
+
+# The tools can be run without the UI on a list of .blend files described in a manifest (JSON):
+#
+#   blender -b --factory-startup --python mustard_tools.py -- --manifest manifest.json --workers 4 --log log.jsonl
+#
+# The manifest contains the list of "files" to process. Each file has its own "jobs" (or uses the
+# manifest "jobs"), and an optional "output" path (otherwise the file is overwritten):
+#
+#   {"jobs": [...], "files": [{"file": "character.blend", "output": "character_rig.blend", "jobs": [...]}]}
+#
+# Each file is processed in a separate background Blender instance, which runs the jobs with:
+#
+#   blender -b file.blend --python mustard_tools.py -- --jobs jobs.json --result result.json
+#
+# The available jobs are listed in mustardtools_cli_jobs. Every job can change the tool settings with the
+# "settings" dictionary (with the property names of MustardTools_Settings, objects are given by name).
+
+# Find an object of the given type using the name in job[key]
+def mustardtools_cli_get_object(job, key, type):
+    
+    obj = bpy.data.objects.get(job.get(key, ""))
+    
+    if obj == None or obj.type != type:
+        raise ValueError("Object " + str(job.get(key)) + " not found or not of type " + type)
+    
+    return obj
+
+# Change the tool settings with a dictionary of property names and values
+def mustardtools_cli_apply_settings(settings, values):
+    
+    for key, value in values.items():
         
-        settings = bpy.context.scene.mustardtools_settings
+        if key not in settings.bl_rna.properties:
+            raise ValueError("Unknown setting " + key)
+        
+        if settings.bl_rna.properties[key].type == 'POINTER':
+            value = bpy.data.objects.get(value) if value else None
         
-        def check_cv2():
+        setattr(settings, key, value)
+
+def mustardtools_cli_job_ik_chain(job, settings):
     
-            try:
-                import cv2
-                return True
-         
-            except:
-                
-                try:
-                    
-                    import subprocess
-                    import sys
-                    
-                    # path to python.exe
-                    python_exe = os.path.join(sys.prefix, 'bin', 'python.exe')
-                     
-                    # upgrade pip
-                    subprocess.call([python_exe, "-m", "ensurepip"])
-                    subprocess.call([python_exe, "-m", "pip", "install", "--upgrade", "pip"])
-                     
-                    # install required packages
-                    subprocess.call([python_exe, "-m", "pip", "install", "opencv-python"])
-                    
-                    return True
-                except:
-                    return False
-            
-            return False
+    arm = mustardtools_cli_get_object(job, "armature", 'ARMATURE')
+    
+    specs = job.get("chains", [])
+    if "file" in job:
+        arm_name, specs = mustardtools_ik_chain_load_specs(job["file"])
+    elif not isinstance(specs, list):
+        return False, "\"chains\" is not a list"
+    
+    chains = []
+    for spec in specs:
+        chain, error = mustardtools_ik_chain_from_spec(arm, spec, settings)
+        if chain == None:
+            return False, error
+        chains.append(chain)
+    
+    stats = mustardtools_ik_chain_build(arm, chains, settings)
+    
+    return True, str(stats["chains"]) + " IK chains created with " + str(stats["mode_switches"]) + " mode switches"
 
-        def import_image(name):
-            
-            import cv2
-            return cv2.imread(name, cv2.IMREAD_GRAYSCALE)
+def mustardtools_cli_job_ik_chain_poles(job, settings):
+    
+    arm = mustardtools_cli_get_object(job, "armature", 'ARMATURE')
+    
+    bone_names = job.get("bones", [bone.name for bone in arm.pose.bones])
+    
+    stats = mustardtools_ik_chain_poles_build(arm, bone_names, settings)
+    
+    return True, str(stats["poles"]) + " IK poles created with " + str(stats["mode_switches"]) + " mode switches"
 
-        def merge_and_export_image(r, g, b, output_name = "output.png"):
-            
-            import cv2
-            
-            def check_ratio(r, g, b):
-                
-                ratios = [r.shape[1]/r.shape[0], g.shape[1]/g.shape[0], b.shape[1]/b.shape[0]]
-                
-                return ratios[0] == ratios[1] and ratios[0] == ratios[2] and ratios[1] == ratios[2]
-            
-            def find_min_dim(r, g, b):
-                return [min([r.shape[0], g.shape[0], b.shape[0]]),min([r.shape[1], g.shape[1], b.shape[1]])]
-            
-            def check_shape_and_resize(img, min_dims):
-                
-                if img.shape[0] > min_dims[0] or img.shape[1] > min_dims[1]:
-                    return cv2.resize(img, (min_dim_x, min_dim_y), interpolation = cv2.INTER_AREA)
-                
-                return img
-            
-            # Check if the ratios of the images are the same
-            if not check_ratio(r,g,b):
-                return False, None
-            
-            # Find minimum dimension and eventually reshape
-            min_dims = find_min_dim(r, g, b)
-            r = check_shape_and_resize(r, min_dims)
-            g = check_shape_and_resize(g, min_dims)
-            b = check_shape_and_resize(b, min_dims)
-            
-            # Merge images into RGB
-            rgb = cv2.merge((r,g,b))
-            
-            # Check if the textures folder is already created and eventually create one
-            try:
-                os.mkdir('textures')
-            except:
-                pass
-            
-            # Write the final image
-            cv2.imwrite("textures\\"+ output_name, rgb)
-            
-            return True, rgb
+def mustardtools_cli_job_ik_spline(job, settings):
+    
+    arm = mustardtools_cli_get_object(job, "armature", 'ARMATURE')
+    
+    chains = []
+    for spec in job.get("chains", []):
+        chain_bones, error = mustardtools_chain_bones_from_spec(arm, spec)
+        if chain_bones == None:
+            return False, error
+        if settings.ik_spline_number > len(chain_bones)-1:
+            return False, "Chain ending with " + chain_bones[-1] + " is too short for " + str(settings.ik_spline_number) + " controllers"
+        chains.append(chain_bones)
+    
+    warning, stats = mustardtools_ik_spline_build(arm, chains, settings)
+    
+    message = str(stats["chains"]) + " IK splines created with " + str(stats["mode_switches"]) + " mode switches"
+    if warning:
+        message += " (location not applied on the armature)"
+    
+    return True, message
 
-        def find_and_create_link(links, from_node, new_from_node_output):
-            
-            for l in links:
-                if l.from_node == from_node:
-                    links.new(new_from_node_output, l.to_socket)
-                    return True
-            
-            return False
-        
-        # Check active material on active object
-        active_material = bpy.context.active_object.active_material.name
-        nodes = bpy.data.materials[active_material].node_tree.nodes
-        links = bpy.data.materials[active_material].node_tree.links
+def mustardtools_cli_job_mouth_controller(job, settings):
+    
+    return mustardtools_mouth_controller_apply(settings)
+
+def mustardtools_cli_job_merge_images(job, settings):
+    
+    material = bpy.data.materials.get(job.get("material", ""))
+    if material == None or material.node_tree == None:
+        raise ValueError("Material " + str(job.get("material")) + " not found or without nodes")
+    
+    # The nodes are given by name, or as channels definitions with the "node", "channel", "value", "invert" and "remap" keys
+    channels = []
+    for node_name in job.get("nodes", []):
+        spec = node_name if isinstance(node_name, dict) else {"node": node_name}
+        node = None
+        if spec.get("node") != None:
+            node = material.node_tree.nodes.get(spec["node"])
+            if node == None or node.type != "TEX_IMAGE" or node.image == None:
+                raise ValueError("Image node " + spec["node"] + " not found in " + material.name)
+        channels.append(mustardtools_merge_images_channel(node, spec.get("channel", 0), spec.get("value", 0.), spec.get("invert", False), spec.get("remap", (0., 1.))))
+    
+    if len(channels) not in [3, 4]:
+        return False, "3 or 4 image nodes are needed"
+    
+    return mustardtools_merge_images_to_grayscale(material.node_tree, channels, settings)
+
+def mustardtools_cli_job_merge_images_batch(job, settings):
+    
+    materials = bpy.data.materials
+    if "collection" in job:
+        collection = bpy.data.collections.get(job["collection"])
+        if collection == None:
+            raise ValueError("Collection " + job["collection"] + " not found")
+        materials = set(slot.material for obj in collection.all_objects for slot in obj.material_slots if slot.material != None)
+    
+    stats = mustardtools_merge_images_batch(materials, settings, job.get("workers", 4))
+    
+    message = str(stats["images"]) + " images merged for " + str(stats["materials"]) + " materials, " + str(stats["skipped"]) + " materials skipped, " + str(stats["vram_saved"]) + " bytes of VRAM saved"
+    
+    return len(stats["errors"]) == 0, "; ".join([message] + stats["errors"])
+
+mustardtools_cli_jobs = {
+    "ik_chain": mustardtools_cli_job_ik_chain,
+    "ik_chain_poles": mustardtools_cli_job_ik_chain_poles,
+    "ik_spline": mustardtools_cli_job_ik_spline,
+    "mouth_controller": mustardtools_cli_job_mouth_controller,
+    "merge_images": mustardtools_cli_job_merge_images,
+    "merge_images_batch": mustardtools_cli_job_merge_images_batch,
+}
+
+# Run a list of jobs on the currently opened file.
+# Returns the list of results, one for each job
+def mustardtools_cli_run_jobs(jobs):
+    
+    settings = bpy.context.scene.mustardtools_settings
+    
+    results = []
+    for job in jobs:
         
-        # Check if the selected nodes are images
-        selected_images = []
-        for n in nodes:
-            if n.select and n.type=="TEX_IMAGE":
-                selected_images.append(n)
+        start_time = time.time()
         
-        if not check_cv2():
-            self.report({'ERROR'}, 'MustardTools - Can not find or download CV2 for Python.')
-            return 2
+        try:
+            mustardtools_cli_apply_settings(settings, job.get("settings", {}))
+            res, message = mustardtools_cli_jobs[job["type"]](job, settings)
+        except Exception as e:
+            res, message = False, type(e).__name__ + ": " + str(e)
         
-        import cv2
+        # Go back to Object mode, so that the next job can freely choose the active object
+        if bpy.context.object != None and bpy.context.object.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
         
-        # Import the images from the nodes
-        r = import_image(selected_images[0].image.filepath[2:])
-        g = import_image(selected_images[1].image.filepath[2:])
-        b = import_image(selected_images[2].image.filepath[2:])
+        results.append({"type": job.get("type"),
+                        "status": "OK" if res else "ERROR",
+                        "message": message,
+                        "time": time.time() - start_time})
         
-        # Choose export file name
-        sep = settings.merge_images_to_grayscale_separator
-        image_name = selected_images[0].image.name + sep + selected_images[1].image.name + sep + selected_images[2].image.name + ".png"
+        print("MustardTools - " + str(job.get("type")) + ": " + ("OK" if res else "ERROR") + " - " + message)
+    
+    return results
+
+# Run the jobs on the file opened by the background Blender instance, and save the results
+def mustardtools_cli_worker(jobs_path, result_path, output_path):
+    
+    start_time = time.time()
+    
+    with open(jobs_path, 'r') as f:
+        jobs = json.load(f)
+    
+    results = mustardtools_cli_run_jobs(jobs)
+    
+    # The file is saved only if all the jobs succeeded, so that the input file is never overwritten with a partial result
+    status = "OK" if all(r["status"] == "OK" for r in results) else "ERROR"
+    if status == "OK":
+        bpy.ops.wm.save_as_mainfile(filepath=output_path if output_path else bpy.data.filepath)
+    
+    result = {"file": bpy.data.filepath, "status": status, "saved": status == "OK", "jobs": results, "time": time.time() - start_time}
+    
+    if result_path:
+        with open(result_path, 'w') as f:
+            json.dump(result, f)
+    
+    return result
+
+# Process a file of the manifest in a background Blender instance.
+# The instance runs in the folder of the manifest, so that the relative paths of the jobs are resolved from there
+def mustardtools_cli_process_file(entry, jobs, blender, timeout, cwd):
+    
+    import subprocess
+    import tempfile
+    
+    start_time = time.time()
+    result = {"file": entry["file"], "output": entry.get("output", entry["file"]), "status": "ERROR", "saved": False, "jobs": []}
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        
+        jobs_path = os.path.join(tmp_dir, "jobs.json")
+        result_path = os.path.join(tmp_dir, "result.json")
+        
+        with open(jobs_path, 'w') as f:
+            json.dump(jobs, f)
+        
+        command = [blender, "-b", "--factory-startup", entry["file"],
+                   "--python", os.path.abspath(__file__), "--",
+                   "--jobs", jobs_path, "--result", result_path]
+        if "output" in entry:
+            command += ["--output", entry["output"]]
+        
+        try:
+            process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, cwd=cwd)
+            if os.path.isfile(result_path):
+                with open(result_path, 'r') as f:
+                    worker_result = json.load(f)
+                result["status"] = worker_result["status"]
+                result["saved"] = worker_result["saved"]
+                result["jobs"] = worker_result["jobs"]
+            else:
+                result["error"] = "Blender exited with code " + str(process.returncode) + " without results"
+                result["log"] = process.stdout.decode(errors="replace")[-2000:]
+        except subprocess.TimeoutExpired:
+            result["error"] = "Timeout after " + str(timeout) + " s"
+    
+    result["time"] = time.time() - start_time
+    
+    return result
+
+# Process all the files of a manifest using a pool of background Blender instances.
+# The result of every file is written as a JSON line in the log file as soon as it is available
+def mustardtools_cli_run_manifest(manifest_path, workers, log_path, blender, timeout):
+    
+    import concurrent.futures
+    
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    if os.path.dirname(blender):
+        blender = os.path.abspath(blender)
+    entries = []
+    for entry in manifest.get("files", []):
+        if isinstance(entry, str):
+            entry = {"file": entry}
+        entry = dict(entry)
+        entry["file"] = os.path.join(manifest_dir, entry["file"])
+        if "output" in entry:
+            entry["output"] = os.path.join(manifest_dir, entry["output"])
+        entries.append(entry)
+    
+    start_time = time.time()
+    failed = 0
+    
+    with open(log_path, 'w') as log, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
         
-        # Merge and export
-        res, img = merge_and_export_image(r,g,b, output_name = image_name)
-        if not res:
-            self.report({'ERROR'}, 'MustardTools - Image merge failed.')
-            return 3
+        futures = [pool.submit(mustardtools_cli_process_file, entry, entry.get("jobs", manifest.get("jobs", [])), blender, timeout, manifest_dir) for entry in entries]
         
-        if settings.merge_images_to_grayscale_substitute_nodes:
-            # Create new node
-            img_node = nodes.new('ShaderNodeTexImage')
-            img_node.location = ((selected_images[0].location[0] + selected_images[1].location[0] + selected_images[2].location[0])/3,
-                             (selected_images[0].location[1] + selected_images[1].location[1] + selected_images[2].location[1])/3)  
-            imported_image = bpy.data.images.load("//textures/" + image_name)
-            img_node.image = imported_image
-            
-            # Create Separate RGB node
-            sep_node = nodes.new('ShaderNodeSeparateColor')
-            sep_node.location = (img_node.location[0] + 300, img_node.location[1])
-            
-            # Create link to new image to Separate RGB node
-            links.new(img_node.outputs["Color"], sep_node.inputs["Color"])
-            # Try to restore old nodes links
-            find_and_create_link(links, selected_images[0], sep_node.outputs[0])
-            find_and_create_link(links, selected_images[1], sep_node.outputs[1])
-            find_and_create_link(links, selected_images[2], sep_node.outputs[2])
-            
-            # Remove old nodes
-            for n in selected_images:
-                nodes.remove(n)
-        
-        self.report({'INFO'}, 'MustardTools - Images merged.') 
-        return {'FINISHED'}
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if result["status"] != "OK":
+                failed += 1
+            log.write(json.dumps(result) + "\n")
+            log.flush()
+            print("MustardTools - " + result["file"] + ": " + result["status"] + " (" + "{:.2f}".format(result["time"]) + " s)")
+    
+    print("MustardTools - " + str(len(entries)) + " files processed in " + "{:.2f}".format(time.time() - start_time) + " s, " + str(failed) + " with errors")
+    
+    return failed
+
+# Command line entry point, with the arguments after "--" in the Blender command line.
+# Returns the exit code
+def mustardtools_cli_main(argv):
+    
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog="mustard_tools.py", description="Mustard Tools command line")
+    parser.add_argument("--manifest", help="JSON manifest with the files to process")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of background Blender instances")
+    parser.add_argument("--log", default="mustardtools_log.jsonl", help="Log file with the results for each file")
+    parser.add_argument("--blender", default=bpy.app.binary_path, help="Blender executable")
+    parser.add_argument("--timeout", type=float, default=None, help="Maximum time in seconds for each file")
+    parser.add_argument("--jobs", help="JSON file with the jobs to run on the opened file")
+    parser.add_argument("--result", help="JSON file where the result of the jobs is written")
+    parser.add_argument("--output", help="Path where the processed file is saved (default: overwrite)")
+    parser.add_argument("--benchmark-resample", type=int, metavar="SIZE", help="Compare the image resampling strategies on a SIZExSIZE image")
+    parser.add_argument("--benchmark-target", type=int, default=2048, help="Size of the resampled image for the benchmark")
+    args = parser.parse_args(argv)
+    
+    if args.benchmark_resample:
+        for result in mustardtools_resample_benchmark(args.benchmark_resample, args.benchmark_target):
+            print("MustardTools Merge Images - " + result["strategy"] + ": " + "{:.1f}".format(result["megapixels_per_second"]) + " MP/s, peak " + "{:.1f}".format(result["peak_mb"]) + " MB")
+        return 0
+    
+    if args.manifest:
+        failed = mustardtools_cli_run_manifest(args.manifest, args.workers, args.log, args.blender, args.timeout)
+        return 0 if failed == 0 else 1
+    elif args.jobs:
+        result = mustardtools_cli_worker(args.jobs, args.result, args.output)
+        return 0 if result["status"] == "OK" else 1
+    
+    parser.print_help()
+    return 0
 
 # ------------------------------------------------------------------------
 #    UI
@@ -2196,6 +4444,7 @@ class MUSTARDTOOLS_PT_IKChain(MainPanel, bpy.types.Panel):
         box=layout.box()
         box.label(text="Main settings", icon="CON_KINEMATIC")
         box.prop(settings,"ik_chain_last_bone_use")
+        box.prop(settings,"ik_chain_mirror")
         box.prop(settings,"ik_chain_bendy")
         col=box.column()
         if not settings.ik_chain_bendy:
@@ -2206,9 +4455,11 @@ class MUSTARDTOOLS_PT_IKChain(MainPanel, bpy.types.Panel):
         row.scale_x = 3.
         row.prop(settings,"ik_chain_last_bone_custom_shape")
         layout.operator('mustardui.ik_chain', icon="ADD")
+        layout.operator('mustardui.ik_chain_batch', icon="FILE_TICK")
         box=layout.box()
         box.label(text="Pole settings", icon="SHADING_WIRE")
         box.prop(settings,"ik_chain_pole_angle")
+        box.prop(settings,"ik_chain_pole_distance")
         row=box.row()
         row.label(text="Shape")
         row.scale_x = 3.
@@ -2220,6 +4471,7 @@ class MUSTARDTOOLS_PT_IKChain(MainPanel, bpy.types.Panel):
             row.operator('mustardui.ik_chainpole', text="Confirm", icon = "CHECKMARK", depress = True).status = False
             row.scale_x=1.
             row.operator('mustardui.ik_chainpole', text="", icon = "X").cancel = True
+        layout.operator('mustardui.ik_chainpole_auto', icon="AUTO")
         layout.separator()
         layout.operator('mustardui.ik_chainclean', icon="CANCEL")
 
@@ -2235,8 +4487,10 @@ class MUSTARDTOOLS_PT_IKSpline(MainPanel, bpy.types.Panel):
         box=layout.box()
         box.label(text="Main settings", icon="CON_SPLINEIK")
         box.prop(settings,"ik_spline_number")
+        box.prop(settings,"ik_spline_arc_length")
         if settings.ms_advanced:
             box.prop(settings,"ik_spline_resolution")
+        box.prop(settings,"ik_spline_mirror")
         box.prop(settings,"ik_spline_bendy")
         col=box.column()
         if not settings.ik_spline_bendy:
@@ -2254,10 +4508,18 @@ class MUSTARDTOOLS_PT_IKSpline(MainPanel, bpy.types.Panel):
             row.prop(settings,"ik_spline_bone_custom_shape")
         
         layout.operator('mustardui.ik_spline', icon="ADD")
+        layout.operator('mustardui.ik_spline_batch', icon="OUTLINER_OB_CURVE")
         
         layout.separator()
         layout.operator('mustardui.ik_splineclean', icon="CANCEL")
 
+class MUSTARDTOOLS_UL_MouthControllerProfiles(bpy.types.UIList):
+    
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname):
+        
+        layout.prop(item, "enabled", text="")
+        layout.label(text=item.name, icon="ARMATURE_DATA")
+
 class MUSTARDTOOLS_PT_MouthController(MainPanel, bpy.types.Panel):
     bl_idname = "MUSTARDTOOLS_PT_MouthController"
     bl_label = "Mouth Controller"
@@ -2275,6 +4537,10 @@ class MUSTARDTOOLS_PT_MouthController(MainPanel, bpy.types.Panel):
         box.prop(settings,"mouth_controller_mirror")
         box.prop(settings,"mouth_controller_number_bones")
         box.prop(settings,"mouth_controller_create_driver")
+        if settings.mouth_controller_create_driver:
+            box.prop(settings,"mouth_controller_driver_type")
+            if settings.mouth_controller_driver_type == "SWITCH" and settings.mouth_controller_armature != None:
+                box.prop(settings.mouth_controller_armature,"mustardtools_mouth_controller_mute")
         box.prop(settings,"mouth_controller_mhx")
         if settings.ms_advanced:
             box.prop(settings,"mouth_controller_transform_ratio")
@@ -2329,6 +4595,7 @@ class MUSTARDTOOLS_PT_MouthController(MainPanel, bpy.types.Panel):
         row=box.row()
         row.label(text="Mouth settings", icon="BONE_DATA")
         row.operator('mustardui.mouth_controller_search', icon="VIEWZOOM", text="")
+        row.operator('mustardui.mouth_controller_classify', icon="GROUP_BONE", text="")
         row=box.row()
         row.label(text="Armature")
         row.scale_x = row_scale
@@ -2339,6 +4606,12 @@ class MUSTARDTOOLS_PT_MouthController(MainPanel, bpy.types.Panel):
         row.scale_x = row_scale
         row.prop(settings,"mouth_controller_body_object", text="")
         
+        if settings.ms_advanced:
+            row=box.row()
+            row.label(text="Conventions")
+            row.scale_x = row_scale
+            row.prop(settings,"mouth_controller_conventions_file", text="")
+        
         if settings.mouth_controller_armature != None:
             
             row=box.row()
@@ -2423,6 +4696,19 @@ class MUSTARDTOOLS_PT_MouthController(MainPanel, bpy.types.Panel):
         layout.operator('mustardui.mouth_controller', icon="ADD")
         layout.separator()
         layout.operator('mustardui.mouth_controller_clean', icon="CANCEL", text="Clean")
+        
+        box=layout.box()
+        box.label(text="Profiles", icon="COMMUNITY")
+        row=box.row()
+        row.template_list("MUSTARDTOOLS_UL_MouthControllerProfiles", "", settings, "mouth_controller_profiles", settings, "mouth_controller_profiles_index")
+        col=row.column(align=True)
+        col.operator('mustardui.mouth_controller_profile_add', icon="ADD", text="")
+        col.operator('mustardui.mouth_controller_profile_remove', icon="REMOVE", text="")
+        col.separator()
+        col.operator('mustardui.mouth_controller_profile_load', icon="IMPORT", text="")
+        row=box.row(align=True)
+        row.operator('mustardui.mouth_controller_batch', icon="ADD", text="Apply All").action = "APPLY"
+        row.operator('mustardui.mouth_controller_batch', icon="CANCEL", text="Clean All").action = "CLEAN"
 
 
 class MUSTARDTOOLS_PT_MergeImagesToGrayscale(MainPanel, bpy.types.Panel):
@@ -2438,8 +4724,78 @@ class MUSTARDTOOLS_PT_MergeImagesToGrayscale(MainPanel, bpy.types.Panel):
         box.label(text="Main settings", icon="OUTLINER_OB_IMAGE")
         box.prop(settings,"merge_images_to_grayscale_substitute_nodes")
         box.prop(settings,"merge_images_to_grayscale_separator")
+        box.prop(settings,"merge_images_to_grayscale_save")
+        box.prop(settings,"merge_images_to_grayscale_layout")
+        box.prop(settings,"merge_images_to_grayscale_resolution")
+        if settings.merge_images_to_grayscale_resolution == "EXPLICIT":
+            row=box.row(align=True)
+            row.prop(settings,"merge_images_to_grayscale_width")
+            row.prop(settings,"merge_images_to_grayscale_height")
+        box.prop(settings,"merge_images_to_grayscale_filter")
+        if settings.ms_advanced:
+            box.prop(settings,"merge_images_to_grayscale_streaming")
+            col=box.column()
+            if not settings.merge_images_to_grayscale_streaming:
+                col.enabled=False
+            col.prop(settings,"merge_images_to_grayscale_strip")
+        
+        if settings.merge_images_to_grayscale_layout == "CUSTOM":
+            obj = bpy.context.active_object
+            node_tree = obj.active_material.node_tree if obj != None and obj.active_material != None else None
+            box=layout.box()
+            box.label(text="Channels", icon="NODE_TEXTURE")
+            for c in ["r", "g", "b", "a"]:
+                layout_channel = getattr(settings, "merge_images_to_grayscale_" + c)
+                col=box.column(align=True)
+                row=col.row(align=True)
+                row.label(text=c.upper())
+                row.scale_x = 3.
+                row.prop(layout_channel, "source", text="")
+                if layout_channel.source == "IMAGE":
+                    row=col.row(align=True)
+                    if node_tree != None:
+                        row.prop_search(layout_channel, "node", node_tree, "nodes", text="")
+                    else:
+                        row.prop(layout_channel, "node", text="")
+                    row.prop(layout_channel, "channel", text="")
+                elif layout_channel.source == "CONSTANT":
+                    col.prop(layout_channel, "value")
+                if layout_channel.source != "NONE":
+                    row=col.row(align=True)
+                    row.prop(layout_channel, "invert", toggle=True)
+                    row.prop(layout_channel, "remap_min")
+                    row.prop(layout_channel, "remap_max")
         
         layout.operator('mustardui.merge_images_to_grayscale', icon="ADD")
+        layout.operator('mustardui.merge_images_to_grayscale_batch', icon="MATERIAL")
+
+class MUSTARDTOOLS_UL_RigComponents(bpy.types.UIList):
+    
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname):
+        
+        layout.label(text=item.name, icon=item.bl_rna.properties["type"].enum_items[item.type].icon)
+        layout.label(text=str(len(item.elements)))
+
+class MUSTARDTOOLS_PT_RigComponents(MainPanel, bpy.types.Panel):
+    bl_idname = "MUSTARDTOOLS_PT_RigComponents"
+    bl_label = "Rig Components"
+    bl_options = {"DEFAULT_CLOSED"}
+    
+    @classmethod
+    def poll(cls, context):
+        
+        return context.object != None and context.object.type == "ARMATURE"
+
+    def draw(self, context):
+        
+        layout = self.layout
+        arm = context.object
+        
+        layout.template_list("MUSTARDTOOLS_UL_RigComponents", "", arm, "mustardtools_rig_components", arm, "mustardtools_rig_components_index")
+        
+        row = layout.row(align=True)
+        row.operator('mustardui.rig_components_remove', icon="X", text="Remove").remove_all = False
+        row.operator('mustardui.rig_components_remove', icon="CANCEL", text="Remove All").remove_all = True
 
 class MUSTARDTOOLS_PT_Settings(MainPanel, bpy.types.Panel):
     bl_idname = "MUSTARDTOOLS_PT_Settings"
@@ -2469,18 +4825,31 @@ class MUSTARDTOOLS_PT_Settings(MainPanel, bpy.types.Panel):
 
 classes = (
     MUSTARDTOOLS_OT_IKChain,
+    MUSTARDTOOLS_OT_IKChain_Batch,
     MUSTARDTOOLS_OT_IKChain_Pole,
+    MUSTARDTOOLS_OT_IKChain_PoleAuto,
     MUSTARDTOOLS_OT_IKChain_Clean,
     MUSTARDTOOLS_PT_IKChain,
     MUSTARDTOOLS_OT_IKSpline,
+    MUSTARDTOOLS_OT_IKSpline_Batch,
     MUSTARDTOOLS_OT_IKSpline_Clean,
     MUSTARDTOOLS_PT_IKSpline,
     MUSTARDTOOLS_OT_MouthController,
     MUSTARDTOOLS_OT_MouthControllerSmartSearch,
+    MUSTARDTOOLS_OT_MouthControllerClassify,
     MUSTARDTOOLS_OT_MouthControllerClean,
+    MUSTARDTOOLS_OT_MouthControllerProfile_Add,
+    MUSTARDTOOLS_OT_MouthControllerProfile_Load,
+    MUSTARDTOOLS_OT_MouthControllerProfile_Remove,
+    MUSTARDTOOLS_OT_MouthController_Batch,
+    MUSTARDTOOLS_UL_MouthControllerProfiles,
     MUSTARDTOOLS_PT_MouthController,
     MUSTARDTOOLS_OT_MergeImagesToGrayscale,
+    MUSTARDTOOLS_OT_MergeImagesToGrayscale_Batch,
     MUSTARDTOOLS_PT_MergeImagesToGrayscale,
+    MUSTARDTOOLS_OT_RigComponents_Remove,
+    MUSTARDTOOLS_UL_RigComponents,
+    MUSTARDTOOLS_PT_RigComponents,
     MUSTARDTOOLS_PT_Settings
 )
 
@@ -2489,12 +4858,31 @@ def register():
     from bpy.utils import register_class
     for cls in classes:
         register_class(cls)
+    
+    if mustardtools_constraints_cache_update not in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.append(mustardtools_constraints_cache_update)
+    for handlers in [bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post]:
+        if mustardtools_constraints_cache_clear not in handlers:
+            handlers.append(mustardtools_constraints_cache_clear)
 
 def unregister():
     
+    if mustardtools_constraints_cache_update in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(mustardtools_constraints_cache_update)
+    for handlers in [bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post]:
+        if mustardtools_constraints_cache_clear in handlers:
+            handlers.remove(mustardtools_constraints_cache_clear)
+    mustardtools_constraints_cache.clear()
+    
     from bpy.utils import unregister_class
     for cls in reversed(classes):
         unregister_class(cls)
 
 if __name__ == "__main__":
     register()
+    
+    # Command line usage: blender -b [file.blend] --python mustard_tools.py -- [arguments]
+    if bpy.app.background and "--" in sys.argv:
+        exit_code = mustardtools_cli_main(sys.argv[sys.argv.index("--")+1:])
+        if exit_code != 0:
+            sys.exit(exit_code)